@@ -1,142 +1,122 @@
-import csv
-import numpy as np
-
-file_path = "C:\\Users\\xy.DESKTOP-6GVRBJT\\Documents\\Python\\twopstim\\twopstim\\stimuli\\OutputFiles\\_stimulus_output_2017_1_9_9_54_37.txt"
-
-# fieldnames=('tcurr','boutInd','epoch','fulltime','phase','theta','data')
-with open(file_path,'r') as csvfile:
-	stim_file = next(csvfile)#skip header
-	next(csvfile)#skip header
-	next(csvfile)#skip header with wrong timing
-	reader = csv.DictReader(csvfile)
-	
-	# flickering freuqnecy per epoch in hz
-	freq_1 = 16.0
-	freq_2 = 30.0
-	freq_3 = 32.0
-	freq_4 = 25.0
-	
-	# phasenlaengen
-	phase_1 = 1/freq_1
-	phase_2 = 1/freq_2
-	phase_3 = 1/freq_3
-	phase_4 = 1/freq_4
-	
-	# to analyze quickly
-	max_length = 10000
-	
-	phase = [0]*max_length
-	on_all = [0]*max_length
-	epoch = [0]*max_length
-	fulltime = [0]*max_length
-	tcurr = [0]*max_length 
-	framedur = [0]*max_length 
-	
-	ii = 0
-	#print "Stimfile:\n"
-	#print stim_file
-	
-	reader.fieldnames=['frame',"tcurr",'boutInd','epoch','fulltime','phase','theta','data']
-	for row in reader:
-		if ii < max_length:
-			epoch[ii] = float(row['epoch'])
-			#if epoch[ii] == 1.0:# Just for epoch 1
-			phase[ii] = float(row['phase'])
-			on_all[ii] = float(row['theta'])
-			fulltime[ii] = float(row['fulltime'])
-			tcurr[ii] = float(row['tcurr'])	
-			if ii > 2: # calc framduration average
-				framedur[ii] = fulltime[ii]-fulltime[ii-1]
-			ii += 1
-		
-	# Average frameduration
-	framedur_cut = framedur[:ii]
-	frameduration = np.median(framedur_cut)
-	#frameduration = sum(framedur_cut)/float(len(framedur_cut))
-	print "\n\nFrameduration average: %f" %(frameduration)
-	length_file = ii
-	print "Length File: %d\n" %(length_file)
-	
-	# cut list
-	on = on_all[:length_file]
-	# stores no. of 1's or 0's in a row
-	maximum_1s = [[0 for x in range(2)] for y in range(length_file)]
-	maximum_0s = [[0 for x in range(2)] for y in range(length_file)]
-	diff = [0]*length_file
-	j = 0
-	k = 0
-	
-	if length_file > max_length:
-		length_file = max_length
-	
-	for ii in range(length_file-1):
-		diff[ii] = on[ii+1]-on[ii]
-		
-		if(int(on[ii]) == 1):
-			maximum_1s[j][0] += 1;
-			#print "%d %d %1.3f  %d" %(on[ii],maximum_1s[j][0], tcurr[ii],j)
-		if int(diff[ii]) == -1: # this phasis part has ended
-			maximum_1s[j][1] = tcurr[ii] # record end time
-			j += 1;
-			 
-			
-		# Off phasis part
-		if(int(on[ii]) == 0):
-			maximum_0s[k][0] += 1;
-			#print "%d %d %d %1.3f  %d" %(ii, on[ii],maximum_0s[k][0], tcurr[ii],k)
-		if int(diff[ii]) == 1:
-			maximum_0s[k][1] = tcurr[ii] # record end time
-			k += 1;
-			
-	# Cut array, there are counting mistakes
-	maximum_0s[0][0] = 0
-	maximum_0s[k][0] = 0
-	
-
-	if "16_16" in stim_file:
-		print "Stimulus with 16 Hz: Phasis-lenght= 1/16 = %f, -> ca. %1.1f frames per phasis" % (phase_1,phase_1/frameduration)
-		print "Regularly, half a phasis should contain %1.1f frames." %(phase_1/frameduration/2)
-		reg_dur_0 = phase_1/frameduration/2 # frames per half phasis
-	elif "30_30" in stim_file:
-		print "Stimulus with 30 Hz: Phasis-lenght= 1/30 = %f, -> ca. %1.1f frames per phasis" % (phase_2,phase_2/frameduration)
-		print "Regularly, half a phasis should contain %1.1f frames." %(phase_2/frameduration/2)
-		reg_dur_0 = phase_2/frameduration/2 # frames per half phasis
-	elif "32_32" in stim_file:
-		print "Stimulus with 32 Hz: Phasis-lenght= 1/32 = %f, -> ca. %1.1f frames per phasis\n" % (phase_3,phase_3/frameduration)
-		print "Regularly, half a phasis should contain %1.1f frames." %(phase_3/frameduration/2)
-		reg_dur_0 = phase_3/frameduration/2 # frames per half phasis
-	elif "25_25" in stim_file:
-		print "Stimulus with 25 Hz: Phasis-lenght= 1/25 = %f, -> ca. %1.1f frames per phasis\n" % (phase_4,phase_4/frameduration)
-		print "Regularly, half a phasis should contain %1.1f frames." %(phase_4/frameduration/2)
-		reg_dur_0 = phase_4/frameduration/2 # frames per half phasis
-	
-	
-	for ii in range(length_file):
-		if maximum_0s[ii][0] == 0 and ii > 0:
-			end_index = ii;
-			break
-			
-	maximum_0s = maximum_0s[:end_index]
-	
-	for ii in range(length_file):
-		if maximum_1s[ii][0] == 0 and ii > 0:
-			end_index = ii;
-			break
-			
-	maximum_1s = maximum_1s[:end_index]
-	
-	# max along first axis
-	max_0 = np.amax(maximum_0s,0)
-	max_1 = np.amax(maximum_1s,0)
-	
-	print "\nMaximum 0s (No. of frames in a row which are black, e.g. off part of phasis)"
-	print max_0
-	print "Deviation of max: %2.1f %% error" %((max_0[0]-reg_dur_0)/reg_dur_0 * 100)
-	print "Median: %2.1f  ,Average: %2.1f  ,Std Dev: %2.2f , in percent: %2.2f %%\n" %(np.median(maximum_0s,0)[0],np.average(maximum_0s,0)[0],np.std(maximum_0s,0)[0],np.std(maximum_0s,0)[0]/reg_dur_0 *100)
-
-	print "Maximum 1s (No. of frames in a row which are bright, e.g. on part of phasis)"	
-	print max_1
-	print "Deviation of max: %2.1f %% error" %((max_1[0]-reg_dur_0)/reg_dur_0 * 100)
-	print "Median: %2.1f  ,Average: %2.1f  ,Std Dev: %2.2f , in percent: %2.2f %%" %(np.median(maximum_1s,0)[0],np.average(maximum_1s,0)[0],np.std(maximum_1s,0)[0],np.std(maximum_1s,0)[0]/reg_dur_0 *100)
-	
-	
\ No newline at end of file
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Timing analysis of frame logs (stimulus output files), see modules/framelog.py.
+
+Frame logs (or every frame log in the given directories) are analysed in
+parallel, one process per file: frame intervals, dropped frames, run
+lengths of a column (theta by default, e.g. the on/off phases of a
+flicker) and timing per epoch. A combined report of all sessions is
+printed and can be stored as JSON.
+
+Example:
+    python bin/analyse_output.py OutputFiles --processes 4 --report timing.json
+    python bin/analyse_output.py my_stimulus_output.txt --epochs
+    python bin/analyse_output.py OutputFiles --binary  # also stores .npy copies
+
+"""
+
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+
+os.environ.setdefault('PYVISUALSTIM_HEADLESS', '1') # no dialog
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules import framelog
+
+
+def frame_log_files(paths):
+    """ Returns the frame logs of files and directories (the binary copy if
+    both exist) """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                for name in sorted(names):
+                    filename = os.path.join(root, name)
+                    if not framelog.is_frame_log(filename) or name.endswith('_header.npy'):
+                        continue
+                    if name.endswith('.txt') and os.path.exists(framelog.binary_filename(filename)):
+                        continue
+                    files.append(filename)
+        else:
+            files.append(path)
+    return files
+
+
+def _analyse(job):
+    filename, column, binary = job
+    try:
+        log = framelog.read_frame_log(filename)
+        if binary and not filename.endswith('.npy'):
+            framelog.write_binary(log)
+        return framelog.analyse(log, column), None
+    except Exception as e:
+        return {'filename': filename}, repr(e)
+
+
+def _ms(value):
+    return '%8.3f' % value if value is not None else '%8s' % '-'
+
+
+def print_summary(summary, epochs=False):
+    interval = summary['frame_interval_ms']
+    print(f"{summary['filename']}")
+    print(f"    {summary['frames']} frames, {summary['duration_s']:.2f} s, "
+          f"{summary['framerate'] or 0:.3f} Hz, dropped {summary['dropped_frames']} "
+          f"({summary['drop_events']} events), interval median {_ms(interval['median'])} ms, "
+          f"max {_ms(interval['max'])} ms")
+    runs = summary['run_lengths']
+    for value, statistics in sorted(runs['runs'].items()):
+        if statistics['count']:
+            print(f"    {runs['column']} = {value:g}: {statistics['count']} runs, frames median "
+                  f"{statistics['median']:g}, max {statistics['max']:g}, std {statistics['std']:.2f}")
+    if epochs:
+        for epoch, statistics in sorted(summary['epochs'].items()):
+            print(f"    epoch {epoch:3d}: {statistics['presentations']:4d} x "
+                  f"{statistics['frames']['median']:g} frames, duration median "
+                  f"{statistics['duration_s']['median']:.3f} s, dropped {statistics['dropped']}, "
+                  f"max interval {_ms(statistics['max_interval_ms'])} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Timing analysis of frame logs')
+    parser.add_argument('paths', nargs='+', help='frame logs or directories')
+    parser.add_argument('--column', default='theta', choices=framelog.COLUMNS,
+                        help='column whose run lengths are reported')
+    parser.add_argument('--epochs', action='store_true', help='print the timing per epoch')
+    parser.add_argument('--binary', action='store_true',
+                        help='store a binary copy (.npy) of every text frame log')
+    parser.add_argument('--report', default=None, help='JSON file for the combined report')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    jobs = [(filename, args.column, args.binary) for filename in frame_log_files(args.paths)]
+    summaries = []
+    with multiprocessing.Pool(args.processes) as pool:
+        for summary, error in pool.imap(_analyse, jobs):
+            if error:
+                print(f"FAILED {summary['filename']}: {error}")
+                continue
+            print_summary(summary, args.epochs)
+            summaries.append(summary)
+
+    # Combined report
+    frames = sum(summary['frames'] for summary in summaries)
+    dropped = sum(summary['dropped_frames'] for summary in summaries)
+    with_drops = sum(1 for summary in summaries if summary['dropped_frames'])
+    print('##############################################')
+    print(f'{len(summaries)} sessions, {frames} frames, {dropped} dropped frames '
+          f'({with_drops} sessions with drops)')
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'sessions': summaries, 'frames': frames, 'dropped_frames': dropped},
+                      f, indent=2)
+        print(f'Report: {args.report}')
+
+
+if __name__ == '__main__':
+    main()
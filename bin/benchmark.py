@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Benchmark of every stimulus type, without projector or NI-DAQ.
+
+Every case is a small generated stimulus file, run as a whole session by the
+dry run (see modules/simulation.py) with the simulated DAQ, in its own
+process. Reported per case:
+
+- setup time: from the start of the session to its first flip (textures,
+  stimulus objects, schedule, preparation of the first epoch)
+- per-frame CPU time (main thread) and wall time between flips, as percentiles
+- peak RSS of the process
+- garbage collections during epochs (none with --realtime, see modules/realtime.py)
+
+Two windows:
+
+- ``simulated`` (default): no OpenGL, measures the per-frame Python logic only
+  (draw() does nothing, so e.g. the number of dots does not matter)
+- ``gl``: a real psychopy window with waitBlanking=False (frames are not
+  synchronized to the screen). Use a software GL context to run it headless,
+  e.g. ``xvfb-run python bin/benchmark.py --window gl``
+
+Example:
+    python bin/benchmark.py --out benchmark_results/abc123.json
+    python bin/benchmark.py --baseline benchmark_results/old.json --out new.json
+    python bin/benchmark.py --compare old.json new.json
+    python bin/benchmark.py --realtime --baseline without_realtime.json
+
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import datetime
+import tempfile
+import subprocess
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+os.environ.setdefault('PYVISUALSTIM_HEADLESS', '1') # no dialog
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import numpy as np
+
+PERCENTILES = (50, 90, 99, 99.9)
+DOT_COUNTS = (1, 1000, 10000, 35000)
+
+# Stimulus attributes per case: (STIMULUSDATA, {attribute: value per epoch})
+CASES = {
+    'C': ('NULL', {'stimtype': ['C'], 'bg': [0.5], 'fg': [0], 'duration': [2], 'tau': [1],
+                   'radius': [120]}),
+    'R': ('NULL', {'stimtype': ['R'], 'bg': [0.5], 'fg': [0], 'duration': [2], 'tau': [1],
+                   'width': [4.5], 'height': [4.5], 'number': [3], 'interSpace': [10],
+                   'x_center': [0], 'y_center': [0]}),
+    'NC': ('SINUSOIDAL_NOISY_TEXTURE', {'stimtype': ['NC'], 'bg': [0.5], 'fg': [111], 'lum': [0.5],
+                                        'michealson.contrast': [0.1], 'frequency': [1], 'SNR': [2],
+                                        'radius': [120], 'duration': [3], 'tau': [0]}),
+    'SSR': ('NULL', {'stimtype': ['SSR'], 'bg': [0.5], 'fg': [1], 'bar.duration': [0.5],
+                     'bg.duration': [0.5], 'bar.width': [5], 'bar.height': [360],
+                     'bar.orientation': [0], 'bar.xmin': [-40], 'bar.xmax': [40],
+                     'bar.ymin': [-40], 'bar.ymax': [40], 'bar.distance': [5]}),
+    'DS': ('NULL', {'stimtype': ['DS'], 'bg': [0.5], 'fg': [0], 'duration': [2], 'tau': [0],
+                    'velocity': [100], 'direction': [1], 'bar.initPos': [0], 'bar.width': [5],
+                    'bar.height': [80], 'bar.orientation': [0], 'bar.number': [1],
+                    'bar.interSpace': [0]}),
+    'N_16x16': ('TERNARY_TEXTURE', {'stimtype': ['C', 'N'], 'bg': [0.5, 0.5], 'fg': [0.5, 0],
+                                    'duration': [1, 0], 'tau': [0, 0], 'radius': [120, 0],
+                                    'texture.duration': [0, 0.05], 'texture.count': [0, 10000],
+                                    'texture.hor_size': [0, 16], 'texture.vert_size': [0, 16]}),
+    'G': ('SINUSOIDAL_NOISY_TEXTURE', {'stimtype': ['noisygrating'], 'bg': [0.5], 'fg': [111],
+                                       'lum': [0.5], 'michealson.contrast': [1],
+                                       'sWavelength': [30], 'velocity': [30], 'SNR': [2],
+                                       'duration': [4], 'tau': [1]}),
+}
+CASES['DS_multi'] = (CASES['DS'][0], dict(CASES['DS'][1], **{'bar.number': [5], 'bar.interSpace': [10]}))
+CASES['N_32x32'] = (CASES['N_16x16'][0], dict(CASES['N_16x16'][1], **{'texture.hor_size': [0, 32],
+                                                                      'texture.vert_size': [0, 32]}))
+for n_dots in DOT_COUNTS:
+    CASES['DG_%d' % n_dots] = ('SINUSOIDAL_TEXTURE', {'stimtype': ['DG'], 'bg': [0.5], 'fg': [111],
+                                                     'lum': [0.5], 'michealson.contrast': [1],
+                                                     'sWavelength': [30], 'velocity': [30],
+                                                     'nDots': [n_dots], 'dotSize': [5], 'dotSpeed': [0],
+                                                     'duration': [4], 'tau': [1]})
+
+
+def write_stimfile(filename, case, seconds, perspective_correction):
+
+    """ Writes the stimulus file of a case. MAXRUNTIME ends the session after
+    `seconds` of stimulus (the session clock starts at the trigger). """
+
+    from modules import config
+    stimulusdata, attributes = CASES[case]
+    with open(filename, 'w') as f:
+        f.write('EPOCHS\t%d\n' % len(attributes['stimtype']))
+        f.write('MAXRUNTIME\t%d\n' % (seconds + config.TRIGGER_PAUSE))
+        f.write('STIMULUSDATA\t%s\n' % stimulusdata)
+        f.write('PERSPECTIVE_CORRECTION\t%d\n' % perspective_correction)
+        f.write('RANDOMIZATION_MODE\t0\n')
+        for key, values in attributes.items():
+            f.write('Stimulus.%s\t%s\n' % (key, '\t'.join(map(str, values))))
+
+
+class FrameTimer(object):
+    """ Time stamps (wall and CPU time of this thread) of every flip """
+
+    def __init__(self):
+        self.wall = []
+        self.cpu = []
+
+    def tick(self):
+        self.wall.append(time.perf_counter_ns())
+        self.cpu.append(time.thread_time_ns())
+
+
+def _simulated_window(timer):
+    from modules.simulation import SimulatedWindow
+
+    class TimedWindow(SimulatedWindow):
+        def flip(self, clearBuffer=True):
+            SimulatedWindow.flip(self, clearBuffer)
+            timer.tick()
+    return TimedWindow
+
+
+def _gl_window(timer):
+    def create(clock):
+        from psychopy import visual, monitors
+        from modules import config
+        mon = monitors.Monitor('benchmark', width=config.SCREEN_WIDTH, distance=config.DISTANCE)
+        win = visual.Window(size=[500, 500], monitor=mon, color=[-1, -1, -1], useFBO=True,
+                            allowGUI=False, waitBlanking=False, checkTiming=False)
+        gl_flip = win.flip
+
+        def flip(clearBuffer=True):
+            gl_flip(clearBuffer)
+            clock.advance(1.0 / config.FRAMERATE)
+            timer.tick()
+        win.flip = flip
+        return win
+    return create
+
+
+def peak_rss_mb():
+    """ Peak resident memory of this process in MB (None if unknown) """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / 1024.0 ** (2 if sys.platform == 'darwin' else 1), 1) # bytes on macOS
+    except ImportError: # Windows
+        try:
+            import psutil
+            return round(psutil.Process().memory_info().peak_wset / 1024.0 ** 2, 1)
+        except (ImportError, AttributeError):
+            return None
+
+
+def _statistics(ns):
+    us = np.asarray(ns, dtype=float) / 1000.0
+    if not len(us):
+        return {}
+    statistics = {'p%g' % q: round(float(np.percentile(us, q)), 1) for q in PERCENTILES}
+    statistics['mean'] = round(float(us.mean()), 1)
+    statistics['max'] = round(float(us.max()), 1)
+    return statistics
+
+
+def run_case(case, seconds, window, perspective_correction, realtime=False):
+
+    """ Runs one case as a dry run session and returns its results (in a child process) """
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return _run_case(case, seconds, window, perspective_correction, realtime)
+
+
+def _metadata_value(metafile, key):
+    with open(metafile) as f:
+        for line in f:
+            if line.startswith(key + ','):
+                return line.rstrip('\n').split(',', 1)[1]
+    return None
+
+
+def _run_case(case, seconds, window, perspective_correction, realtime):
+    from modules.simulation import dry_run # prints on import
+    timer = FrameTimer()
+    if window == 'gl':
+        from psychopy import visual
+        create_window = _gl_window(timer)
+    else:
+        visual = None
+        create_window = _simulated_window(timer)
+
+    with tempfile.TemporaryDirectory() as directory:
+        stimfile = os.path.join(directory, case + '.txt')
+        write_stimfile(stimfile, case, seconds, perspective_correction)
+        start = time.perf_counter_ns()
+        metafile = dry_run(stimfile, directory, True, window=create_window, visual=visual,
+                           realtime=realtime)[1]
+        gc_in_epochs = int(_metadata_value(metafile, 'gc_collections_in_epochs'))
+
+    wall = np.diff(timer.wall)
+    cpu = np.diff(timer.cpu)
+    return {'frames': len(timer.wall),
+            'setup_s': round((timer.wall[0] - start) / 1e9, 3) if timer.wall else None,
+            'cpu_us': _statistics(cpu),
+            'wall_us': _statistics(wall),
+            'peak_rss_mb': peak_rss_mb(),
+            'gc_in_epochs': gc_in_epochs}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(cases, seconds, window, perspective_correction, realtime=False):
+    results = {'commit': git_commit(),
+               'date': datetime.datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'platform': platform.platform(),
+               'window': window, 'seconds': seconds,
+               'perspective_correction': perspective_correction, 'realtime': realtime,
+               'cases': {}}
+    spawn = multiprocessing.get_context('spawn') # a fresh process per case, for its peak RSS
+    for case in cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as executor:
+            try:
+                result = executor.submit(run_case, case, seconds, window, perspective_correction,
+                                         realtime).result()
+            except Exception as e:
+                result = {'error': repr(e)}
+        results['cases'][case] = result
+        if 'error' in result:
+            print('%-10s FAILED: %s' % (case, result['error']))
+        else:
+            print('%-10s %6d frames  setup %6.2f s  cpu p50 %8.1f us  p99 %8.1f us  max %9.1f us  rss %s MB  gc %d' % (
+                case, result['frames'], result['setup_s'], result['cpu_us']['p50'],
+                result['cpu_us']['p99'], result['cpu_us']['max'], result['peak_rss_mb'],
+                result['gc_in_epochs']))
+    return results
+
+
+def compare(old, new, threshold, min_difference_us):
+
+    """ Prints old and new results side by side and flags regressions.
+
+    A metric regresses if it grew by more than `threshold` (relative) and,
+    for frame times, by more than `min_difference_us` (timer noise).
+
+    :returns: number of regressions
+
+    """
+    metrics = [('setup_s', None), ('cpu_us', 'p50'), ('cpu_us', 'p99'), ('wall_us', 'p99'),
+               ('wall_us', 'p99.9'),
+               ('peak_rss_mb', None)]
+    print('old: %s (%s)   new: %s (%s)' % (old.get('commit'), old.get('date'),
+                                           new.get('commit'), new.get('date')))
+    regressions = 0
+    for case in new['cases']:
+        if case not in old['cases']:
+            continue
+        for metric, statistic in metrics:
+            old_value, new_value = old['cases'][case].get(metric), new['cases'][case].get(metric)
+            if statistic is not None and old_value is not None and new_value is not None:
+                old_value, new_value = old_value.get(statistic), new_value.get(statistic)
+            if old_value is None or new_value is None:
+                continue
+            name = metric if statistic is None else '%s %s' % (metric, statistic)
+            change = (new_value - old_value) / old_value if old_value else 0.0
+            flag = ''
+            if change > threshold and (statistic is None or new_value - old_value > min_difference_us):
+                flag = 'REGRESSION'
+                regressions += 1
+            print('%-10s %-12s %10s -> %10s  %+6.1f%%  %s' % (case, name, old_value, new_value,
+                                                              change * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of every stimulus type')
+    parser.add_argument('--cases', nargs='+', default=list(CASES), choices=list(CASES))
+    parser.add_argument('--seconds', type=int, default=10, help='stimulus seconds per case')
+    parser.add_argument('--window', choices=['simulated', 'gl'], default='simulated')
+    parser.add_argument('--perspective-correction', type=int, choices=[0, 1, 2], default=0)
+    parser.add_argument('--realtime', action='store_true',
+                        help='real-time mode: no garbage collection during epochs, priority, pinning')
+    parser.add_argument('--out', help='JSON file for the results')
+    parser.add_argument('--baseline', help='JSON results to compare the new results with')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='only compares two saved JSON results')
+    parser.add_argument('--threshold', type=float, default=0.10, help='relative change flagged')
+    parser.add_argument('--min-difference-us', type=float, default=5.0)
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f_old, open(args.compare[1]) as f_new:
+            old, new = json.load(f_old), json.load(f_new)
+    else:
+        new = run(args.cases, args.seconds, args.window, args.perspective_correction, args.realtime)
+        if args.out:
+            os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+            with open(args.out, 'w') as f:
+                json.dump(new, f, indent=2)
+        if not args.baseline:
+            return
+        with open(args.baseline) as f:
+            old = json.load(f)
+
+    if compare(old, new, args.threshold, args.min_difference_us):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Catalog of the recorded sessions, see modules/catalog.py.
+
+scan indexes the sessions (metadata files and frame logs) of a directory;
+only the files modified since the last scan are read again. query lists
+the sessions matching experiment info, stimtypes, epoch attributes and
+timing quality ('*' as wildcard).
+
+Example:
+    python bin/catalog.py scan OutputFiles
+    python bin/catalog.py query --genotype "LC11*" --stimtype noisygrating --param SNR=0.5
+    python bin/catalog.py query --condition ExpLine --max-dropped 0 --epochs
+
+The catalog is OUT_DIR/config.CATALOG_FILE for scan, unless --catalog is given.
+
+"""
+
+import os
+import sys
+import argparse
+
+os.environ.setdefault('PYVISUALSTIM_HEADLESS', '1') # no dialog
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules import config
+from modules import catalog
+
+
+def _param(text):
+    key, sep, value = text.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError('expected KEY=VALUE, got %r' % text)
+    return key, float(value)
+
+
+def _value(value, digits=3):
+    if value is None:
+        return '-'
+    return '%.*f' % (digits, value) if isinstance(value, float) else str(value)
+
+
+def print_session(conn, row, epochs=False):
+    print(row['metafile'])
+    print(f"    {row['started']}  {row['Genotype']} | {row['Condition']} | {row['Stimulus']} | "
+          f"{row['TSeries_ID']}")
+    print(f"    {os.path.basename(row['stimfile'] or '-')}: {_value(row['epochs'])} epochs, "
+          f"{_value(row['frames'])} frames, {_value(row['duration_s'], 2)} s, "
+          f"{_value(row['framerate'])} Hz, dropped {_value(row['dropped_frames'])}, "
+          f"max interval {_value(row['max_interval_ms'])} ms")
+    if epochs:
+        for epoch, params in catalog.session_epochs(conn, row['id']):
+            attributes = ' '.join('%s=%g' % item for item in sorted(params.items()))
+            print(f"    epoch {epoch['epoch']:3d} {epoch['stimtype'] or '-':>12s}: "
+                  f"{epoch['presentations']:4d} presentations, dropped {_value(epoch['dropped'])}  "
+                  f"{attributes}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Catalog of the recorded sessions')
+    parser.add_argument('--catalog', default=None, help='SQLite file of the catalog')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    scan = commands.add_parser('scan', help='index the sessions of a directory')
+    scan.add_argument('directory', nargs='?', default=None, help='default: OUT_DIR')
+    scan.add_argument('--keep', action='store_true', help='keep the sessions whose files are gone')
+
+    query = commands.add_parser('query', help='list the matching sessions')
+    for key in catalog.EXP_KEYS:
+        query.add_argument('--' + key.lower().replace('_', '-'), dest=key, default=None)
+    query.add_argument('--stimtype', default=None)
+    query.add_argument('--param', type=_param, action='append', default=[],
+                       help='KEY=VALUE attribute of one epoch (of --stimtype), repeatable')
+    query.add_argument('--max-dropped', type=int, default=None)
+    query.add_argument('--since', default=None, help='YYYYMMDD[_HHMM]')
+    query.add_argument('--until', default=None, help='YYYYMMDD[_HHMM]')
+    query.add_argument('--epochs', action='store_true', help='print the epochs of every session')
+    args = parser.parse_args()
+
+    directory = args.directory if args.command == 'scan' and args.directory else config.OUT_DIR
+    filename = args.catalog or os.path.join(directory, config.CATALOG_FILE)
+    conn = catalog.connect(filename)
+
+    if args.command == 'scan':
+        result = catalog.scan(conn, directory, prune=not args.keep)
+        for metafile, error in result.get('failed', []):
+            print(f'FAILED {metafile}: {error}')
+        print(f"{filename}: {len(result.get('indexed', []))} indexed, "
+              f"{len(result.get('unchanged', []))} unchanged, "
+              f"{len(result.get('removed', []))} removed, {len(result.get('failed', []))} failed")
+        return
+
+    info = {key: getattr(args, key) for key in catalog.EXP_KEYS}
+    rows = catalog.query(conn, stimtype=args.stimtype, params=dict(args.param),
+                         max_dropped=args.max_dropped, since=args.since, until=args.until, **info)
+    for row in rows:
+        print_session(conn, row, args.epochs)
+    print('##############################################')
+    print(f'{len(rows)} sessions')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Runs stimulus files as whole sessions on a virtual clock (see modules/simulation.py).
+
+No window, no projector and no NI-DAQ are needed. The output and metadata
+files are the ones a real session writes, so they can be checked (or
+analysed) before going to the rig.
+
+Example:
+    python bin/dry_run.py my_stim.txt --out-dir dry_run
+    python bin/dry_run.py my_stim.txt --no-dlp
+
+"""
+
+import os
+import sys
+import time
+import argparse
+import contextlib
+
+os.environ.setdefault('PYVISUALSTIM_HEADLESS', '1') # no dialog
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.simulation import dry_run
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs stimulus files on a virtual clock')
+    parser.add_argument('stimfiles', nargs='+')
+    parser.add_argument('--out-dir', default='dry_run')
+    parser.add_argument('--no-dlp', action='store_true', help='test mode (no microscope)')
+    parser.add_argument('--scan-rate', type=float, default=None,
+                        help='microscope frame rate in Hz (default: config.SIMULATED_SCAN_RATE)')
+    parser.add_argument('--verbose', action='store_true', help='show the prints of the session')
+    args = parser.parse_args()
+
+    for stimfile in args.stimfiles:
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull:
+            quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull)
+            with quiet:
+                outfile, metafile = dry_run(stimfile, args.out_dir, not args.no_dlp, args.scan_rate)
+        elapsed = time.perf_counter() - start
+        with open(outfile) as f:
+            n_frames = sum(1 for line in f) - 3 # header lines
+        print(f'{stimfile}: {n_frames} frames in {elapsed:.2f} s -> {outfile}, {metafile}')
+
+
+if __name__ == '__main__':
+    main()
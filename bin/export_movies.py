@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Exports stimulus files as full-length movies, without a window.
+
+Stimulus files (or every .txt file in the given directories) are rendered in
+parallel, one process per file. Every process holds a chunk of frames and
+the textures of its stimulus (up to a few hundred MB for noise stimuli), so
+the number of processes is kept low by default. The directory structure below each given
+directory is kept in the output directory.
+
+Example:
+    python bin/export_movies.py stimuli_collection --out-dir movies --processes 4
+    python bin/export_movies.py my_stim.txt --format npy --warp spherical
+
+"""
+
+import os
+import sys
+import argparse
+import multiprocessing
+
+os.environ.setdefault('PYVISUALSTIM_HEADLESS', '1') # no dialog, no psychopy needed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.movie_export import export_movie
+from modules.rendering import CHUNK_FRAMES
+
+PROCESSES = 2 # the rig PCs have little memory to spare
+
+
+def stimulus_files(paths):
+    """ Returns (stimulus file, relative output name) for files and directories """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                for name in sorted(names):
+                    if name.endswith('.txt') and name != 'README.txt':
+                        stimfile = os.path.join(root, name)
+                        files.append((stimfile, os.path.relpath(stimfile, path)))
+        else:
+            files.append((path, os.path.basename(path)))
+    return files
+
+
+def _export(job):
+    stimfile, output, options = job
+    try:
+        n_frames = export_movie(stimfile, output, **options)
+        return stimfile, output, n_frames, None
+    except Exception as e:
+        return stimfile, output, 0, repr(e)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exports stimulus files as movies')
+    parser.add_argument('paths', nargs='+', help='stimulus files or directories')
+    parser.add_argument('--out-dir', default='movies')
+    parser.add_argument('--format', default='mp4',
+                        help="video extension (mp4, avi, gif) or 'npy' for chunked arrays")
+    parser.add_argument('--size', type=int, nargs=2, default=[500, 500], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--view-scale', type=float, nargs=2, default=[1, 1])
+    parser.add_argument('--warp', choices=['spherical', 'cylindrical'], default=None)
+    parser.add_argument('--eyepoint', type=float, nargs=2, default=[0.5, 0.5])
+    parser.add_argument('--win-masks', type=int, default=0)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_FRAMES)
+    parser.add_argument('--maxruntime', type=float, default=None,
+                        help='seconds per movie (default: the session length of main)')
+    parser.add_argument('--processes', type=int, default=PROCESSES,
+                        help='parallel exports (default: %(default)s)')
+    args = parser.parse_args()
+
+    options = {'size': tuple(args.size), 'view_scale': tuple(args.view_scale),
+               'warp': args.warp, 'eyepoint': tuple(args.eyepoint),
+               'win_masks': args.win_masks, 'chunk_size': args.chunk_size,
+               'maxruntime': args.maxruntime}
+    jobs = []
+    for stimfile, name in stimulus_files(args.paths):
+        name = os.path.splitext(name)[0]
+        if args.format != 'npy':
+            name = name + '.' + args.format
+        jobs.append((stimfile, os.path.join(args.out_dir, name), options))
+
+    with multiprocessing.Pool(args.processes) as pool:
+        for stimfile, output, n_frames, error in pool.imap_unordered(_export, jobs):
+            if error:
+                print(f'FAILED {stimfile}: {error}')
+            else:
+                print(f'{output}: {n_frames} frames')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Contrast report of the grating epochs of a stimulus file, offline.
+
+Prints the diagnostics of every grating epoch (see modules/diagnostics.py)
+and saves one figure per epoch with the last frame of its texture. The
+values are those written to the metadata file of a session if it is given
+(--metadata); otherwise they are computed from newly generated textures.
+Their noise is drawn again from the noise streams (see modules/rng.py),
+so it is the one of the session if SEED and RNG_MODE are the same
+(sessions recorded before the noise was seeded had their own realisation).
+
+Example:
+    python bin/grating_report.py my_stim.txt --out-dir report
+    python bin/grating_report.py my_stim.txt --metadata my_meta_data.txt
+
+"""
+
+import os
+import sys
+import argparse
+import contextlib
+
+os.environ.setdefault('PYVISUALSTIM_HEADLESS', '1') # no dialog
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from modules.helper import Stimulus, rename_stimtypes
+from modules.textures import generate_textures
+from modules.timing import epoch_frames
+from modules.diagnostics import (grating_diagnostics, grating_frame, read_diagnostics,
+                                 MAX_TEX_VALUE, MIN_TEX_VALUE)
+
+
+def epoch_figure(texture, title, contrast):
+    """ The 2x2 figure formerly drawn after every noisy grating epoch """
+    from matplotlib import pyplot as plt
+
+    fig, ax = plt.subplots(2, 2)
+    ax[0, 0].plot(texture.T)
+    ax[0, 0].axhline(y=MAX_TEX_VALUE, color='k', linestyle=':', label="max")
+    ax[0, 0].axhline(y=MIN_TEX_VALUE, color='k', linestyle='--', label="min")
+    ax[0, 0].set_title(title)
+    ax[0, 1].plot(texture[0])
+    ax[0, 1].set_title(title)
+    ax[1, 0].plot(texture[0:3, :].T)
+    ax[1, 1].imshow(texture, cmap=plt.get_cmap('gray'))
+    ax[1, 1].set_title('Contrast: %f' % (contrast * 100))
+    return fig
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Contrast report of the grating epochs')
+    parser.add_argument('stimfile')
+    parser.add_argument('--metadata', default=None, help='metadata file of a session')
+    parser.add_argument('--out-dir', default='grating_report')
+    parser.add_argument('--format', default='png', help='figure format (png, pdf, svg)')
+    parser.add_argument('--no-figures', action='store_true')
+    parser.add_argument('--verbose', action='store_true', help='show the prints of the texture generation')
+    args = parser.parse_args()
+
+    stimdict = Stimulus(args.stimfile).dict
+    rename_stimtypes(stimdict)
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+            textures = generate_textures(stimdict)
+
+    if args.metadata:
+        diagnostics = read_diagnostics(args.metadata)
+    else:
+        diagnostics = grating_diagnostics(stimdict, textures)
+    if not diagnostics:
+        print('No grating epoch with a texture')
+        return
+
+    names = sorted({name for values in diagnostics.values() for name in values})
+    print('epoch  ' + '  '.join('%14s' % name for name in names))
+    for epoch, values in sorted(diagnostics.items()):
+        print('%5d  ' % epoch + '  '.join('%14s' % values.get(name, '') for name in names))
+
+    if args.no_figures:
+        return
+    os.makedirs(args.out_dir, exist_ok=True)
+    base = os.path.splitext(os.path.basename(args.stimfile))[0]
+    stim_texture_ls, noise_array_ls, stim_texture, _useTex, _useNoise = textures
+    for epoch, values in sorted(diagnostics.items()):
+        noise_arr = noise_array_ls[epoch] if _useNoise else None
+        n_frames = epoch_frames(stimdict, epoch)[1]
+        if noise_arr is not None:
+            n_frames = min(n_frames, len(noise_arr))
+        texture = grating_frame(stim_texture_ls[epoch], noise_arr, n_frames - 1)
+        title = '{}%MC_{}_SNR'.format(stimdict['michealson.contrast'][epoch]*100,
+                                      stimdict['SNR'][epoch]) if 'SNR' in stimdict else 'epoch %d' % epoch
+        fig = epoch_figure(np.asarray(texture), title, values['contrast'])
+        filename = os.path.join(args.out_dir, '%s_epoch%d.%s' % (base, epoch, args.format))
+        fig.savefig(filename)
+        print(filename)
+
+
+if __name__ == '__main__':
+    main()
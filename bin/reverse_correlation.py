@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Receptive fields of a ternary noise session, see modules/revcorr.py.
+
+The noise is drawn again from the seed and the stimulus file (by default
+the one named in the frame log), aligned to the imaging frames with the
+frame log and averaged, weighted by the response of every ROI, over
+several lags. The result (n_rois, n_lags, rows, cols) is written to a .npy
+file as it is computed.
+
+Example:
+    python bin/reverse_correlation.py traces.npy my_stimulus_output.txt --out sta.npy
+    python bin/reverse_correlation.py traces.npy my_stimulus_output.txt --lags 20 --processes 4
+
+The traces are a .npy file of (n_rois, n_imaging_frames) values, read
+memory-mapped.
+
+"""
+
+import os
+import sys
+import argparse
+
+os.environ.setdefault('PYVISUALSTIM_HEADLESS', '1') # no dialog
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from modules import config
+from modules import framelog
+from modules.helper import Stimulus, rename_stimtypes
+from modules.revcorr import reverse_correlation, contrast_stack
+from modules.trials import load_traces, IMAGING_FRAME_OFFSET
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Receptive fields of a ternary noise session')
+    parser.add_argument('traces', help='.npy file of (n_rois, n_imaging_frames) traces')
+    parser.add_argument('frame_log', help='stimulus output file of the session (.txt or .npy)')
+    parser.add_argument('--stimfile', default=None, help='default: the one of the frame log')
+    parser.add_argument('--lags', type=int, default=10, help='imaging frames 0 .. LAGS-1')
+    parser.add_argument('--seed', type=int, default=config.SEED)
+    parser.add_argument('--offset', type=int, default=IMAGING_FRAME_OFFSET,
+                        help='imaging frame = frame counter + OFFSET')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--out', default='sta.npy')
+    args = parser.parse_args()
+
+    log = framelog.read_frame_log(args.frame_log)
+    stimfile = args.stimfile or log.stimfile
+    stimdict = Stimulus(stimfile).dict
+    rename_stimtypes(stimdict)
+
+    n_rois = load_traces(args.traces).shape[0]
+    shape = contrast_stack(stimdict, args.seed)[1]
+    out = np.lib.format.open_memmap(args.out, mode='w+', dtype=np.float32,
+                                    shape=(n_rois, args.lags) + tuple(shape))
+    result = reverse_correlation(args.traces, log, stimdict, range(args.lags), args.seed,
+                                 args.offset, processes=args.processes, out=out)
+    out.flush()
+
+    rate = result['imaging_rate']
+    print(f'{stimfile}: {n_rois} ROIs, {shape[0]}x{shape[1]} pixels, imaging at '
+          f'{rate or 0:.2f} Hz, {result["samples"][0] if result["samples"] is not None else 0} '
+          f'imaging frames with noise')
+    print(f'Lags 0 .. {args.lags - 1} imaging frames'
+          + (f' (0 .. {(args.lags - 1) / rate:.2f} s)' if rate else ''))
+    print(f'Response-triggered averages: {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,9 @@
-from .main import main
-from modules.helper import *
 
 
+def main(path_stimfile):
+    # Imported on call, so that the package can be used without psychopy
+    # (offscreen rendering, analysis)
+    from modules.main import main as _main
+    return _main(path_stimfile)
+
+from modules.helper import *
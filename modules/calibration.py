@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Rig calibration cache: refresh rate, frame-interval jitter and warper
+setup per display configuration.
+
+Measuring the refresh rate (psychopy's ``win.getActualFrameRate``) blocks
+every session start. Here the first session of a display configuration
+(monitor, window size, viewScale and projector mode, see `rig_key`) measures
+config.CALIBRATION_FRAMES flips, and later sessions only re-check
+config.CALIBRATION_CHECK_FRAMES flips against the stored rate. A full
+measurement is repeated if the re-check disagrees by more than
+config.CALIBRATION_TOLERANCE or if the entry is older than
+config.CALIBRATION_MAX_AGE_DAYS.
+
+Entries are stored as JSON in config.CACHE_DIR (rig_calibration.json).
+
+"""
+
+import os
+import json
+import time
+import datetime
+import numpy
+
+from modules import config
+
+CALIBRATION_FILE = 'rig_calibration.json'
+
+
+def rig_key(monitor, size, view_scale, mode):
+
+    """ Name of a display configuration
+
+    :param monitor: monitor name (mon.name)
+    :type monitor: str
+    :param size: window size in pixels
+    :param view_scale: viewScale of the window
+    :param mode: projector mode (exp_Info['Projector_mode'])
+    :type mode: str
+    :returns: str
+
+    """
+    return '%s_%dx%d_scale%gx%g_%s' % (monitor, size[0], size[1], view_scale[0],
+                                       view_scale[1], mode)
+
+
+def measure_frame_intervals(win, n_frames, warmup=10):
+
+    """ Flips the (empty) window and returns the intervals between flips
+
+    :param n_frames: number of measured intervals
+    :type n_frames: int
+    :param warmup: flips before the measurement
+    :type warmup: int
+    :returns: numpy array of intervals in seconds
+
+    """
+    for i in range(warmup):
+        win.flip()
+    stamps = numpy.empty(n_frames + 1)
+    for i in range(n_frames + 1):
+        win.flip()
+        stamps[i] = time.perf_counter()
+    return numpy.diff(stamps)
+
+
+def load_calibration(cache_dir=None):
+    """ All stored entries, {rig key: entry} """
+    filename = os.path.join(config.CACHE_DIR if cache_dir is None else cache_dir, CALIBRATION_FILE)
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_calibration(entries, cache_dir=None):
+    """ Stores all entries (written under a temporary name first) """
+    cache_dir = config.CACHE_DIR if cache_dir is None else cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    filename = os.path.join(cache_dir, CALIBRATION_FILE)
+    temp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(temp_filename, 'w') as f:
+        json.dump(entries, f, indent=2, sort_keys=True)
+    os.replace(temp_filename, filename)
+
+
+def _expired(entry):
+    measured = datetime.datetime.fromisoformat(entry['measured'])
+    return datetime.datetime.now() - measured > datetime.timedelta(days=config.CALIBRATION_MAX_AGE_DAYS)
+
+
+def calibrated_refresh_rate(win, key, cache_dir=None):
+
+    """ Refresh rate and frame-interval jitter of the window, from the cache
+    after a short re-check, or measured (and stored) again.
+
+    :param win: the window of the session, with the warper already set up
+    :param key: see `rig_key`
+    :type key: str
+    :returns: entry dict with framerate (Hz), interval_sd_ms, measured (date),
+        and source ('cache' or 'measured')
+
+    """
+    entries = load_calibration(cache_dir)
+    entry = entries.get(key)
+    if entry is not None and 'framerate' in entry and not _expired(entry):
+        intervals = measure_frame_intervals(win, config.CALIBRATION_CHECK_FRAMES)
+        framerate = 1.0 / numpy.median(intervals)
+        if abs(framerate - entry['framerate']) <= config.CALIBRATION_TOLERANCE * entry['framerate']:
+            entry['source'] = 'cache'
+            return entry
+        print('>>> WARNING <<< Refresh rate changed (%.3f Hz, stored %.3f Hz), measuring again'
+              % (framerate, entry['framerate']))
+
+    intervals = measure_frame_intervals(win, config.CALIBRATION_FRAMES)
+    entry = dict(entry or {}) # the warper setup is kept
+    entry.update(framerate=float(1.0 / numpy.median(intervals)),
+                 interval_sd_ms=float(numpy.std(intervals) * 1000),
+                 interval_max_ms=float(numpy.max(intervals) * 1000),
+                 measured=datetime.datetime.now().isoformat(timespec='seconds'))
+    entries[key] = entry
+    save_calibration(entries, cache_dir)
+    entry['source'] = 'measured'
+    return entry
+
+
+def store_warper_setup(key, setup, cache_dir=None):
+
+    """ Stores the warper setup of a display configuration with its calibration.
+    A different setup (flips cost more with a warper) is measured again.
+
+    :param setup: e.g. {'warp': ..., 'eyepoint': ..., 'warpfile': ...}
+    :type setup: dict
+
+    """
+    entries = load_calibration(cache_dir)
+    if entries.get(key, {}).get('warper') != setup:
+        entries[key] = {'warper': setup}
+        save_calibration(entries, cache_dir)
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Local catalog of the recorded sessions (SQLite, see config.CATALOG_FILE).
+
+One session = one metadata file and its frame log (stimulus output file).
+The catalog stores, per session:
+
+- **sessions**: experiment info of the metadata file (genotype, condition,
+  stimulus, ...), stimulus file, start (date and time of the file names)
+  and the timing quality of the frame log (see framelog.analyse)
+- **metadata**: every KEY,VALUE row of the metadata file
+- **epochs**: stimtype, presentations, dropped frames per epoch
+- **epoch_params**: numeric attributes per epoch of the stimulus file (SNR,
+  lum, michealson.contrast, ...), if the stimulus file can be found
+
+main adds every session when it ends (`add_session`); `scan` indexes the
+sessions of a directory and re-reads only the files modified since the last
+scan (mtime and size), so it is cheap to run again. Queries use the SQL
+indexes, e.g. all LC11 sessions with a noisy grating epoch at SNR 0.5:
+
+    with connect('catalog.sqlite') as conn:
+        sessions = query(conn, genotype='LC11*', stimtype='noisygrating', params={'SNR': 0.5})
+
+"""
+
+import os
+import sqlite3
+from collections import defaultdict
+
+from modules import framelog
+
+META_MARK = '_meta_data'
+OUTPUT_MARK = '_stimulus_output'
+EXP_KEYS = ('Experiment', 'User', 'Subject_ID', 'TSeries_ID', 'Genotype', 'Condition',
+            'Stimulus', 'Age', 'Sex', 'Projector_mode')
+PARAM_TOLERANCE = 1e-6
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    metafile TEXT UNIQUE NOT NULL,
+    frame_log TEXT,
+    signature TEXT,
+    started TEXT,
+    Experiment TEXT, User TEXT, Subject_ID TEXT, TSeries_ID TEXT, Genotype TEXT,
+    Condition TEXT, Stimulus TEXT, Age TEXT, Sex TEXT, Projector_mode TEXT,
+    stimfile TEXT,
+    epochs INTEGER,
+    frames INTEGER,
+    duration_s REAL,
+    framerate REAL,
+    dropped_frames INTEGER,
+    drop_events INTEGER,
+    interval_sd_ms REAL,
+    max_interval_ms REAL
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    session_id INTEGER REFERENCES sessions(id) ON DELETE CASCADE,
+    key TEXT, value TEXT
+);
+CREATE TABLE IF NOT EXISTS epochs (
+    session_id INTEGER REFERENCES sessions(id) ON DELETE CASCADE,
+    epoch INTEGER, stimtype TEXT, presentations INTEGER, dropped INTEGER,
+    max_interval_ms REAL,
+    PRIMARY KEY (session_id, epoch)
+);
+CREATE TABLE IF NOT EXISTS epoch_params (
+    session_id INTEGER REFERENCES sessions(id) ON DELETE CASCADE,
+    epoch INTEGER, key TEXT, value REAL
+);
+CREATE INDEX IF NOT EXISTS sessions_genotype ON sessions(Genotype);
+CREATE INDEX IF NOT EXISTS sessions_condition ON sessions(Condition);
+CREATE INDEX IF NOT EXISTS sessions_stimulus ON sessions(Stimulus);
+CREATE INDEX IF NOT EXISTS sessions_started ON sessions(started);
+CREATE INDEX IF NOT EXISTS metadata_session ON metadata(session_id, key);
+CREATE INDEX IF NOT EXISTS epochs_stimtype ON epochs(stimtype, session_id);
+CREATE INDEX IF NOT EXISTS epoch_params_key ON epoch_params(key, value, session_id);
+"""
+
+
+def connect(filename):
+
+    """ Opens (and creates) a catalog
+
+    :param filename: path of the SQLite file
+    :returns: sqlite3 connection (rows as sqlite3.Row)
+
+    """
+    conn = sqlite3.connect(filename)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def is_metafile(filename):
+    """ True for the metadata files of main """
+    name = os.path.basename(filename)
+    return META_MARK in name and name.endswith('.txt')
+
+
+def read_metadata(metafile):
+    """ KEY,VALUE rows of a metadata file, in order (the header row excluded) """
+    rows = []
+    with open(metafile) as f:
+        next(f, None)
+        for line in f:
+            key, sep, value = line.rstrip('\n').partition(',')
+            if sep:
+                rows.append((key, value))
+    return rows
+
+
+def find_frame_log(metafile, metadata=None):
+
+    """ Frame log of a session
+
+    The metadata file names it (frame_log). Older sessions are paired by the
+    common part of the names ({DATE}_{TIME}_{SUBJECT_ID}) and, among several
+    candidates, the closest modification time. The binary copy is preferred.
+
+    :param metafile: path of the metadata file
+    :param metadata: rows of `read_metadata`
+    :returns: path, or None
+
+    """
+    folder = os.path.dirname(metafile)
+    name = dict(metadata or []).get('frame_log')
+    if name is None:
+        prefix = os.path.basename(metafile).split(META_MARK)[0] + OUTPUT_MARK
+        candidates = [os.path.join(folder, n) for n in os.listdir(folder or '.')
+                      if n.startswith(prefix) and n.endswith('.txt')]
+        if not candidates:
+            return None
+        mtime = os.path.getmtime(metafile)
+        name = min(candidates, key=lambda n: abs(os.path.getmtime(n) - mtime))
+    filename = os.path.join(folder, os.path.basename(name))
+    binary = framelog.binary_filename(filename)
+    if os.path.exists(binary):
+        return binary
+    return filename if os.path.exists(filename) else None
+
+
+def find_stimfile(stimfile, metafile):
+    """ Stimulus file as logged, or next to the metadata file """
+    if not stimfile:
+        return None
+    for candidate in (stimfile, os.path.join(os.path.dirname(metafile),
+                                             os.path.basename(stimfile.replace('\\', '/')))):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def read_stimulus(stimfile):
+
+    """ Stimtypes and numeric attributes per epoch of a stimulus file
+
+    :returns: (list of stimtypes, {key: list of values})
+
+    """
+    from modules.helper import Stimulus, rename_stimtypes
+    stimdict = Stimulus(stimfile).dict
+    rename_stimtypes(stimdict)
+    stimtypes = stimdict['stimtype']
+    params = {key: values for key, values in stimdict.items()
+              if key != 'stimtype' and isinstance(values, list) and len(values) == len(stimtypes)}
+    return stimtypes, params
+
+
+def signature(*filenames):
+    """ mtime and size of the files of a session (changes if one is rewritten) """
+    parts = []
+    for filename in filenames:
+        if filename and os.path.exists(filename):
+            stat = os.stat(filename)
+            parts.append('%d:%d' % (stat.st_mtime_ns, stat.st_size))
+        else:
+            parts.append('-')
+    return ' '.join(parts)
+
+
+def _started(metafile):
+    """ {DATE}_{TIME} of the file name """
+    parts = os.path.basename(metafile).split('_')
+    return '_'.join(parts[:2]) if len(parts) > 2 else None
+
+
+def index_session(conn, metafile, frame_log=None):
+
+    """ Adds or replaces a session in the catalog
+
+    :param conn: see `connect`
+    :param metafile: path of the metadata file
+    :param frame_log: path of the frame log (default: `find_frame_log`)
+    :returns: id of the session
+
+    """
+    metafile = os.path.abspath(metafile)
+    metadata = read_metadata(metafile)
+    values = dict(metadata)
+    if frame_log is None:
+        frame_log = find_frame_log(metafile, metadata)
+    elif os.path.exists(framelog.binary_filename(frame_log)):
+        frame_log = framelog.binary_filename(frame_log)
+
+    summary = None
+    stimfile = values.get('stimfile')
+    if frame_log:
+        summary = framelog.analyse(framelog.read_frame_log(frame_log))
+        stimfile = stimfile or summary['stimfile']
+    stimtypes, params = [], {}
+    found = find_stimfile(stimfile, metafile)
+    if found:
+        stimtypes, params = read_stimulus(found)
+
+    interval = summary['frame_interval_ms'] if summary else {}
+    row = {'metafile': metafile, 'frame_log': frame_log,
+           'signature': signature(metafile, frame_log), 'started': _started(metafile),
+           'stimfile': stimfile, 'epochs': len(stimtypes) or None,
+           'frames': summary and summary['frames'],
+           'duration_s': summary and summary['duration_s'],
+           'framerate': summary and summary['framerate'],
+           'dropped_frames': summary and summary['dropped_frames'],
+           'drop_events': summary and summary['drop_events'],
+           'interval_sd_ms': interval.get('std'), 'max_interval_ms': interval.get('max')}
+    row.update((key, values.get(key)) for key in EXP_KEYS)
+
+    with conn:
+        conn.execute('DELETE FROM sessions WHERE metafile = ?', (metafile,))
+        cursor = conn.execute('INSERT INTO sessions (%s) VALUES (%s)'
+                              % (', '.join(row), ', '.join('?' * len(row))), list(row.values()))
+        session_id = cursor.lastrowid
+        conn.executemany('INSERT INTO metadata VALUES (?, ?, ?)',
+                         [(session_id, key, value) for key, value in metadata])
+
+        epochs = summary['epochs'] if summary else {}
+        for epoch in sorted(set(epochs) | set(range(len(stimtypes)))):
+            statistics = epochs.get(epoch, {})
+            conn.execute('INSERT INTO epochs VALUES (?, ?, ?, ?, ?, ?)',
+                         (session_id, epoch, stimtypes[epoch] if epoch < len(stimtypes) else None,
+                          statistics.get('presentations', 0), statistics.get('dropped'),
+                          statistics.get('max_interval_ms')))
+        conn.executemany('INSERT INTO epoch_params VALUES (?, ?, ?, ?)',
+                         [(session_id, epoch, key, value) for key, epoch_values in params.items()
+                          for epoch, value in enumerate(epoch_values)])
+    return session_id
+
+
+def scan(conn, directory, prune=True):
+
+    """ Indexes the sessions of a directory (recursively), incrementally
+
+    Sessions whose metadata file and frame log are unchanged since they were
+    indexed are skipped.
+
+    :param conn: see `connect`
+    :param prune: removes the sessions of the directory whose metadata file
+        no longer exists
+    :type prune: boolean
+    :returns: dict with the lists of the indexed, unchanged, removed and
+        failed ((metafile, error)) sessions
+
+    """
+    known = {row['metafile']: (row['signature'], row['frame_log'])
+             for row in conn.execute('SELECT metafile, signature, frame_log FROM sessions')}
+    result = defaultdict(list)
+    found = set()
+    for root, dirs, names in os.walk(directory):
+        for name in sorted(names):
+            if not is_metafile(name):
+                continue
+            metafile = os.path.abspath(os.path.join(root, name))
+            found.add(metafile)
+            if metafile in known:
+                previous, frame_log = known[metafile]
+                # A frame log may have appeared (or got a binary copy) since
+                if frame_log == find_frame_log(metafile, read_metadata(metafile)) \
+                        and previous == signature(metafile, frame_log):
+                    result['unchanged'].append(metafile)
+                    continue
+            try:
+                index_session(conn, metafile)
+                result['indexed'].append(metafile)
+            except Exception as e:
+                result['failed'].append((metafile, repr(e)))
+
+    if prune:
+        top = os.path.join(os.path.abspath(directory), '')
+        removed = [metafile for metafile in known
+                   if metafile.startswith(top) and metafile not in found]
+        with conn:
+            conn.executemany('DELETE FROM sessions WHERE metafile = ?', [(m,) for m in removed])
+        result['removed'] = removed
+    return dict(result)
+
+
+def _match(column, value):
+    """ SQL condition, '*' as wildcard """
+    if '*' in str(value):
+        return '%s LIKE ?' % column, str(value).replace('*', '%')
+    return '%s = ?' % column, value
+
+
+def query(conn, stimtype=None, params=None, max_dropped=None, since=None, until=None, **info):
+
+    """ Sessions matching all the given conditions
+
+    :param stimtype: a stimtype presented in the session (e.g. 'N', 'noisygrating')
+    :type stimtype: str
+    :param params: {attribute: value} of one epoch (of stimtype if given),
+        e.g. {'SNR': 0.5}
+    :type params: dict
+    :param max_dropped: at most that many dropped frames
+    :type max_dropped: int
+    :param since: first start, 'YYYYMMDD' or 'YYYYMMDD_HHMM'
+    :param until: last start, idem
+    :param info: experiment info (Genotype, Condition, Stimulus, ...,
+        case-insensitive), '*' as wildcard
+    :returns: list of sessions rows
+
+    """
+    conditions, args = [], []
+    names = {key.lower(): key for key in EXP_KEYS}
+    for key, value in info.items():
+        if key.lower() not in names:
+            raise ValueError('Unknown session info %r (%s)' % (key, ', '.join(EXP_KEYS)))
+        if value is not None:
+            condition, arg = _match('s.' + names[key.lower()], value)
+            conditions.append(condition)
+            args.append(arg)
+    if max_dropped is not None:
+        conditions.append('s.dropped_frames <= ?')
+        args.append(max_dropped)
+    if since is not None:
+        conditions.append('s.started >= ?')
+        args.append(since)
+    if until is not None:
+        conditions.append('s.started <= ?')
+        args.append(until + '~') # includes the times of an 'until' date
+
+    if stimtype is not None or params:
+        # One epoch must match the stimtype and every attribute
+        epoch = ['e.session_id = s.id']
+        if stimtype is not None:
+            condition, arg = _match('e.stimtype', stimtype)
+            epoch.append(condition)
+            args.append(arg)
+        for key, value in (params or {}).items():
+            epoch.append('EXISTS (SELECT 1 FROM epoch_params p WHERE p.session_id = s.id '
+                         'AND p.epoch = e.epoch AND p.key = ? AND abs(p.value - ?) <= ?)')
+            args.extend([key, float(value), PARAM_TOLERANCE])
+        conditions.append('EXISTS (SELECT 1 FROM epochs e WHERE %s)' % ' AND '.join(epoch))
+
+    sql = 'SELECT s.* FROM sessions s'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    return conn.execute(sql + ' ORDER BY s.started, s.metafile', args).fetchall()
+
+
+def session_epochs(conn, session_id):
+    """ Epoch rows of a session, with their attributes ({key: value}) """
+    params = defaultdict(dict)
+    for row in conn.execute('SELECT epoch, key, value FROM epoch_params WHERE session_id = ?',
+                            (session_id,)):
+        params[row['epoch']][row['key']] = row['value']
+    return [(row, params[row['epoch']]) for row in
+            conn.execute('SELECT * FROM epochs WHERE session_id = ? ORDER BY epoch', (session_id,))]
+
+
+def add_session(metafile, frame_log=None, filename=None):
+
+    """ Adds a finished session to the catalog of its directory (main).
+    Failures are printed, never raised: the recording itself is saved.
+
+    :param filename: catalog file (default: config.CATALOG_FILE next to the metadata file)
+
+    """
+    from modules import config
+    if filename is None:
+        if not config.CATALOG_FILE:
+            return None
+        filename = os.path.join(os.path.dirname(os.path.abspath(metafile)), config.CATALOG_FILE)
+    try:
+        conn = connect(filename)
+        try:
+            return index_session(conn, metafile, frame_log)
+        finally:
+            conn.close()
+    except Exception as e:
+        print('>>> WARNING <<< Session not added to the catalog %s: %r' % (filename, e))
+        return None
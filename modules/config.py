@@ -21,6 +21,31 @@
     Width of the projection are of the screen
 .. data:: VIEWPOS_FILE
     Txt file if the size (x and y) and the position of the screen
+.. data:: WIN_MASK
+    0 or 1. Masks parts of the window with the polygons in MASK_POLYGONS
+.. data:: MASK_POLYGONS
+    Polygons to black out, in normalized window coordinates ((0,0) is the
+    bottom-left and (1,1) the top-right corner of the window)
+.. data:: WARP_GRIDSIZE
+    Number of grid points per axis of the perspective-correction mesh
+.. data:: CACHE_DIR
+    Directory where precomputed data (e.g. mask textures, warpfiles) is stored
+.. data:: CATALOG_FILE
+    SQLite catalog of the sessions, in the directory of the output files
+    (see catalog). Empty: sessions are not added when they end
+.. data:: CALIBRATION_FRAMES
+    Flips measured for the refresh rate of a new display configuration (see calibration)
+.. data:: CALIBRATION_CHECK_FRAMES
+    Flips measured to re-check a cached refresh rate
+.. data:: CALIBRATION_TOLERANCE
+    Relative deviation from the cached refresh rate accepted by the re-check
+.. data:: CALIBRATION_MAX_AGE_DAYS
+    Days after which the refresh rate is measured again
+.. data:: USE_MEASURED_FRAMERATE
+    0 or 1. Epoch frame counts at the measured refresh rate (1) or at FRAMERATE (see timing)
+.. data:: HEADLESS
+    True if the environment variable PYVISUALSTIM_HEADLESS is set. No dialog
+    is opened and psychopy is not needed (offscreen rendering, analysis)
 
 
 .. data:: MAXRUNTIME
@@ -28,11 +53,35 @@
     If this is exceded, stimulus presentation stops.
 .. data:: SEED
     Seed number to be used in some pseudorandomization process in the main code
+.. data:: RNG_MODE
+    'legacy' or 'counter'. Random streams of the stimuli (see rng): 'legacy'
+    keeps the bar positions and ternary noise of the sessions recorded since
+    2020 and the seeded epoch order of the epoch schedule (the epoch order of
+    older sessions was not seeded), 'counter' draws them from seekable
+    streams as well.
+    A stimulus file can set it in its header (RNG_MODE)
+.. data:: TRIGGER_PAUSE
+    Seconds between the trigger to the microscope and the first stimulus frame
+.. data:: PROFILE_FRAMES
+    0 or 1. Times the stages of every frame and appends latency histograms per
+    stimtype to the metadata file (see profiling)
+.. data:: REALTIME_MODE
+    0 or 1. No garbage collection during epochs, higher process priority and
+    the render thread pinned to one core (see realtime). Off by default: it
+    changes the priority of the whole process, enable it per rig once tested
+.. data:: RENDER_CPU
+    Index into the available cores of the core for the render thread in
+    REALTIME_MODE (-1: the last one). Helper threads use the other cores
+.. data:: LOG_RATE_LIMIT
+    Console lines per second and kind of record of the session log (all
+    records are written to the log file, see stimlog)
 
 .. data:: COUNTER_CHANEL
     Where to read the counter of scanned frames from the microscope to the NI-DAQ
 .. data:: PULSE_CHANNEL
     Where to send the trigger from the NI-DAQ to the microscope for start scanning
+.. data:: SIMULATED_SCAN_RATE
+    Microscope frame rate (Hz) of the simulated NI-DAQ in a dry run (see simulation)
 
 
 """
@@ -40,14 +89,19 @@
 import os
 import pandas as pd
 from datetime import datetime
-from psychopy import gui
+
+HEADLESS = bool(os.environ.get('PYVISUALSTIM_HEADLESS'))
 
 # For the current recording
 #Hard coded path for every PC, must be put of any Github folder
 print('>>> Select the file containing your recording IDs information <<<')
 print('Stim OuputFiles will be saved in the same directory')
 OUT_DIR = r'C:\Users\sebas\Desktop\temp_pyVisualStim_OutputFiles' # Output files directory. Where to save them
-IDs_FILE_DIR  = gui.fileOpenDlg(OUT_DIR)
+if HEADLESS:
+    IDs_FILE_DIR = None
+else:
+    from psychopy import gui
+    IDs_FILE_DIR  = gui.fileOpenDlg(OUT_DIR)
 
 
 #Reading current experimental info from file
@@ -95,17 +149,36 @@ VIEWPOS_FILE = 'viewpositions.txt' # Contains window' size and position on the s
 VIEWPOINT_X = 0.5
 VIEWPOINT_Y = 0.5
 WARP = 'spherical'
+WARP_GRIDSIZE = 300
 WIN_MASK = 0
+# Default mask: only the lower-central part of the window is visible
+MASK_POLYGONS = [[(0,0.5),(1,0.5),(1,1),(0,1)], # upper half
+                 [(0,0),(0.25,0),(0.25,1),(0,1)], # left quarter
+                 [(0.75,0),(1,0),(1,1),(0.75,1)]] # right quarter
+CACHE_DIR = 'cache'
+CATALOG_FILE = 'pyVisualStim_catalog.sqlite'
+CALIBRATION_FRAMES = 300
+CALIBRATION_CHECK_FRAMES = 30
+CALIBRATION_TOLERANCE = 0.005
+CALIBRATION_MAX_AGE_DAYS = 30
+USE_MEASURED_FRAMERATE = 1
 MODE = 'patternMode' #'patternMode', 'videoMode'
 
 # Other configurations
 MAXRUNTIME = 3600
 SEED = 54378  # To keep reproducibility among experiments >> DO NOT CHANGE this SEED number: (54378, original from 2020)
+RNG_MODE = 'legacy' # 'legacy' or 'counter', see rng
+TRIGGER_PAUSE = 5 # Avoids the initial increase in fluorescence when the microscope starts scanning
+PROFILE_FRAMES = 0 # 0 or 1, cheap enough for recordings
+REALTIME_MODE = 0 # opt-in, see realtime
+RENDER_CPU = -1 # core 0 usually serves most interrupts
+LOG_RATE_LIMIT = 5
 
 # For NIDAQ configuration
 COUNTER_CHANNEL = "Dev2/ctr1" # or "Dev2/ctr1"
 PULSE_CHANNEL = "Dev2/ctr0"  #or "Dev2/ctr0". Consider using not a counter but digital mode 'port1/line0' (digital channel)
 MAXRATE = 10000.0 # Seb, currently unused
+SIMULATED_SCAN_RATE = 10.0
 
 # For monitor color and luminance calibration:
 CALIBRATE_GAMMA = 0 # 0 or 1
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Manual stop of a session from the keyboard.
+
+The key presses are not searched for in psychopy's event queue every frame.
+A handler on the pyglet window (called when the window dispatches its
+events, i.e. once per flip) sets the shared `abort` flag, and the stimulus
+loops only read one attribute of it:
+
+- **Esc**: stop now (the current epoch is interrupted)
+- **any other key**: stop after the current epoch
+
+The flag can also be set from code (e.g. another thread) with
+`abort.request`.
+
+"""
+
+import pyglet.window.key as key
+
+RUN, STOP_AFTER_EPOCH, STOP_NOW = 0, 1, 2
+
+
+class AbortFlag(object):
+    """ State of a session: RUN, STOP_AFTER_EPOCH or STOP_NOW. Setting a
+    Python attribute is atomic, so it can be set from any thread. """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.state = RUN
+        self.stop_now = False
+        self.stop_after_epoch = False
+
+    def request(self, state):
+        """ Moves to a stop state (a stop request is never undone by a weaker one) """
+        if state > self.state:
+            self.state = state
+            self.stop_now = state >= STOP_NOW
+            self.stop_after_epoch = True # also after an interrupted epoch
+
+    def on_key_press(self, symbol, modifiers):
+        """ pyglet handler """
+        self.request(STOP_NOW if symbol == key.ESCAPE else STOP_AFTER_EPOCH)
+        return True # handled, psychopy's key buffer is not filled
+
+
+abort = AbortFlag()
+
+
+def install(win):
+
+    """ Resets the flag and connects it to the keyboard of the window.
+
+    :param win: psychopy window (a window without pyglet handle, e.g. the
+        simulated one of a dry run, is only reset)
+    :returns: the flag
+
+    """
+    abort.reset()
+    win_handle = getattr(win, 'winHandle', None)
+    if win_handle is not None and hasattr(win_handle, 'push_handlers'):
+        win_handle.push_handlers(on_key_press=abort.on_key_press)
+    return abort
+
+
+def uninstall(win):
+    """ Disconnects the flag from the window """
+    win_handle = getattr(win, 'winHandle', None)
+    if win_handle is not None and hasattr(win_handle, 'remove_handlers'):
+        win_handle.remove_handlers(on_key_press=abort.on_key_press)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Contrast diagnostics of the grating textures.
+
+Computed from the textures of every grating epoch while the session is
+prepared (never in the presentation loop) and appended to the metadata
+file as numbers, one row per epoch and value:
+
+- **grating_max_ratio_epoch<e>**: fraction of the pixels of the last frame
+  at its maximum
+- **grating_min_ratio_epoch<e>**: fraction of the pixels of the last frame
+  at its minimum
+- **grating_contrast_epoch<e>**: mean of both ratios
+- **grating_clipped_ratio_epoch<e>**: fraction of the noisy pixels of the
+  whole epoch clipped to the displayable range
+
+Figures of the textures are drawn offline by bin/grating_report.py.
+
+"""
+
+import numpy as np
+
+from modules.timing import epoch_frames
+
+MAX_TEX_VALUE = (2*(63.0/255.0))-1 # Max value in stim_texture after scaling
+MIN_TEX_VALUE = -1 # Min value in stim_texture after scaling
+KEY_PREFIX = 'grating_'
+
+
+def is_grating(stimtype):
+    """ True for the stimtypes presented by stimuli.noisy_grating """
+    return stimtype != "DG" and stimtype[-1:] in ("G", "g")
+
+
+def grating_frame(stim_texture, noise_arr, frameN):
+    """ Texture of one frame of a noisy grating, as in stimuli.noisy_grating """
+    if noise_arr is None:
+        return stim_texture
+    return np.clip(stim_texture + noise_arr[frameN], MIN_TEX_VALUE, MAX_TEX_VALUE)
+
+
+def texture_contrast(texture):
+
+    """ Proportion of the pixels at the extreme values of a texture
+
+    :param texture: grating texture in [-1,1]
+    :type texture: numpy array
+    :returns: dict with max_ratio, min_ratio and contrast (their mean)
+
+    """
+    total_num_pixels = texture.size
+    max_ratio = round(float(np.count_nonzero(texture == np.max(texture))) / total_num_pixels, 3)
+    min_ratio = round(float(np.count_nonzero(texture == np.min(texture))) / total_num_pixels, 3)
+    return {'max_ratio': max_ratio, 'min_ratio': min_ratio,
+            'contrast': round((max_ratio + min_ratio) / 2, 3)}
+
+
+def clipped_ratio(stim_texture, noise_arr, n_frames):
+    """ Fraction of the pixels of an epoch outside the displayable range
+    before clipping """
+    clipped = 0
+    for frameN in range(n_frames):
+        texture = stim_texture + noise_arr[frameN]
+        clipped += np.count_nonzero((texture > MAX_TEX_VALUE) | (texture < MIN_TEX_VALUE))
+    return round(float(clipped) / (n_frames * stim_texture.size), 4)
+
+
+def grating_diagnostics(stimdict, textures):
+
+    """ Diagnostics of every grating epoch with a texture
+
+    :param stimdict: stimulus dictionary, with the frame counts of timing.frame_timing
+    :type stimdict: dict
+    :param textures: as returned by `textures.generate_textures`
+    :type textures: tuple
+    :returns: {epoch: dict of values}
+
+    """
+    stim_texture_ls, noise_array_ls, stim_texture, _useTex, _useNoise = textures
+    diagnostics = {}
+    if not _useTex:
+        return diagnostics # psychopy's own 'sqr' texture
+    for epoch, stimtype in enumerate(stimdict["stimtype"]):
+        if not is_grating(stimtype):
+            continue
+        noise_arr = noise_array_ls[epoch] if _useNoise else None
+        n_frames = epoch_frames(stimdict, epoch)[1]
+        if noise_arr is not None:
+            n_frames = min(n_frames, len(noise_arr))
+        values = texture_contrast(grating_frame(stim_texture_ls[epoch], noise_arr, n_frames - 1))
+        if noise_arr is not None:
+            values['clipped_ratio'] = clipped_ratio(stim_texture_ls[epoch], noise_arr, n_frames)
+        diagnostics[epoch] = values
+    return diagnostics
+
+
+def metadata_values(diagnostics):
+    """ Rows for helper.append_main_setup """
+    return {'%s%s_epoch%d' % (KEY_PREFIX, name, epoch): value
+            for epoch, values in sorted(diagnostics.items())
+            for name, value in values.items()}
+
+
+def read_diagnostics(metafile):
+
+    """ Diagnostics written to a metadata file
+
+    :param metafile: path of the metadata file of a session
+    :returns: {epoch: dict of values}
+
+    """
+    diagnostics = {}
+    with open(metafile) as f:
+        for line in f:
+            key, _, value = line.rstrip('\n').partition(',')
+            if not key.startswith(KEY_PREFIX) or '_epoch' not in key:
+                continue
+            name, _, epoch = key[len(KEY_PREFIX):].rpartition('_epoch')
+            diagnostics.setdefault(int(epoch), {})[name] = float(value)
+    return diagnostics
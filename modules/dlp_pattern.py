@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Packing of several stimulus frames into the bit planes of one video frame.
+
+In pattern mode the LightCrafter shows the 24 bit planes of every video
+frame as a sequence of patterns of lower bit depth (e.g. 4 patterns of
+6 bits, 12 of 2 bits or 24 of 1 bit) within one refresh. `pack_frames`
+puts N = 24 // bit_depth consecutive stimulus frames into one RGB frame, so
+binary noise runs at 24 x FRAMERATE and ternary noise (2 bits) at
+12 x FRAMERATE on the same hardware. The pattern sequence itself (bit depth,
+LED, exposure) is set up in the projector software.
+
+Bit planes are numbered G0-G7, R0-R7, B0-B7 (DLPC350 order, see
+PLANE_CHANNELS): pattern j of a video frame occupies the bits
+[j*bit_depth, (j+1)*bit_depth) of that 24-bit number.
+
+The packed values are presented unchanged, so the window gamma must be 1
+(config.GAMMA_LS), `get_dlpcol` must not be applied, and the texture must
+not be interpolated: a warped window blends neighbouring pixels, which
+mixes their bit planes at the edges of the texels. `check_pattern_setup`
+refuses such sessions.
+
+Ternary noise is shown at the levels of `ternary_levels`, whose gray is
+exactly half of the bright level, so that the contrasts stay -1, 0 and 1.
+
+For a noise stimulus the frame log stores in theta the number of the first
+pattern of the video frame in the epoch; `expand_frame_log` gives the time
+and the texture of every pattern.
+
+"""
+
+import numpy as np
+
+BITS_PER_FRAME = 24
+PLANE_CHANNELS = (1, 0, 2) # RGB channel of the bits 0-7, 8-15 and 16-23
+
+
+def patterns_per_frame(bit_depth):
+
+    """ Patterns shown per video frame
+
+    :param bit_depth: bits per pattern, 1, 2, 3, 4, 6 or 8 (the projector
+        shows patterns of at most 8 bits)
+    :type bit_depth: int
+    :returns: int
+
+    """
+    if not 1 <= bit_depth <= 8 or BITS_PER_FRAME % bit_depth:
+        raise ValueError('Pattern bit depth %r is not 1, 2, 3, 4, 6 or 8' % (bit_depth,))
+    return BITS_PER_FRAME // bit_depth
+
+
+def quantize(frames, bit_depth):
+
+    """ Intensities in [0,1] to the levels of a pattern
+
+    :param frames: array of intensities (e.g. the texture stack of a noise stimulus)
+    :type frames: numpy array
+    :returns: uint8 array of levels 0 .. 2**bit_depth - 1
+
+    """
+    top = (1 << bit_depth) - 1
+    return np.rint(np.clip(frames, 0, 1) * top).astype(np.uint8)
+
+
+def ternary_levels(bit_depth):
+
+    """ Pattern levels of the dark, gray and bright values of ternary noise
+
+    Gray is exactly half of bright (e.g. 0, 1, 2 of the 2-bit levels 0-3),
+    so bright may be below the top level.
+
+    :param bit_depth: bits per pattern
+    :type bit_depth: int
+    :returns: uint8 array of 3 levels
+
+    """
+    half = ((1 << bit_depth) - 1) // 2
+    if not half:
+        raise ValueError('Ternary noise cannot be shown with %d-bit patterns (no gray level)' % bit_depth)
+    return np.array([0, half, 2 * half], dtype=np.uint8)
+
+
+def check_pattern_setup(stimdict, gamma, calibrate_gamma=False):
+
+    """ Raises ValueError if a session with PATTERN_BIT_DEPTH would corrupt
+    the bit planes: perspective correction (warper), a gamma other than 1,
+    or a noise background that `get_dlpcol` turns into other levels (the
+    noise epochs must be on black, 0 in every plane). Also if ternary noise
+    has no gray level at the bit depth (see `ternary_levels`)
+
+    :param stimdict: stimulus dictionary, after helper.rename_stimtypes
+    :param gamma: gamma of every channel (config.GAMMA_LS)
+    :param calibrate_gamma: config.CALIBRATE_GAMMA, the monitor gamma is changed
+
+    """
+    patterns_per_frame(stimdict["PATTERN_BIT_DEPTH"])
+    if stimdict.get("STIMULUSDATA") == "TERNARY_TEXTURE":
+        ternary_levels(stimdict["PATTERN_BIT_DEPTH"])
+    noise = [epoch for epoch, stimtype in enumerate(stimdict["stimtype"]) if stimtype == "N"]
+    problems = []
+    pers_corr = stimdict.get("pers.corr", [0] * len(stimdict["stimtype"]))
+    if stimdict.get("PERSPECTIVE_CORRECTION", 0) == 1 or any(pers_corr[epoch] == 1 for epoch in noise):
+        problems.append('perspective correction (PERSPECTIVE_CORRECTION or pers.corr 1)')
+    if calibrate_gamma or any(value != 1 for value in gamma):
+        problems.append('gamma %s (must be 1)' % (list(gamma),))
+    if any(stimdict["bg"][epoch] != 0 for epoch in noise):
+        problems.append('noise background other than 0 (scaled by get_dlpcol)')
+    if problems:
+        raise ValueError('PATTERN_BIT_DEPTH %s cannot be presented with %s'
+                         % (stimdict["PATTERN_BIT_DEPTH"], ', '.join(problems)))
+
+
+def _words_to_rgb(words):
+    """ 24-bit numbers to RGB bytes, see PLANE_CHANNELS """
+    rgb = np.empty(words.shape + (3,), dtype=np.uint8)
+    for byte, channel in enumerate(PLANE_CHANNELS):
+        rgb[..., channel] = (words >> (8 * byte)) & 0xFF
+    return rgb
+
+
+def pack_frames(levels, bit_depth):
+
+    """ Packs consecutive frames into the bit planes of video frames
+
+    :param levels: (n, height, width) array of levels, see `quantize`. n is
+        padded with blank (0) patterns to a multiple of `patterns_per_frame`
+    :type levels: numpy array
+    :param bit_depth: bits per pattern
+    :type bit_depth: int
+    :returns: (ceil(n / N), height, width, 3) uint8 array of RGB video frames
+
+    """
+    n_patterns = patterns_per_frame(bit_depth)
+    levels = np.asarray(levels)
+    n_frames = -(-len(levels) // n_patterns)
+    padded = np.zeros((n_frames * n_patterns,) + levels.shape[1:], dtype=np.uint32)
+    padded[:len(levels)] = levels
+    padded = padded.reshape((n_frames, n_patterns) + levels.shape[1:])
+
+    shifts = (np.arange(n_patterns, dtype=np.uint32) * bit_depth).reshape((1, n_patterns) + (1,) * (levels.ndim - 1))
+    words = np.bitwise_or.reduce(padded << shifts, axis=1) # 24-bit number per pixel
+
+    return _words_to_rgb(words)
+
+
+def unpack_frames(rgb, bit_depth):
+
+    """ Inverse of `pack_frames`
+
+    :param rgb: (n_video, height, width, 3) uint8 array
+    :returns: (n_video * N, height, width) uint8 array of levels
+
+    """
+    n_patterns = patterns_per_frame(bit_depth)
+    rgb = np.asarray(rgb, dtype=np.uint32)
+    words = np.zeros(rgb.shape[:-1], dtype=np.uint32)
+    for byte, channel in enumerate(PLANE_CHANNELS):
+        words |= rgb[..., channel] << (8 * byte)
+
+    shifts = (np.arange(n_patterns, dtype=np.uint32) * bit_depth).reshape((1, n_patterns) + (1,) * (words.ndim - 1))
+    levels = (words[:, None] >> shifts) & ((1 << bit_depth) - 1)
+    return levels.reshape((-1,) + words.shape[1:]).astype(np.uint8)
+
+
+def to_psychopy_rgb(rgb):
+    """ uint8 RGB frames to psychopy's rgb color space [-1,1] (exact for every byte) """
+    return (np.asarray(rgb, dtype=np.float32) / 127.5 - 1).astype(np.float32)
+
+
+def texture_patterns(texture_duration, framerate, bit_depth):
+
+    """ Patterns per texture of a noise stimulus
+
+    :param texture_duration: "texture.duration" of the epoch in seconds
+    :type texture_duration: float
+    :param framerate: refresh rate of the video frames
+    :type framerate: float
+    :returns: int, at least 1
+
+    """
+    return max(1, int(round(texture_duration * framerate * patterns_per_frame(bit_depth))))
+
+
+def pack_texture_stack(levels, bit_depth, tex_patterns):
+
+    """ Pattern stream of a noise texture stack, packed into video frames
+
+    :param levels: (count, height, width) pattern levels, see `quantize` and
+        `ternary_levels`
+    :param tex_patterns: patterns per texture, see `texture_patterns`
+    :type tex_patterns: int
+    :returns: (n_video, height, width, 3) float32 frames in psychopy's rgb color space
+
+    """
+    n_patterns = patterns_per_frame(bit_depth)
+    n_frames = -(-len(levels) * tex_patterns // n_patterns)
+
+    # Texture of every pattern, gathered slot by slot (the repeated pattern
+    # stream is never built). Patterns after the last texture stay blank.
+    texture_of = np.arange(n_frames * n_patterns).reshape(n_frames, n_patterns) // tex_patterns
+    words = np.zeros((n_frames,) + levels.shape[1:], dtype=np.uint32)
+    for j in range(n_patterns):
+        shown = texture_of[:, j] < len(levels)
+        words[shown] |= levels[texture_of[shown, j]].astype(np.uint32) << (j * bit_depth)
+
+    return to_psychopy_rgb(_words_to_rgb(words))
+
+
+def expand_frame_log(times, first_patterns, framerate, bit_depth, tex_patterns=1):
+
+    """ One row per pattern from the rows of the video frames in the frame log
+
+    :param times: flip times of the video frames (tcurr)
+    :type times: numpy array
+    :param first_patterns: number of the first pattern of every video frame
+        in its epoch (theta of a packed noise stimulus)
+    :type first_patterns: numpy array
+    :param framerate: refresh rate of the video frames
+    :type framerate: float
+    :param bit_depth: bits per pattern
+    :type bit_depth: int
+    :param tex_patterns: patterns per texture, see `texture_patterns`
+    :type tex_patterns: int
+    :returns: (pattern times, pattern numbers, texture indices), arrays of
+        length N * len(times)
+
+    """
+    n_patterns = patterns_per_frame(bit_depth)
+    offsets = np.arange(n_patterns)
+    times = np.asarray(times, dtype=float)[:, None] + offsets / (framerate * n_patterns)
+    patterns = np.asarray(first_patterns, dtype=np.int64)[:, None] + offsets
+    return times.ravel(), patterns.ravel(), patterns.ravel() // tex_patterns
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Reading and timing analysis of the frame logs (stimulus output files).
+
+A frame log is the text file written by `helper.write_out`: two header
+lines (experiment info, stimulus file), the column names, and one row per
+presented frame. `read_frame_log` returns it as a NumPy record array, from
+the text file or from its binary copy (.npy, see `write_binary`), which is
+much faster to read again.
+
+The analysis is vectorized: frame intervals from the flip times (tcurr),
+dropped frames (intervals longer than DROP_FACTOR times the usual one),
+run lengths of a column (`run_lengths`, e.g. the on/off phases stored in
+theta) and timing statistics per epoch.
+
+"""
+
+import os
+import numpy as np
+
+COLUMNS = ('frame', 'tcurr', 'boutInd', 'epoch', 'xpos', 'ypos', 'theta', 'data')
+DTYPE = np.dtype([('frame', np.int64), ('tcurr', np.float64), ('boutInd', np.int64),
+                  ('epoch', np.int64), ('xpos', np.float64), ('ypos', np.float64),
+                  ('theta', np.float64), ('data', np.int64)])
+HEADER_LINES = 3
+DROP_FACTOR = 1.5
+
+
+class FrameLog(object):
+    """ Rows and header of a frame log.
+
+        :param rows: record array with the fields of DTYPE
+        :type rows: numpy array
+        :param experiment: first header line (experiment, user, TSeries)
+        :type experiment: str
+        :param stimfile: stimulus file of the session
+        :type stimfile: str
+        :param filename: file it was read from
+        :type filename: str
+
+    """
+
+    def __init__(self, rows, experiment='', stimfile='', filename=None):
+        self.rows = rows
+        self.experiment = experiment
+        self.stimfile = stimfile
+        self.filename = filename
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, column):
+        return self.rows[column]
+
+
+def is_frame_log(filename):
+    """ True for the text frame logs and their binary copies """
+    name = os.path.basename(filename)
+    return '_stimulus_output' in name and (name.endswith('.txt') or name.endswith('.npy'))
+
+
+def binary_filename(filename):
+    """ Name of the binary copy of a text frame log """
+    return os.path.splitext(filename)[0] + '.npy'
+
+
+def read_frame_log(filename):
+
+    """ Reads a frame log, text or binary (.npy)
+
+    :param filename: path of the stimulus output file
+    :returns: `FrameLog`
+
+    """
+    if filename.endswith('.npy'):
+        data = np.load(filename, allow_pickle=False)
+        header = [str(line) for line in np.load(_header_filename(filename), allow_pickle=False)] \
+            if os.path.exists(_header_filename(filename)) else ['', '']
+        return FrameLog(data, header[0], header[1], filename)
+
+    with open(filename) as f:
+        header = [next(f, '').rstrip('\n') for i in range(HEADER_LINES)]
+        rows = np.loadtxt(f, delimiter=',', dtype=DTYPE, ndmin=1)
+    return FrameLog(rows, header[0], header[1], filename)
+
+
+def _header_filename(filename):
+    return os.path.splitext(filename)[0] + '_header.npy'
+
+
+def write_binary(log, filename=None):
+
+    """ Stores a frame log as .npy (rows) and _header.npy (header lines)
+
+    :param log: `FrameLog`
+    :param filename: default: next to the text file (`binary_filename`)
+    :returns: the filename
+
+    """
+    filename = binary_filename(log.filename) if filename is None else filename
+    np.save(filename, log.rows)
+    np.save(_header_filename(filename), np.array([log.experiment, log.stimfile]))
+    return filename
+
+
+def run_lengths(values):
+
+    """ Run-length encoding
+
+    :param values: 1D array
+    :returns: (run values, run starts, run lengths)
+
+    """
+    values = np.asarray(values)
+    if len(values) == 0:
+        return values, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    starts = np.concatenate(([0], np.flatnonzero(values[1:] != values[:-1]) + 1))
+    lengths = np.diff(np.concatenate((starts, [len(values)])))
+    return values[starts], starts, lengths
+
+
+def frame_intervals(log):
+    """ Intervals between consecutive frames in seconds """
+    return np.diff(log['tcurr'])
+
+
+def nominal_interval(intervals):
+    """ Frame interval of a session: mean of the intervals without drops
+    (tcurr is logged in ms, so the median alone is off by up to 0.5 ms) """
+    if len(intervals) == 0:
+        return None
+    regular = intervals[intervals <= DROP_FACTOR * np.median(intervals)]
+    return float(np.mean(regular))
+
+
+def dropped_frames(intervals, nominal=None):
+
+    """ Frames missed between consecutive logged frames
+
+    :param intervals: see `frame_intervals`
+    :param nominal: frame interval in seconds (default: `nominal_interval`)
+    :type nominal: float
+    :returns: int array, per interval, of the frames missed (0 if none)
+
+    """
+    if len(intervals) == 0:
+        return np.zeros(0, dtype=np.int64)
+    nominal = nominal_interval(intervals) if nominal is None else nominal
+    missed = np.rint(intervals / nominal).astype(np.int64) - 1
+    missed[intervals <= DROP_FACTOR * nominal] = 0
+    return missed
+
+
+def _statistics(values):
+    if len(values) == 0:
+        return {'mean': None, 'median': None, 'std': None, 'max': None}
+    return {'mean': float(np.mean(values)), 'median': float(np.median(values)),
+            'std': float(np.std(values)), 'max': float(np.max(values))}
+
+
+def epoch_statistics(log, nominal=None):
+
+    """ Timing statistics per epoch index, over all its presentations
+
+    :param log: `FrameLog`
+    :param nominal: frame interval in seconds (default: `nominal_interval`)
+    :returns: {epoch: dict} with presentations, frames (per presentation:
+        mean, median, std, max), duration_s (idem), dropped frames and the
+        largest interval in ms
+
+    """
+    if len(log) == 0:
+        return {}
+    tcurr = log['tcurr']
+    intervals = frame_intervals(log)
+    if nominal is None:
+        nominal = nominal_interval(intervals) or 0.0
+    missed = dropped_frames(intervals, nominal)
+
+    # One presentation = one run of boutInd; a presentation lasts until the
+    # next one starts (the last one until the end of its last frame)
+    _, starts, lengths = run_lengths(log['boutInd'])
+    epochs = log['epoch'][starts]
+    durations = np.diff(np.concatenate((tcurr[starts], [tcurr[-1] + nominal])))
+
+    # Interval i (between frames i and i+1) counts if both frames belong to
+    # the same presentation
+    presentation = np.repeat(np.arange(len(starts)), lengths)
+    inside = presentation[1:] == presentation[:-1]
+
+    statistics = {}
+    for epoch in np.unique(epochs):
+        presentations = np.flatnonzero(epochs == epoch)
+        mask = inside & np.isin(presentation[:-1], presentations)
+        statistics[int(epoch)] = {
+            'presentations': int(len(presentations)),
+            'frames': _statistics(lengths[presentations]),
+            'duration_s': _statistics(durations[presentations]),
+            'dropped': int(missed[mask].sum()),
+            'max_interval_ms': float(intervals[mask].max() * 1000) if mask.any() else None}
+    return statistics
+
+
+def analyse(log, column='theta'):
+
+    """ Timing summary of a session
+
+    :param log: `FrameLog`
+    :param column: column whose run lengths are reported (e.g. theta, the
+        on/off phases of a flicker)
+    :type column: str
+    :returns: dict
+
+    """
+    intervals = frame_intervals(log)
+    nominal = nominal_interval(intervals)
+    missed = dropped_frames(intervals, nominal)
+    values, starts, lengths = run_lengths(log[column])
+
+    runs = {}
+    for value in np.unique(values):
+        # First and last runs may be cut by the start and the end of the log
+        inner = lengths[1:-1][values[1:-1] == value]
+        runs[float(value)] = _statistics(inner)
+        runs[float(value)]['count'] = int(len(inner))
+
+    return {'filename': log.filename,
+            'stimfile': log.stimfile,
+            'frames': len(log),
+            'duration_s': float(log['tcurr'][-1] - log['tcurr'][0]) if len(log) else 0.0,
+            'frame_interval_ms': _statistics(intervals * 1000),
+            'framerate': 1.0 / nominal if nominal else None,
+            'dropped_frames': int(missed.sum()),
+            'drop_events': int(np.count_nonzero(missed)),
+            'run_lengths': {'column': column, 'runs': runs},
+            'epochs': epoch_statistics(log, nominal)}
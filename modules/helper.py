@@ -3,12 +3,19 @@
 
 from __future__ import division
 from collections import defaultdict
-import PyDAQmx as daq
+try:
+    import PyDAQmx as daq
+except (ImportError, NotImplementedError, OSError): # No NI-DAQ driver (e.g. offscreen rendering)
+    daq = None
 import numpy
 import datetime
+import time
+import os
 
 from modules.exceptions import MicroscopeException, StimulusTimeExceededException, GlobalTimeExceededException
 from modules import config
+from modules import stimlog
+from modules.rng import RandomStreams
 
 
 
@@ -81,7 +88,7 @@ class Output(object):
 
         """
         time = datetime.datetime.now()
-        outfile_temp_name = "%s\\%s_%d%d_%d.txt" %(location,config.OUTFILE_NAME,time.hour,time.minute,time.second)
+        outfile_temp_name = os.path.join(location, "%s_%d%d_%d.txt" %(config.OUTFILE_NAME,time.hour,time.minute,time.second))
         outFile_temp = open(outfile_temp_name, 'w')
         expInfo = '%s %s %s\n' % (exp_Info["Experiment"],exp_Info["User"],exp_Info["TSeries_ID"] )
         stimfile = '%s\n' % (path_stimfile)
@@ -143,13 +150,49 @@ class Stimulus(object):
         return dict
 
 
-def write_main_setup(location,dlp_ok,MAXRUNTIME,exp_Info):
+def experiment_info():
 
-    """ Writes the meta_data file which logs global settings """
+    """ Returns the info about the experiment session, as set in config.
+    main lets the user edit it in a dialog before the session starts. """
+
+    return {'Experiment': config.ID_DICT['EXP_NAME'],'User': config.ID_DICT['USER_ID'], 'Subject_ID': config.ID_DICT['SUBJECT_ID'],
+            'TSeries_ID': f"{config.ID_DICT['SUBJECT_ID']}-{config.ID_DICT['TSERIES_NUMBER']}",'Genotype': config.ID_DICT['GENOTYPE'],
+            'Condition' : config.ID_DICT['CONDITION'],'Stimulus' : config.ID_DICT['STIMULUS_ID'], 'Age' : config.ID_DICT['AGE'],
+            'Sex' : config.ID_DICT['SEX'],'ViewPoint_x': config.VIEWPOINT_X, 'ViewPoint_y':config.VIEWPOINT_Y, 'Warp': config.WARP,
+            'Projector_mode': config.MODE}
+
+def add_session_info(exp_Info,psychopy_version):
+
+    """ Adds the date, the psychopy version and the screen settings to exp_Info (in place)
+
+    :param exp_Info: info about the experiment session (see `experiment_info`)
+    :type exp_Info: dict
+    :param psychopy_version: psychopy.__version__
+    :type psychopy_version: str
+
+    """
+    _time = datetime.datetime.now()
+    exp_Info['date'] = "%d%d%d_%d%d_%d" %(_time.year,_time.month,
+                                                _time.day,_time.hour,
+                                                _time.minute,_time.second)
+
+    exp_Info['psychopyVersion'] = psychopy_version
+    exp_Info['Frame_rate'] = config.FRAMERATE
+    exp_Info['Screen_distance'], exp_Info['Screen_width'] = config.DISTANCE, config.SCREEN_WIDTH
+    exp_Info['WinMasks'] = config.WIN_MASK
+
+def write_main_setup(location,dlp_ok,MAXRUNTIME,exp_Info,schedule=None):
+
+    """ Writes the meta_data file which logs global settings
+
+    :param schedule: Epoch order of the whole session (see `epoch_schedule`)
+    :type schedule: numpy integer array
+
+    """
 
     # A temporary mainfile, containing data of last run
     time = datetime.datetime.now()
-    mainfile_name_temp = f"{location}\\{config.METAFILE_NAME}_{time.hour}{time.minute}_{time.second}.txt"
+    mainfile_name_temp = os.path.join(location, f"{config.METAFILE_NAME}_{time.hour}{time.minute}_{time.second}.txt")
     mainfile_temp = open(mainfile_name_temp, 'w')
 
     mainfile_temp.write("KEY,VALUE\n")
@@ -157,6 +200,20 @@ def write_main_setup(location,dlp_ok,MAXRUNTIME,exp_Info):
     mainfile_temp.write("MAXRUNTIME,%f\n" % round(MAXRUNTIME))
     for key,value in exp_Info.items():
         mainfile_temp.write(f"{key},{value}\n")
+    if schedule is not None:
+        mainfile_temp.write("epoch_schedule,%s\n" % ' '.join(map(str, schedule)))
+    mainfile_temp.close()
+
+    return mainfile_name_temp
+
+def append_main_setup(metafile, **values):
+
+    """ Appends KEY,VALUE lines to the meta_data file (values known only
+    after `write_main_setup`) """
+
+    with open(metafile, 'a') as mainfile:
+        for key, value in values.items():
+            mainfile.write(f"{key},{value}\n")
 
 def save_main_setup(location):
 
@@ -247,16 +304,116 @@ def check_timing_nidaq(dlpOK,stimdictMAXRUNTIME,global_clock,taskHandle = None,d
 
     return (data.value,lastDataFrame, lastDataFrameStartTime)
 
-def shuffle_epochs(randomize,no_epochs):
+def start_nidaq(dlp_ok,global_clock):
+
+    """ Sets up the NIDAQ tasks for the imaging synchronization and sends the
+    trigger to the microscope. Without DLP (test mode) only the variables
+    are defined, they are not changed during the session.
+
+    :param dlp_ok: Is DLP used (so, not in testmode)?
+    :type dlp_ok: boolean
+    :param global_clock: global clock of the session
+    :type global_clock: core.Clock
+    :returns: (counterTaskHandle, pulseTaskHandle, data, lastDataFrame, lastDataFrameStartTime).
+        Task handles are None without DLP
+
+    """
+    if dlp_ok:
+        print('DLP used')
+
+        counterTaskHandle = daq.TaskHandle(0)
+        pulseTaskHandle = daq.TaskHandle(0)
+        counterChannel = config.COUNTER_CHANNEL
+        pulseChannel = config.PULSE_CHANNEL
+
+        # data from NIDAQ counter
+        data = daq.uInt32(1)
+        lastDataFrame = -1
+        lastDataFrameStartTime = 0
+
+        #DAQ SETUP FOR IMAGING SYNCHRONIZATION
+        try:
+            # DAQmx Configure Code
+            daq.DAQmxCreateTask("2",daq.byref(counterTaskHandle))
+            daq.DAQmxCreateCICountEdgesChan(counterTaskHandle,counterChannel,
+                                            "",daq.DAQmx_Val_Rising,0,
+                                            daq.DAQmx_Val_CountUp)
+            daq.DAQmxCreateTask("1",daq.byref(pulseTaskHandle))
+            daq.DAQmxCreateCOPulseChanTime(pulseTaskHandle,pulseChannel,
+                                           "",daq.DAQmx_Val_Seconds,
+                                           daq.DAQmx_Val_Low,0,0.05,0.05)
+
+            # DAQmx Start Code
+            daq.DAQmxStartTask(counterTaskHandle) # Reading any coming frame.
+            daq.DAQmxStartTask(pulseTaskHandle)   # Sending trigger to mic.
+
+            # Reads incoming signal from microscope computer and stores it to
+            # 'data'. A rising edge is send every new frame the microscope
+            # starts to record, thus the 'data' variable is incremented
+            daq.DAQmxReadCounterScalarU32(counterTaskHandle,1.0,
+                                          daq.byref(data), None)
+
+            # Do we need that here? Check it with hardware.
+            # Checks if new frame is being imaged.
+            if (lastDataFrame != data.value):
+                lastDataFrame = data.value
+                lastDataFrameStartTime = global_clock.getTime()
+
+        except daq.DAQError as err:
+            print ("DAQmx Error: %s"%err)
+
+    else:
+        # When not using dlp (Checking the stimulus in th PCs monitor),
+        # some varibales need to be defined anyways, although they are
+        # not being change every frame.
+        counterTaskHandle = None
+        pulseTaskHandle = None
+        data = daq.uInt32(1)
+        lastDataFrame = 0
+        lastDataFrameStartTime = 0
+        print('No DLP used')
+
+    return (counterTaskHandle, pulseTaskHandle, data, lastDataFrame, lastDataFrameStartTime)
+
+def clearTask(taskHandle):
+    """
+    Clears a task from the card.
+    """
+    daq.DAQmxStopTask(taskHandle)
+    daq.DAQmxClearTask(taskHandle)
+
+def wait_until(clock, deadline, spin=0.002):
+
+    """ Waits until the clock reaches the deadline: sleeps, and busy-waits
+    the last `spin` seconds, since sleep may overshoot by a few milliseconds.
+
+    :param clock: e.g. the global clock of the session
+    :param deadline: time of the clock to wait for
+    :type deadline: float
+    :returns: the time that was left (negative if the deadline was missed)
+
+    """
+    remaining = deadline - clock.getTime()
+    if remaining > spin:
+        time.sleep(remaining - spin)
+    while clock.getTime() < deadline:
+        pass
+    return remaining
+
+def shuffle_epochs(randomize,no_epochs,random_state=None):
     """Shuffles the epoch sequence according to the randomize option.
 
     :param randomize: 0 (don't shuffle), 1 (shuffle randomly, except 1st epoch), 2 (shuffle randomly).
     :type randomize: Integer
     :param no_epochs: Number of epochs in stimfile.
     :type no_epochs: Integer
+    :param random_state: Seeded generator used for shuffling (see rng). None uses the global numpy one.
+    :type random_state: numpy.random.RandomState or numpy.random.Generator
     :returns: numpy integer array of shuffled epoch indices.
 
     """
+    if random_state is None:
+        random_state = numpy.random
     if randomize == 0.0:
         # dont shuffle epochs
         index = numpy.zeros((no_epochs,1))
@@ -273,8 +430,7 @@ def shuffle_epochs(randomize,no_epochs):
         for ii in range(0,no_epochs-1):
             index[ii] = ii+1
 
-        # numpy.random.seed(config.SEED)
-        numpy.random.shuffle(index) # Actual shuffling
+        random_state.shuffle(index) # Actual shuffling
 
     elif randomize == 2.0:
         # shuffle epochs randomly
@@ -284,12 +440,100 @@ def shuffle_epochs(randomize,no_epochs):
         for ii in range(no_epochs):
             index[ii] = ii
 
-        # numpy.random.seed(config.SEED)
-        numpy.random.shuffle(index) # Actual shuffling
+        random_state.shuffle(index) # Actual shuffling
 
 
     return index
 
+def randomization_mode(stimdict):
+    """Returns the randomize option of the stimulus file.
+
+    Older stimulus files define it per epoch as "Stimulus.randomize".
+    """
+    try:
+        return stimdict["RANDOMIZATION_MODE"]
+    except KeyError:
+        return stimdict["randomize"][0] # Seb, temp for old stimulus design
+
+def epoch_duration(stimdict, epoch, screen_width, distance, texture_count=None):
+    """Returns the duration in seconds of one epoch, as played by its stimulus function.
+
+    :param stimdict: The stimulus dictionary.
+    :type stimdict: dict
+    :param epoch: The epoch.
+    :type epoch: Integer
+    :param texture_count: Number of textures presented by a noise ("N") epoch.
+    :type texture_count: Integer
+    :returns: float
+
+    """
+    stimtype = stimdict["stimtype"][epoch]
+    if stimtype == "SSR":
+        if stimdict["bar.orientation"][epoch] == 0:
+            positions = position_x(stimdict, epoch, screen_width, distance, config.SEED)
+        else:
+            positions = position_y(stimdict, epoch, screen_width, distance, config.SEED)
+        return (stimdict["bar.duration"][epoch] + stimdict["bg.duration"][epoch]) * len(positions)
+    elif stimtype == "N":
+        return stimdict["texture.duration"][epoch] * (texture_count or 0)
+    else:
+        return stimdict["duration"][epoch]
+
+def session_runtime(stimdict, maxruntime):
+    """Returns the duration in seconds of a session: the MAXRUNTIME of the
+    stimulus file, if any, limited by the global maxruntime.
+    """
+    if stimdict["MAXRUNTIME"]:
+        return min(maxruntime, stimdict["MAXRUNTIME"])
+    return maxruntime
+
+def epoch_schedule(stimdict, maxruntime, screen_width, distance, seed, texture_count=None):
+    """Materialises the complete epoch order of a session up front.
+
+    The presentation order is the same as the one `choose_epoch` produces
+    from `shuffle_epochs`: the shuffled order is repeated until the summed
+    duration of the epochs reaches maxruntime. Shuffling uses the
+    epoch_order stream seeded with seed (see rng), so a session can be
+    reproduced.
+
+    :param stimdict: The stimulus dictionary.
+    :type stimdict: dict
+    :param maxruntime: Duration of the session in seconds.
+    :type maxruntime: float
+    :param seed: Seed for shuffling the epochs.
+    :type seed: Integer
+    :returns: numpy integer array with one epoch index per presented epoch.
+
+    """
+    randomize = randomization_mode(stimdict)
+    no_epochs = stimdict["EPOCHS"]
+    random_state = RandomStreams(seed, stimdict.get("RNG_MODE")).random_state('epoch_order')
+    index = shuffle_epochs(randomize, no_epochs, random_state)[:, 0]
+
+    # One cycle of the presentation order
+    if randomize == 1.0:
+        # every 2nd epochchoose == 0
+        cycle = numpy.zeros(2*len(index), dtype=int)
+        cycle[1::2] = index
+        if not len(cycle):
+            cycle = numpy.zeros(1, dtype=int)
+    else:
+        cycle = index
+
+    durations = numpy.array([epoch_duration(stimdict, e, screen_width, distance, texture_count)
+                             for e in range(no_epochs)], dtype=float)
+    cycle_duration = durations[cycle].sum()
+    if cycle_duration <= 0:
+        return cycle
+
+    # Enough cycles to fill maxruntime, cut after the epoch that reaches it
+    n_cycles = int(numpy.ceil(maxruntime / cycle_duration)) or 1
+    schedule = numpy.tile(cycle, n_cycles)
+    end_times = numpy.cumsum(durations[schedule])
+    last = numpy.searchsorted(end_times, maxruntime)
+
+    return schedule[:last+1]
+
 def choose_epoch(index,randomize,no_epochs,current_index):
     """Shuffles the epoch sequence according to the randomize option.
 
@@ -309,20 +553,15 @@ def choose_epoch(index,randomize,no_epochs,current_index):
     if randomize == 0.0 or randomize == 2.0:
         epochchoose = index.item((current_index,0))
         current_index = (current_index+1) % no_epochs
-        print('---------------------')
-        print('Presented epoch: {}'.format(epochchoose))
 
     elif randomize == 1.0:
          # every 2nd epochchoose == 0
         if (current_index % 2) == 1:
             epochchoose = index.item(int((current_index-1)/2),0)
-            print('---------------------')
-            print('Presented epoch: {}'.format(epochchoose))
         else:
             epochchoose = 0
-            print('---------------------')
-            print('Presented epoch: {}'.format(epochchoose))
         current_index = (current_index+1) % (2*(no_epochs-1))
+    stimlog.log('epoch', '---------------------\nPresented epoch: {epoch}', epoch=epochchoose)
 
     return (epochchoose, current_index)
 
@@ -393,6 +632,99 @@ def set_intensity(epoch,value):
 
     return intensity
 
+def epoch_colors(stimdict):
+
+    """ Returns the backgroung (bg) and foreground (fg) colors per epoch
+    It calls the functions for gamma correction and 6-bit depth transformation
+
+    :param stimdict: stimulus dictionary
+    :type stimdict: dict
+    :returns: bg_ls, fg_ls. Lists with one RGB color in range [-1,1] per epoch
+
+    """
+    bg_ls = list()
+    fg_ls = list()
+    for e in range(stimdict["EPOCHS"]):
+
+        # Setting stimulus backgroung (bg) and foreground (fg) colors
+        try:
+            if stimdict["lum"][e] == 111:
+                # Gamma correction and 6-bit depth transformation
+                bg = set_intensity(e,stimdict["bg"][e])
+                fg = set_intensity(e,stimdict["fg"][e])
+                bg_ls.append(bg)
+                fg_ls.append(fg)
+
+            elif stimdict["lum"][e] or stimdict["contrast"][e]:
+                # Gamma correction and 6-bit depth transformation
+                bg = set_bgcol(stimdict["lum"][e],stimdict["contrast"][e])
+                fg = set_fgcol(stimdict["lum"][e],stimdict["contrast"][e])
+                bg_ls.append(bg)
+                fg_ls.append(fg)
+
+            else:
+                # Gamma correction and 6-bit depth transformation
+                bg = set_intensity(e,stimdict["bg"][e])
+                fg = set_intensity(e,stimdict["fg"][e])
+                bg_ls.append(bg)
+                fg_ls.append(fg)
+
+        except:
+            # Gamma correction and 6-bit depth transformation
+            bg = set_intensity(e,stimdict["bg"][e])
+            fg = set_intensity(e,stimdict["fg"][e])
+            bg_ls.append(bg)
+            fg_ls.append(fg)
+
+    return bg_ls, fg_ls
+
+def rename_stimtypes(stimdict):
+
+    """ Adjusts old stim names to new ones (in place)
+
+    :param stimdict: stimulus dictionary
+    :type stimdict: dict
+
+    """
+    for s, stimtype in enumerate(stimdict["stimtype"]):
+        if stimtype in ("stripe(s)", "stripe"):
+            stimdict["stimtype"][s] = "SSR"
+
+        elif stimtype == "circle":
+            stimdict["stimtype"][s] = "C"
+
+        elif stimtype == "noisy_circle":
+            stimdict["stimtype"][s] = "NC"
+
+        elif stimtype == "driftingstripe":
+            stimdict["stimtype"][s] = "DS"
+
+        elif stimtype == "noise":
+            stimdict["stimtype"][s] = "N"
+
+        elif stimtype == "grating":
+            stimdict["stimtype"][s] = "G"
+
+        elif stimtype == "dottygrating":
+            stimdict["stimtype"][s] = "DG"
+
+def stimulus_units(stimdict):
+
+    """ Returns the units of the stimulus objects, depending on PERSPECTIVE_CORRECTION """
+
+    if stimdict["PERSPECTIVE_CORRECTION"] == 1:
+        return 'deg' # Keep in "deg" when using the warper.
+
+    elif stimdict["PERSPECTIVE_CORRECTION"] == 2:
+        # Every vertex is corrected for perspective (no warper needed).
+        # See perspective_correction.deg2cmPerspective
+        return 'degPerspective'
+
+    else:
+        #'degFlatPos' is the correct unit for having a correct screen size
+        # in degrees when the perspective is not corrected by the warper.
+        return 'degFlatPos'
+
 def get_dlpcol(DLPintensity,channel):
 
     """ Gamma correction
@@ -537,7 +869,7 @@ def position_x(stimdict, epoch, screen_width, distance, seed):
 
 
     xpos = numpy.arange(xmin, xmax, bar_distance)
-    seeder = numpy.random.RandomState(seed)
+    seeder = RandomStreams(seed, stimdict.get("RNG_MODE")).random_state('positions', epoch)
     seeder.shuffle(xpos)
 
     return xpos
@@ -588,7 +920,7 @@ def position_y(stimdict, epoch, screen_width, distance, seed):
 
     ypos = numpy.arange(ymin, ymax, bar_distance)
     ypos = ypos*-1 #-1 to move downswards with the stimulus
-    seeder = numpy.random.RandomState(seed)
+    seeder = RandomStreams(seed, stimdict.get("RNG_MODE")).random_state('positions', epoch)
     seeder.shuffle(ypos)
 
 
@@ -599,6 +931,8 @@ def window_3masks(win,_monitor = 'testMonitor'):
     from psychopy import visual
 
     '''
+    OLD, deprecated. Use masking.WindowMask, which masks inside the main window.
+
     Draws mask of for a screen, so that the smaller screen is insede the big
     one like the scheme: the center (C) at the top of the small screen is in
     the center of the big one and that the big screen fills all the resolution
@@ -648,10 +982,42 @@ def window_3masks(win,_monitor = 'testMonitor'):
 
 def set_edge_position_and_direction(bar,scr_width,scr_distance,exp_Info,direction):
 
+    """ Places the bar at the screen edge it starts drifting from.
+
+    See `edge_position_and_direction`. Sets bar.pos and returns the direction name.
+
+    """
+    pos, direction = edge_position_and_direction(bar.width, bar.ori, scr_width,
+                                                 scr_distance, exp_Info['WinMasks'],
+                                                 direction, pos=bar.pos)
+    bar.pos = pos
+
+    return direction
+
+def edge_position_and_direction(width,ori,scr_width,scr_distance,win_masks,direction,pos=(0.0,0.0)):
+
+    """ Returns the initial position of a drifting bar and the name of its direction.
+
+    It does not touch any stimulus object, so it can be computed in advance
+    (e.g. while the previous epoch is still being presented).
+
+    :param width: bar width
+    :type width: float
+    :param ori: bar orientation (0, 90, 45 or 135)
+    :type ori: float
+    :param win_masks: whether the window is masked (see exp_Info['WinMasks'])
+    :type win_masks: int
+    :param direction: either 1 or -1
+    :type direction: float
+    :param pos: position kept if the orientation is not compatible
+    :type pos: tuple
+    :returns: (pos, direction name)
+
+    """
+
     #Getting screen visual angles
     maxhorang = max_angle_from_center(scr_width, scr_distance)
     maxverang = max_angle_from_center(scr_width, scr_distance)
-    #bar.width = maxhorang*2
     maxhorang = maxhorang * direction # x_position should be either 1 or -1
     maxverang = maxverang * direction # x_position should be either 1 or -1
 
@@ -659,86 +1025,85 @@ def set_edge_position_and_direction(bar,scr_width,scr_distance,exp_Info,directio
     #It considers the edge of the screen = (maxhorang)
     #and the half width of the rectangle = (stimdict["spacing"][epoch]/2)
     if maxhorang  > 0:
-        shift_pos = (maxhorang) + (bar.width/2)
+        shift_pos = (maxhorang) + (width/2)
     elif maxhorang  < 0:
-        shift_pos = (maxhorang) - (bar.width/2)
+        shift_pos = (maxhorang) - (width/2)
 
     # Adusting the initial position of the stimulus based on bar orientation
-    if bar.ori == 0: #vertical bar
-        bar.pos = (shift_pos, 0.0)
-    elif bar.ori == 90: #horizontal bar
-        bar.pos = (0.0,shift_pos)
-    elif bar.ori == 45:
-        bar.pos = (-shift_pos, shift_pos)
-    elif bar.ori == 135:
-        bar.pos = (shift_pos, shift_pos)
+    if ori == 0: #vertical bar
+        pos = (shift_pos, 0.0)
+    elif ori == 90: #horizontal bar
+        pos = (0.0,shift_pos)
+    elif ori == 45:
+        pos = (-shift_pos, shift_pos)
+    elif ori == 135:
+        pos = (shift_pos, shift_pos)
     else:
-        print('Bar orientation not compatible')
+        stimlog.log('edge', 'Bar orientation not compatible: {ori}', ori=ori)
 
-    if exp_Info['WinMasks']:
+    if win_masks:
         scr_width = scr_width/2
         #Recalculating only the maxhorang
         maxhorang = max_angle_from_center(scr_width, scr_distance)
         maxhorang = maxhorang * direction # x_position should be either 1 or -1
-        #bar.width = maxhorang*2
 
         # Recheck these calculations
         if direction  > 0:
-            shift_pos = (maxhorang) + (bar.width/2)
-            shift_x_pos = maxverang + (bar.width/2)
-            shift_y_pos = maxverang + (bar.width/2)
+            shift_pos = (maxhorang) + (width/2)
+            shift_x_pos = maxverang + (width/2)
+            shift_y_pos = maxverang + (width/2)
         elif direction  < 0:
-            shift_pos = (maxhorang) - (bar.width/2)
-            shift_x_pos = maxverang - (bar.width/2)
-            shift_y_pos = maxverang - (bar.width/2)
+            shift_pos = (maxhorang) - (width/2)
+            shift_x_pos = maxverang - (width/2)
+            shift_y_pos = maxverang - (width/2)
 
         # Adusting the initial position of the stimulus based on bar orientation
-        if bar.ori == 0: #vertical bar
-            bar.pos = (shift_pos, 0.0)
-            print(f'Going lateral from: {bar.pos}')
-        elif bar.ori == 90: #horizontal bar
+        if ori == 0: #vertical bar
+            pos = (shift_pos, 0.0)
+            stimlog.log('edge', 'Going lateral from: {pos}', pos=pos)
+        elif ori == 90: #horizontal bar
             if direction  > 0:
-                bar.pos = (0.0,(bar.width/2)) #bar will go down from here
-                print(f'Going down from: {bar.pos}')
+                pos = (0.0,(width/2)) #bar will go down from here
+                stimlog.log('edge', 'Going down from: {pos}', pos=pos)
             elif direction  < 0:
-                bar.pos = (0.0,shift_y_pos) #bar will go up from here
-                print(f'Going up from: {bar.pos}')
+                pos = (0.0,shift_y_pos) #bar will go up from here
+                stimlog.log('edge', 'Going up from: {pos}', pos=pos)
 
         # IMPORTANT 45 and 135 agles still have a bug. Rethink!
-        elif bar.ori == 45:
+        elif ori == 45:
             if direction  > 0:
-                bar.pos = (-shift_x_pos, (bar.width/2))
-                print(f'Going right-down from: {bar.pos}')
+                pos = (-shift_x_pos, (width/2))
+                stimlog.log('edge', 'Going right-down from: {pos}', pos=pos)
             elif direction  < 0:
-                bar.pos = (-shift_x_pos, shift_y_pos)
-                print(f'Going left-up from: {bar.pos}')
-        elif bar.ori == 135:
+                pos = (-shift_x_pos, shift_y_pos)
+                stimlog.log('edge', 'Going left-up from: {pos}', pos=pos)
+        elif ori == 135:
             if direction  > 0:
-                print(f'Going left-down from: {bar.pos}')
-                bar.pos = (shift_x_pos, (bar.width/2))
+                stimlog.log('edge', 'Going left-down from: {pos}', pos=pos)
+                pos = (shift_x_pos, (width/2))
             elif direction  < 0:
-                bar.pos = (shift_pos, shift_y_pos)
-                print(f'Going rigth-up from: {bar.pos}')
+                pos = (shift_pos, shift_y_pos)
+                stimlog.log('edge', 'Going rigth-up from: {pos}', pos=pos)
         else:
-            print('Bar orientation not compatible')
+            stimlog.log('edge', 'Bar orientation not compatible: {ori}', ori=ori)
 
 
     #Assigning directionality to the epoch
-    if bar.pos[0] > 0 and bar.pos[1] < 0:
+    if pos[0] > 0 and pos[1] < 0:
          direction = "left-up"
-    elif bar.pos[0] < 0 and bar.pos[1] > 0:
+    elif pos[0] < 0 and pos[1] > 0:
          direction = "right-down"
-    elif bar.pos[0] < 0 and bar.pos[1] < 0:
+    elif pos[0] < 0 and pos[1] < 0:
          direction = "right-up"
-    elif bar.pos[0] > 0 and bar.pos[1] > 0:
+    elif pos[0] > 0 and pos[1] > 0:
          direction = "left-down"
-    elif bar.pos[0] < 0:
+    elif pos[0] < 0:
         direction = "right"
-    elif bar.pos[0] > 0:
+    elif pos[0] > 0:
         direction = "left"
-    elif bar.pos[1] < 0:
+    elif pos[1] < 0:
         direction = "up"
-    elif bar.pos[1] > 0:
+    elif pos[1] > 0:
         direction = "down"
 
-    return direction
+    return (pos, direction)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Masking of parts of the projected image inside the main window.
+
+The mask is a set of polygons defined in ``config.MASK_POLYGONS``. They are
+rasterized once into an RGBA texture (black, opaque where masked and fully
+transparent elsewhere), cached on disk and drawn as a single full-window quad
+right after the warper has blitted the frame buffer to the back buffer.
+This replaces the three extra windows of ``helper.window_3masks``.
+
+"""
+
+import os
+import ctypes
+import hashlib
+import numpy
+
+try:
+    import pyglet.gl as GL
+except Exception: # No OpenGL (e.g. headless export), only the rasterizer can be used
+    GL = None
+
+from modules import config
+
+
+def polygon_mask(polygons, width, height):
+
+    """ Rasterizes polygons into a boolean mask (True = masked).
+
+    Polygons are given in normalized window coordinates: (0,0) is the
+    bottom-left and (1,1) the top-right corner of the window. A pixel is
+    masked if its center lies inside any polygon (even-odd rule).
+
+    :param polygons: list of polygons, each one a list of (x,y) vertices
+    :type polygons: list
+    :param width: window width in pixels
+    :type width: int
+    :param height: window height in pixels
+    :type height: int
+    :returns: NumPy bool array of shape (height, width), row 0 at the bottom
+
+    """
+    xs = (numpy.arange(width) + 0.5) / width
+    ys = (numpy.arange(height) + 0.5) / height
+    px = xs[numpy.newaxis, :]
+    py = ys[:, numpy.newaxis]
+
+    mask = numpy.zeros((height, width), dtype=bool)
+    for polygon in polygons:
+        vertices = numpy.asarray(polygon, dtype=float)
+        inside = numpy.zeros((height, width), dtype=bool)
+        x0, y0 = vertices[:, 0], vertices[:, 1]
+        x1, y1 = numpy.roll(x0, -1), numpy.roll(y0, -1)
+        for xa, ya, xb, yb in zip(x0, y0, x1, y1):
+            if ya == yb:
+                continue # horizontal edges never cross a horizontal ray
+            crosses = (ya > py) != (yb > py)
+            x_cross = xa + (py - ya) * (xb - xa) / (yb - ya)
+            inside ^= crosses & (px < x_cross)
+        mask |= inside
+
+    return mask
+
+
+def mask_texture(polygons, width, height, cache_dir=None):
+
+    """ Returns the RGBA mask texture, loading it from the cache if possible.
+
+    :param polygons: list of polygons (see `polygon_mask`)
+    :type polygons: list
+    :param width: window width in pixels
+    :type width: int
+    :param height: window height in pixels
+    :type height: int
+    :param cache_dir: directory to store the texture. None disables caching
+    :type cache_dir: path
+    :returns: NumPy uint8 array of shape (height, width, 4)
+
+    """
+    width, height = int(width), int(height)
+    key = hashlib.sha1(repr((width, height, polygons)).encode()).hexdigest()[:16]
+
+    cache_file = None
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, f'mask_{width}x{height}_{key}.npy')
+        if os.path.exists(cache_file):
+            return numpy.load(cache_file)
+
+    rgba = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+    rgba[:, :, 3] = polygon_mask(polygons, width, height) * 255
+
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        numpy.save(cache_file, rgba)
+
+    return rgba
+
+
+class WindowMask(object):
+    """ Draws the precomputed mask texture on top of the (warped) frame.
+
+    It hooks into ``win._renderFBO``, the same extension point the psychopy
+    ``Warper`` uses. Therefore it has to be created AFTER the warper.
+
+        :param win: The window to be masked. Needs useFBO = True
+        :type win: visual.Window
+        :param polygons: list of polygons (see `polygon_mask`)
+        :type polygons: list
+
+    """
+
+    def __init__(self, win, polygons=None, cache_dir=None):
+        if polygons is None:
+            polygons = config.MASK_POLYGONS
+        if cache_dir is None:
+            cache_dir = config.CACHE_DIR
+
+        self.win = win
+        self.polygons = polygons
+        self.rgba = mask_texture(polygons, win.size[0], win.size[1], cache_dir)
+
+        # Uploading the texture only once
+        self.texture_id = GL.GLuint()
+        GL.glGenTextures(1, ctypes.byref(self.texture_id))
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture_id)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA,
+                        self.rgba.shape[1], self.rgba.shape[0], 0,
+                        GL.GL_RGBA, GL.GL_UNSIGNED_BYTE,
+                        self.rgba.ctypes.data_as(ctypes.POINTER(GL.GLubyte)))
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+        # monkey patch the blit of the frame buffer (warped or not)
+        self._renderFBO = win._renderFBO
+        win._renderFBO = self.drawMasked
+
+    def drawMasked(self):
+        """ Blits the frame (through the warper, if any) and draws the mask
+        on top of it, in the same pass.
+        """
+        self._renderFBO()
+
+        GL.glUseProgram(0)
+        GL.glEnable(GL.GL_BLEND)
+        GL.glBlendFunc(GL.GL_SRC_ALPHA, GL.GL_ONE_MINUS_SRC_ALPHA)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture_id)
+        GL.glColor4f(1.0, 1.0, 1.0, 1.0)
+
+        GL.glBegin(GL.GL_QUADS)
+        GL.glTexCoord2f(0.0, 0.0)
+        GL.glVertex2f(-1.0, -1.0)
+        GL.glTexCoord2f(0.0, 1.0)
+        GL.glVertex2f(-1.0, 1.0)
+        GL.glTexCoord2f(1.0, 1.0)
+        GL.glVertex2f(1.0, 1.0)
+        GL.glTexCoord2f(1.0, 0.0)
+        GL.glVertex2f(1.0, -1.0)
+        GL.glEnd()
+
+        # Restoring the state the window expects after _renderFBO()
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.win.frameTexture)
+        GL.glDisable(GL.GL_BLEND)
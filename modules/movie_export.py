@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Export of stimulus files as movies, without a window.
+
+Frames come from the offscreen renderer (see ``rendering``) chunk by chunk,
+already in 8 bit, and are written straight away, so memory use only depends
+on the chunk size (rendering.CHUNK_FRAMES) and not on the length of the
+stimulus. Optionally, the perspective
+correction of the warper and the window masks are applied on the CPU, as
+main does on the screen.
+
+Two output formats:
+
+- a video file (.mp4, .avi, .gif, ...) written with imageio (optional
+  dependency), plus a ``<name>_epochs.npy`` file with the epoch of every frame
+- a directory of chunked arrays: ``frames_00000.npy`` (uint8, shape
+  (n, height, width, 3)) and ``epochs_00000.npy`` per chunk. They can be read
+  back with `read_chunks`, memory-mapped.
+
+"""
+
+import os
+import glob
+import numpy as np
+
+from modules.helper import Stimulus
+from modules.rendering import OffscreenRenderer, CHUNK_FRAMES
+from modules.masking import polygon_mask
+from modules import warp_mesh
+from modules import config
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.gif')
+
+
+class FrameWarper(object):
+    """ Applies the perspective correction of the warper to rendered frames.
+
+    The mesh is the one main uses (cached warpfile, see
+    `warp_mesh.get_warpfile`), turned once into a per-pixel lookup table
+    applied to uint8 frames (black outside the mesh).
+
+        :param warp: 'spherical' or 'cylindrical'
+        :type warp: str
+        :param eyepoint: eye position, [0.5, 0.5] is the screen center
+        :type eyepoint: list
+        :param size: frame size in pixels (width, height)
+        :type size: tuple
+
+    """
+
+    def __init__(self, warp, eyepoint, screen_width, distance, size,
+                 gridsize=None, cache_dir=None):
+        if gridsize is None:
+            gridsize = config.WARP_GRIDSIZE
+        if cache_dir is None:
+            cache_dir = config.CACHE_DIR
+        warpfile = warp_mesh.get_warpfile(warp, eyepoint, screen_width, distance,
+                                          gridsize, size, cache_dir)
+        x, y, u, v, opacity = warp_mesh.read_warpfile(warpfile)
+        self.rows, self.cols, self.valid = warp_mesh.remap_indices(x, y, u, v, size[0], size[1])
+
+    def __call__(self, frames):
+        warped = frames[:, self.rows, self.cols]
+        warped[:, ~self.valid] = 0
+        return warped
+
+
+class ChunkWriter(object):
+    """ Writes every chunk of frames to its own .npy file in a directory """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.chunk = 0
+
+    def write(self, epochs, frames):
+        np.save(os.path.join(self.directory, 'frames_%05d.npy' % self.chunk), frames)
+        np.save(os.path.join(self.directory, 'epochs_%05d.npy' % self.chunk), epochs)
+        self.chunk += 1
+
+    def close(self):
+        pass
+
+
+class VideoWriter(object):
+    """ Appends the frames to a video file (needs imageio) """
+
+    def __init__(self, filename, fps):
+        import imageio # optional, only needed for video files
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        kwargs = {} if filename.endswith('.gif') else {'macro_block_size': 1}
+        self.filename = filename
+        self._writer = imageio.get_writer(filename, fps=fps, **kwargs)
+        self._epochs = []
+
+    def write(self, epochs, frames):
+        for frame in frames:
+            self._writer.append_data(frame)
+        self._epochs.append(np.array(epochs)) # the renderer reuses its arrays
+
+    def close(self):
+        self._writer.close()
+        epochs = np.concatenate(self._epochs) if self._epochs else np.zeros(0, dtype=int)
+        np.save(os.path.splitext(self.filename)[0] + '_epochs.npy', epochs)
+
+
+def read_chunks(directory):
+
+    """ Yields (epochs, frames) of a movie written as chunked arrays.
+    Frames are memory-mapped, not loaded.
+    """
+    for frames_file in sorted(glob.glob(os.path.join(directory, 'frames_*.npy'))):
+        epochs_file = frames_file.replace('frames_', 'epochs_')
+        yield np.load(epochs_file), np.load(frames_file, mmap_mode='r')
+
+
+def export_movie(stimfile, output, size=(500, 500), view_scale=(1, 1), warp=None,
+                 eyepoint=(0.5, 0.5), win_masks=0, chunk_size=CHUNK_FRAMES, maxruntime=None):
+
+    """ Renders a stimulus file and streams its frames to a movie.
+
+    :param stimfile: stimulus file
+    :type stimfile: path
+    :param output: video file (see VIDEO_EXTENSIONS) or directory for chunked arrays
+    :type output: path
+    :param size: window size in pixels (width, height)
+    :param view_scale: as the viewScale of the window
+    :param warp: None, 'spherical' or 'cylindrical'. As in main, the warp is
+        only applied to stimulus files with PERSPECTIVE_CORRECTION 1
+    :param eyepoint: eye position for the warp
+    :param win_masks: as exp_Info['WinMasks']
+    :param chunk_size: number of frames rendered and written at once
+    :param maxruntime: duration in seconds. By default the one of main
+    :returns: number of frames written
+
+    """
+    stimdict = Stimulus(stimfile).dict
+    renderer = OffscreenRenderer(stimdict, size=size, view_scale=view_scale, win_masks=win_masks)
+
+    warper = None
+    if warp and renderer.perspective_correction == 1:
+        warper = FrameWarper(warp, eyepoint, renderer.screen_width, renderer.distance,
+                             renderer.size)
+    mask = None
+    if win_masks:
+        mask = polygon_mask(config.MASK_POLYGONS, renderer.size[0], renderer.size[1])[::-1]
+
+    if os.path.splitext(output)[1].lower() in VIDEO_EXTENSIONS:
+        writer = VideoWriter(output, renderer.framerate)
+    else:
+        writer = ChunkWriter(output)
+
+    n_frames = 0
+    try:
+        for epochs, frames in renderer.render(renderer.schedule(maxruntime), chunk_size):
+            if warper is not None:
+                frames = warper(frames)
+            if mask is not None:
+                frames[:, mask] = 0
+            writer.write(epochs, frames)
+            n_frames += len(frames)
+    finally:
+        writer.close()
+
+    return n_frames
@@ -1,17 +1,101 @@
-from numpy import array, radians, zeros, hypot, tan
-from psychopy import monitors
+import weakref
+from numpy import array, asarray, radians, empty, ones, hypot, tan, column_stack
+from psychopy import logging
+from psychopy.tools import monitorunittools
+from psychopy.visual.windowwarp import Warper
+
+from modules import warp_mesh
+
+
+class CachedWarper(Warper):
+    """ psychopy Warper with vectorized mesh creation.
+
+    The spherical and cylindrical meshes, as well as the meshes read from a
+    warpfile, are turned into quads without the per-vertex Python loops of
+    the original class. Use it together with `warp_mesh.get_warpfile` and
+    warp='warpfile' to load a cached mesh instead of recomputing it.
+
+    """
+
+    def projectionSphericalOrCylindrical(self, isCylindrical=False):
+        """Correct perspective on flat screen using either a spherical or
+        cylindrical projection.
+        """
+        warp = 'cylindrical' if isCylindrical else 'spherical'
+        grids = warp_mesh.warp_grid(warp, self.eyepoint, self.mon_width_cm,
+                                    self.mon_height_cm, self.dist_cm,
+                                    self.xgrid, self.ygrid)
+        self._createQuads(*grids)
+
+    def projectionWarpfile(self):
+        """Use a warp definition file to create the projection.
+        """
+        try:
+            grids = warp_mesh.read_warpfile(self.warpfile)
+        except Exception:
+            error = 'Unable to read warpfile: ' + str(self.warpfile)
+            logging.warning(error)
+            print(error)
+            return
+
+        self.ygrid, self.xgrid = grids[0].shape
+        self._createQuads(*grids)
+
+    def _createQuads(self, x, y, u, v, opacity=None):
+        self.nverts = (self.xgrid - 1) * (self.ygrid - 1) * 4
+        if opacity is None:
+            qx, qy, qu, qv = warp_mesh.grid_to_quads(x, y, u, v)
+        else:
+            qx, qy, qu, qv, qa = warp_mesh.grid_to_quads(x, y, u, v, opacity)
+            # opacity is RGBA, only alpha is used
+            opacity = ones((qa.shape[0], 4), 'float32')
+            opacity[:, 3] = qa
+        vertices = column_stack([qx, qy]).astype('float32')
+        tcoords = column_stack([qu, qv]).astype('float32')
+        self.createVertexAndTextureBuffers(vertices, tcoords, opacity)
+
+
+_monitor_geometry = weakref.WeakKeyDictionary()
+
+def monitor_geometry(monitor):
+    """Returns (distance cm, width cm, size pix) of a Monitor object.
+
+    Values are read only once per Monitor object and cached afterwards,
+    since they are needed for every vertex conversion of every frame.
+    Call `clear_monitor_geometry` after changing the monitor settings.
+    """
+    try:
+        return _monitor_geometry[monitor]
+    except (KeyError, TypeError):
+        pass
+    # check we have a monitor
+    if not hasattr(monitor, 'getDistance'):
+        msg = ("deg2cm requires a monitors.Monitor object as the second "
+               "argument but received %s")
+        raise ValueError(msg % str(type(monitor)))
+    geometry = (monitor.getDistance(), monitor.getWidth(), monitor.getSizePix())
+    try:
+        _monitor_geometry[monitor] = geometry
+    except TypeError:
+        pass # not weak-referenceable, do not cache
+    return geometry
+
+def clear_monitor_geometry():
+    _monitor_geometry.clear()
 
 
 def _degPerspective2pix(vertices, pos, win):
     return deg2pixPerspective(array(pos) + array(vertices), win.monitor,
                    correctFlat=True)
 
+# Makes units='degPerspective' available for every stimulus
+monitorunittools.addUnitTypeConversion('degPerspective', _degPerspective2pix)
+
 def deg2pixPerspective(degrees, monitor, correctFlat=False):
     """Convert size in degrees to size in pixels for a given Monitor object
     """
     # get monitor params and raise error if necess
-    scrWidthCm = monitor.getWidth()
-    scrSizePix = monitor.getSizePix()
+    dist, scrWidthCm, scrSizePix = monitor_geometry(monitor)
     if scrSizePix is None:
         msg = "Monitor %s has no known size in pixels (SEE MONITOR CENTER)"
         raise ValueError(msg % monitor.name)
@@ -20,85 +104,42 @@ def deg2pixPerspective(degrees, monitor, correctFlat=False):
         raise ValueError(msg % monitor.name)
 
     cmSize = deg2cmPerspective(degrees, monitor, correctFlat)
-    #print cmSize * scrSizePix[0] / float(scrWidthCm)
 
-    return cmSize * scrSizePix[0] / float(scrWidthCm)
+    return cmSize * (scrSizePix[0] / float(scrWidthCm))
 
 
 def deg2cmPerspective(degrees, monitor, correctFlat=False):
-    """Convert size in degrees to size in pixels for a given Monitor object.
+    """Convert size in degrees to size in cm for a given Monitor object.
     If `correctFlat == False` then the screen will be treated as if all
     points are equal distance from the eye. This means that each "degree"
     will be the same size irrespective of its position.
-    If `correctFlat == True` then the `degrees` argument must be an Nx2 matrix
-    for X and Y values (the two cannot be calculated separately in this case).
+    If `correctFlat == True` then the `degrees` argument must be a pair or
+    an Nx2 matrix (any N) for X and Y values (the two cannot be calculated
+    separately in this case). All vertices are converted in one go.
     With `correctFlat == True` the positions may look strange because more
     eccentric vertices will be spaced further apart.
     """
-    # check we have a monitor
-    if not hasattr(monitor, 'getDistance'):
-        msg = ("deg2cm requires a monitors.Monitor object as the second "
-               "argument but received %s")
-        raise ValueError(msg % str(type(monitor)))
-    # get monitor dimensions
-    dist = monitor.getDistance()
+    dist = monitor_geometry(monitor)[0]
     # check they all exist
     if dist is None:
         msg = "Monitor %s has no known distance (SEE MONITOR CENTER)"
         raise ValueError(msg % monitor.name)
     if correctFlat:
-        rads = radians(degrees)
-        cmXY = zeros(rads.shape, 'd')  # must be a double (not float)
-        if rads.shape == (2,):
-            x, y = rads
-            cmXY[0] = hypot(dist, tan(y) * dist) * tan(x)
-            cmXY[1] = hypot(dist, tan(x) * dist) * tan(y)
-            # edit this: change cmXY[1:0]
-        elif  rads.shape[0] >= 4 and rads.shape[1] == 2:
-            # It doesn't paint it like that :( 
-            ##########################
-            monitor_height = monitors.Monitor('testMonitor').getSizePix()[1] # bad, hard-coded, in cm
-            monitor_width = monitors.Monitor('testMonitor').getSizePix()[0]
-            monitor_width_cm = monitors.Monitor('testMonitor').getWidth()
-            pix_size = monitor_width_cm / monitor_width
-            monitor_height_cm = monitor_height * pix_size
-            
-            # X
-            #cmXY[0, 0] = hypot(hypot(dist, monitor_height_cm), tan(rads[0, 1]) * dist) * tan(rads[0, 0])-10
-            cmXY[0, 0] = hypot(dist, monitor_height_cm) * tan(rads[0, 0])
-            #cmXY[1, 0] = hypot(dist, tan(rads[1, 1]) * dist) * tan(rads[1, 0])
-            cmXY[1, 0] = dist * tan(rads[1, 0])
-            #cmXY[2, 0] = hypot(dist, tan(rads[2, 1]) * dist) * tan(rads[2, 0])
-            cmXY[2, 0] = dist * tan(rads[2, 0])
-            #cmXY[3, 0] = hypot(hypot(dist, monitor_height_cm), tan(rads[3, 1]) * dist) * tan(rads[3, 0])
-            cmXY[3, 0] = hypot(dist, monitor_height_cm) * tan(rads[3, 0])
-            
-            # Y
-            cmXY[0, 1] = hypot(hypot(dist, monitor_height_cm), tan(rads[0, 0]) * dist) * tan(rads[0, 1])
-            cmXY[1, 1] = hypot(dist, tan(rads[1, 0]) * dist) * tan(rads[1, 1])
-            cmXY[2, 1] = hypot(dist, tan(rads[2, 0]) * dist) * tan(rads[2, 1])
-            cmXY[3, 1] = hypot(hypot(dist, monitor_height_cm), tan(rads[3, 0]) * dist) * tan(rads[3, 1])
-            
-            print (cmXY)
-        #elif len(rads.shape) > 1 and rads.shape[1] == 2:
-            #cmXY[:, 0] = hypot(dist, tan(rads[:, 1]) * dist) * tan(rads[:, 0])
-            #cmXY[:, 1] = hypot(dist, tan(rads[:, 0]) * dist) * tan(rads[:, 1])
-            #print cmXY
-            #pass
-        else:
+        rads = radians(asarray(degrees, dtype='d'))
+        if rads.ndim not in (1, 2) or rads.shape[-1] != 2:
             msg = ("If using deg2cm with correctedFlat==True then degrees "
                    "arg must have shape [N,2], not %s")
             raise ValueError(msg % (repr(rads.shape)))
+        tanXY = tan(rads)
+        cmXY = empty(rads.shape, 'd')  # must be a double (not float)
+        cmXY[..., 0] = hypot(dist, tanXY[..., 1] * dist) * tanXY[..., 0]
+        cmXY[..., 1] = hypot(dist, tanXY[..., 0] * dist) * tanXY[..., 1]
         # derivation:
         #    if hypotY is line from eyeball to [x,0] given by
         #       hypot(dist, tan(degX))
         #    then cmY is distance from [x,0] to [x,y] given by
         #       hypotY * tan(degY)
         #    similar for hypotX to get cmX
-        # alternative:
-        #    we could do this by converting to polar coords, converting
-        #    deg2cm and then going back to cartesian,
-        #    but this would be slower(?)
         return cmXY
     else:
         # the size of 1 deg at screen centre
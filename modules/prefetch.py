@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Background preparation of the upcoming epochs of a session. """
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class EpochPrefetcher(object):
+    """ Prepares the resources of epoch N+1 while epoch N is being presented.
+
+    The preparation runs in a background thread and must not touch any
+    OpenGL resource (window, stimulus objects). Results are kept per epoch
+    index, since an epoch needs the same resources every time it is shown.
+
+        :param schedule: Epoch order of the whole session (see `helper.epoch_schedule`)
+        :type schedule: numpy integer array
+        :param prepare: Function taking an epoch index and returning its resources
+        :type prepare: callable
+        :param initializer: called first in the background thread (e.g. to pin
+            it to a core, see `realtime.RealtimeMode.helper_thread_initializer`)
+        :type initializer: callable
+
+    """
+
+    def __init__(self, schedule, prepare, initializer=None):
+        self.schedule = schedule
+        self.prepare = prepare
+        self._prepared = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, initializer=initializer)
+
+    def request(self, position):
+        """ Starts preparing the epoch at this position of the schedule """
+        if position < len(self.schedule):
+            epoch = int(self.schedule[position])
+            if epoch not in self._prepared:
+                self._prepared[epoch] = self._executor.submit(self.prepare, epoch)
+
+    def get(self, position):
+        """ Returns the resources of the epoch at this position of the schedule
+        (waiting for them if needed) and starts preparing the next one.
+        """
+        self.request(position)
+        prepared = self._prepared[int(self.schedule[position])].result()
+        self.request(position + 1)
+        return prepared
+
+    def close(self):
+        self._executor.shutdown(wait=False)
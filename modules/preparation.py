@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Preparation of the resources of an epoch before it is presented.
+
+Nothing here touches a window or a stimulus object (and psychopy is not
+imported), so these functions can run in a background thread while the
+previous epoch is presented, and are shared with the offscreen renderer.
+
+"""
+
+import numpy as np
+
+from modules.helper import *
+from modules import config
+from modules import dlp_pattern
+from modules.timing import seconds_to_frames, frame_rate
+from modules.textures import PROJECTOR_BITS, TERNARY_VALUES, noise_levels
+
+
+def prepare_field_flash(bg_ls,fg_ls,stim_texture,noise_arr,stimdict,epoch):
+
+    """ Computes everything field_flash needs before its first frame.
+
+    It does not touch any window or stimulus object, so it can run in
+    a background thread while the previous epoch is presented.
+
+    :returns: dict with space_ls, circle_texture, frame_shift, BG, FG and WC
+
+    """
+    prepared = {}
+
+    # "number"  and "interSpace" attributes are present in only some stimuli
+    space_ls = [] # Only implemented for vertical and horizontal bars (see bar.ori)
+    try:
+        stim_number = int(stimdict["number"][epoch])
+        inter_space = stimdict["interSpace"][epoch]
+        for i in range(stim_number):
+            if stim_number == 1:
+                space_ls.append(0.0)
+            else:
+                space_ls.append(inter_space * i)
+    except:
+        space_ls.append(0.0)
+    prepared['space_ls'] = space_ls
+
+    # generating texture for luminance values
+    prepared['circle_texture'] = None
+    prepared['frame_shift'] = 0
+    if stimdict["stimtype"][epoch] == 'NC':
+
+        wave_lenght = len(stim_texture[0]) # Lenght of the original wave
+        noise_arr = noise_arr[1,:,:] # Making lenghts of signal and noise the same
+
+        # Initialyzing the arrays with 1 wave, followed by all waves
+        long_wave = np.concatenate([stim_texture[0]] + list(stim_texture))
+        long_noise_arr = np.concatenate([noise_arr[0]] + list(noise_arr))
+
+        prepared['circle_texture'] = long_wave + long_noise_arr # Final texture (=lum values) to apply
+        frequency =  stimdict["frequency"][epoch] # Frequency to change lum values
+        framerate = frame_rate(stimdict) # Screen frame rate (see timing.frame_timing)
+        prepared['frame_shift'] = round((wave_lenght * frequency)/framerate)
+
+    # Information to print
+    BG=  ((bg_ls[epoch][2]+1)/2)/(63.0/255.0) # Scaling values back to a range of [0 1]
+    FG= ((fg_ls[epoch][2]+1)/2)/(63.0/255.0)  # Scaling values back to a range of [0 1]
+    WC = None
+    # The WC calculation only makes sense if the win values is being showed
+    if BG != 0.0 and stimdict["tau"][epoch] != stimdict["duration"][epoch]:
+        WC = (FG-BG)/BG
+    prepared['BG'], prepared['FG'], prepared['WC'] = BG, FG, WC
+
+    return prepared
+
+
+def prepare_standing_stripes_random(stimdict, epoch, scr_width, scr_distance):
+
+    """ Computes the shuffled bar positions and the bar/bg durations (in frames)
+    of a standing_stripes_random epoch. Safe to run in a background thread.
+
+    :returns: dict with positions, bar_duration and bg_duration
+
+    """
+    framerate = frame_rate(stimdict) # see timing.frame_timing
+    position_seed = config.SEED
+    prepared = {}
+    prepared['bar_duration'] = seconds_to_frames(stimdict["bar.duration"][epoch], framerate)
+    prepared['bg_duration'] = seconds_to_frames(stimdict["bg.duration"][epoch], framerate)
+
+    #Single bar, random locations
+    if stimdict["bar.orientation"][epoch] == 0:
+        prepared['positions'] = position_x(stimdict, epoch, screen_width=scr_width, distance=scr_distance, seed=position_seed)
+    elif stimdict["bar.orientation"][epoch] == 90:
+        prepared['positions'] = position_y(stimdict, epoch, screen_width=scr_width, distance=scr_distance, seed=position_seed)
+
+    return prepared
+
+
+def prepare_drifting_stripe(exp_Info, stimdict, epoch, scr_width, scr_distance):
+
+    """ Computes the initial bar position, the direction and the sister bars
+    of a drifting_stripe epoch. Safe to run in a background thread.
+
+    :returns: dict with pos, direction, init_pos, bar_number and space_ls
+
+    """
+    prepared = {}
+
+    # Setting edge positions
+    prepared['pos'], prepared['direction'] = edge_position_and_direction(
+        stimdict["bar.width"][epoch], stimdict["bar.orientation"][epoch],
+        scr_width, scr_distance, exp_Info['WinMasks'], stimdict["direction"][epoch])
+
+    # "bar.initPos" attribute are present in only some stimuli
+    try:
+        prepared['init_pos'] = stimdict["bar.initPos"][epoch]
+    except:
+        prepared['init_pos'] = None # In case the stim input file does not have an initial position, put it to the center
+
+    # "bar.number"  and "bar.interSpace" attributes are present in only some stimuli
+    space_ls = [] # Only implemented for vertical and horizontal bars (see bar.ori)
+    try:
+        bar_number = int(stimdict["bar.number"][epoch])
+        inter_space = stimdict["bar.interSpace"][epoch]
+        for i in range(bar_number):
+            if bar_number == 1:
+                space_ls.append(0.0)
+            else:
+                space_ls.append(inter_space * i)
+
+    except:
+        bar_number = 1
+        space_ls = [0.0]
+    prepared['bar_number'], prepared['space_ls'] = bar_number, space_ls
+
+    return prepared
+
+
+def prepare_stim_noise(stim_texture):
+
+    """ Noise texture stack for presentation. Safe to run in a background
+    thread.
+
+    :param stim_texture: uint8 levels, already scaled to the projector bit
+        depth (textures.noise_levels). Converted to rgb at upload
+    :returns: dict with the texture stack
+
+    """
+    return {'texture': stim_texture}
+
+
+def pattern_levels(stim_texture, stimdict):
+
+    """ Pattern levels of a noise texture stack in pattern mode
+
+    Ternary noise (TERNARY_TEXTURE) is mapped choice by choice to
+    dlp_pattern.ternary_levels, so gray stays half of bright; other noise
+    is quantized to the bit depth.
+
+    :param stim_texture: uint8 levels (textures.noise_levels)
+    :param stimdict: stimulus dictionary with PATTERN_BIT_DEPTH
+    :returns: uint8 array of pattern levels, same shape
+
+    """
+    bit_depth = stimdict["PATTERN_BIT_DEPTH"]
+    if stimdict.get("STIMULUSDATA") == "TERNARY_TEXTURE":
+        lookup = np.zeros(256, dtype=np.uint8)
+        lookup[noise_levels(np.array(TERNARY_VALUES))] = dlp_pattern.ternary_levels(bit_depth)
+        return lookup[stim_texture]
+    return dlp_pattern.quantize(stim_texture / float(2 ** PROJECTOR_BITS - 1), bit_depth) # uint8 levels -> [0,1]
+
+
+def pattern_metadata(stim_texture, stimdict):
+
+    """ Metadata rows of the pattern mode (helper.append_main_setup): bit
+    depth, patterns per video frame, the levels the noise is shown at and the
+    top level of the bit depth """
+
+    bit_depth = stimdict["PATTERN_BIT_DEPTH"]
+    shown = np.unique(pattern_levels(np.unique(stim_texture), stimdict))
+    return {'pattern_bit_depth': bit_depth,
+            'patterns_per_frame': dlp_pattern.patterns_per_frame(bit_depth),
+            'pattern_levels': ' '.join(str(level) for level in shown),
+            'pattern_top_level': (1 << bit_depth) - 1}
+
+
+def prepare_stim_noise_patterns(stim_texture, stimdict, epoch):
+
+    """ Packs the noise texture stack into the bit planes of video frames
+    for the DLP pattern mode (header PATTERN_BIT_DEPTH, see dlp_pattern).
+    Safe to run in a background thread.
+
+    :returns: dict with the packed frames, the patterns per video frame and
+        per texture
+
+    """
+    bit_depth = stimdict["PATTERN_BIT_DEPTH"]
+    framerate = frame_rate(stimdict)
+    tex_patterns = dlp_pattern.texture_patterns(stimdict['texture.duration'][epoch], framerate, bit_depth)
+
+    levels = pattern_levels(stim_texture, stimdict)
+    return {'frames': dlp_pattern.pack_texture_stack(levels, bit_depth, tex_patterns),
+            'patterns_per_frame': dlp_pattern.patterns_per_frame(bit_depth),
+            'tex_patterns': tex_patterns}
+
+
+def prepare_epoch(exp_Info,bg_ls,fg_ls,stim_texture,noise_arr,stimdict,epoch,scr_width,scr_distance):
+
+    """prepare_epoch:
+
+    Computes the resources of one epoch before it is presented, according to
+    its stimtype. It never touches the window or any stimulus object, so the
+    main loop can run it in a background thread (see prefetch.EpochPrefetcher)
+    while the previous epoch is being presented. Its result is passed to the
+    stimulus function as "prepared". Returns None for stimtypes that do not
+    need any preparation.
+
+    """
+    stimtype = stimdict["stimtype"][epoch]
+    if stimtype == "SSR":
+        return prepare_standing_stripes_random(stimdict, epoch, scr_width, scr_distance)
+    elif stimtype[-1] == "C" or stimtype[-1] == "R":
+        return prepare_field_flash(bg_ls,fg_ls,stim_texture,noise_arr,stimdict,epoch)
+    elif stimtype == "DS":
+        return prepare_drifting_stripe(exp_Info, stimdict, epoch, scr_width, scr_distance)
+    elif stimtype == "N":
+        if stimdict.get("PATTERN_BIT_DEPTH", 0):
+            return prepare_stim_noise_patterns(stim_texture, stimdict, epoch)
+        return prepare_stim_noise(stim_texture)
+    return None
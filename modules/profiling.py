@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Per-stage timing of the frame loop of the stimulus functions.
+
+Enabled with config.PROFILE_FRAMES. Every frame is split into the stages of
+STAGES, each one ending with a time stamp (``time.perf_counter_ns``) written
+into a preallocated array:
+
+- keys: from the previous flip to the check of the abort flag (see controls)
+- update: stimulus attributes for this frame (stimdict lookups, positions, textures)
+- draw: draw() calls (with several bars, also the updates between them)
+- nidaq: output values and check_timing_nidaq
+- write_out: the line of the output file
+- flip: win.flip()
+
+After every epoch the stage durations are added to latency histograms per
+stimtype (fixed logarithmic bins, see HIST_EDGES_NS), so memory does not grow
+with the session length. The histograms are appended to the metadata file at
+the end of the session.
+
+"""
+
+from time import perf_counter_ns
+import numpy as np
+
+STAGES = ('keys', 'update', 'draw', 'nidaq', 'write_out', 'flip')
+HIST_EDGES_NS = np.logspace(3, 9, 49).astype(np.int64) # 1 us to 1 s, 8 bins per decade
+
+
+def _no_stamp():
+    pass
+
+
+def start_profile(profiler, stimtype, n_frames):
+
+    """ Starts profiling an epoch and returns the function stamping the end of
+    every stage. Without profiler, the function does nothing.
+
+    :param profiler: FrameProfiler or None
+    :param stimtype: stimtype of the epoch
+    :type stimtype: str
+    :param n_frames: number of frames of the epoch
+    :type n_frames: int
+    :returns: function without arguments
+
+    """
+    if profiler is None:
+        return _no_stamp
+    return profiler.start_epoch(stimtype, n_frames)
+
+
+class FrameProfiler(object):
+    """ Stage durations of every frame, summarized in histograms per stimtype.
+
+        :param max_frames: frames of the longest expected epoch. The stamp
+            array only grows (between epochs) for longer ones
+        :type max_frames: int
+
+    """
+
+    def __init__(self, max_frames=3600):
+        self._stamps = np.zeros(1 + len(STAGES) * max_frames, dtype=np.int64)
+        self._index = 0
+        self._stimtype = None
+        self.histograms = {} # stimtype: (stage, bin) counts. Bin i is [EDGES[i-1], EDGES[i])
+        self.totals = {} # stimtype: (stage,) sum of durations in ns
+        self.maxima = {} # stimtype: (stage,) longest duration in ns
+
+    def start_epoch(self, stimtype, n_frames):
+        """ Returns `stamp`, after the first stamp of the epoch """
+        size = 1 + len(STAGES) * n_frames
+        if size > len(self._stamps):
+            self._stamps = np.zeros(size, dtype=np.int64)
+        self._stimtype = stimtype
+        self._index = 0
+        self.stamp()
+        return self.stamp
+
+    def stamp(self):
+        """ Marks the end of the current stage """
+        self._stamps[self._index] = perf_counter_ns()
+        self._index += 1
+
+    def end_epoch(self):
+        """ Adds the complete frames of the epoch to the histograms """
+        if self._stimtype is None:
+            return
+        n_stages = len(STAGES)
+        n_frames = (self._index - 1) // n_stages
+        durations = np.diff(self._stamps[:1 + n_stages * n_frames]).reshape(n_frames, n_stages)
+
+        if self._stimtype not in self.histograms:
+            self.histograms[self._stimtype] = np.zeros((n_stages, len(HIST_EDGES_NS) + 1), dtype=np.int64)
+            self.totals[self._stimtype] = np.zeros(n_stages, dtype=np.int64)
+            self.maxima[self._stimtype] = np.zeros(n_stages, dtype=np.int64)
+        bins = np.searchsorted(HIST_EDGES_NS, durations, side='right')
+        for s in range(n_stages):
+            self.histograms[self._stimtype][s] += np.bincount(bins[:, s], minlength=len(HIST_EDGES_NS) + 1)
+        self.totals[self._stimtype] += durations.sum(axis=0)
+        if n_frames:
+            self.maxima[self._stimtype] = np.maximum(self.maxima[self._stimtype], durations.max(axis=0))
+        self._stimtype = None
+
+    def percentile(self, stimtype, stage, q):
+        """ Upper bin edge (ns) below which q percent of the durations of a stage fall """
+        counts = self.histograms[stimtype][STAGES.index(stage)]
+        cumulative = np.cumsum(counts)
+        i = int(np.searchsorted(cumulative, cumulative[-1] * q / 100.0))
+        edges = np.append(HIST_EDGES_NS, self.maxima[stimtype][STAGES.index(stage)])
+        return int(edges[min(i, len(edges) - 1)])
+
+    def summary(self):
+        """ Returns {stimtype: {stage: (frames, mean_us, p50_us, p99_us, max_us)}} """
+        summary = {}
+        for stimtype, histogram in self.histograms.items():
+            frames = int(histogram[0].sum())
+            summary[stimtype] = {}
+            for s, stage in enumerate(STAGES):
+                mean = self.totals[stimtype][s] / frames / 1000.0 if frames else 0.0
+                summary[stimtype][stage] = (frames, round(mean, 1),
+                                            self.percentile(stimtype, stage, 50) / 1000.0,
+                                            self.percentile(stimtype, stage, 99) / 1000.0,
+                                            self.maxima[stimtype][s] / 1000.0)
+        return summary
+
+    def write(self, metafile):
+        """ Appends summary and histograms to the metadata file (KEY,VALUE lines) """
+        with open(metafile, 'a') as f:
+            f.write("frame_profile_stages,%s\n" % ' '.join(STAGES))
+            f.write("frame_profile_summary_columns,frames mean_us p50_us p99_us max_us\n")
+            f.write("frame_profile_edges_ns,%s\n" % ' '.join(map(str, HIST_EDGES_NS)))
+            for stimtype, stages in self.summary().items():
+                for s, stage in enumerate(STAGES):
+                    f.write("frame_profile_%s_%s,%s\n" % (stimtype, stage, ' '.join(map(str, stages[stage]))))
+                    f.write("frame_profile_%s_%s_histogram,%s\n" % (stimtype, stage,
+                            ' '.join(map(str, self.histograms[stimtype][s]))))
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Real-time process mode for the presentation of a session.
+
+Enabled with config.REALTIME_MODE. During the session:
+
+- the cyclic garbage collector is frozen and disabled while an epoch is
+  presented, and only collects between epochs. The objects alive at the start
+  of an epoch are moved to the permanent generation (``gc.freeze``), so the
+  collection between epochs only scans what the last epoch allocated
+- the process priority is raised (HIGH on Windows, nice -10 on Linux/macOS,
+  which needs the permission to do so)
+- the render thread (the one presenting the session) is pinned to one core
+  (config.RENDER_CPU) and helper threads (e.g. the epoch prefetcher, via
+  `helper_thread_initializer`) to the other cores
+
+Whether the mode is enabled or not, the garbage collections during epochs
+and the frame intervals of the window are counted and appended to the
+metadata file, so sessions with and without it can be compared.
+psutil is used for the process priority if it is installed.
+
+"""
+
+import gc
+import os
+import sys
+import ctypes
+import numpy as np
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from modules import config
+
+REPORT_PERCENTILES = (50, 99, 99.9)
+_ERRORS = (OSError, AttributeError) + ((psutil.Error,) if psutil is not None else ())
+
+
+def available_cpus():
+    """ Cores this process may run on """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    if psutil is not None:
+        return sorted(psutil.Process().cpu_affinity())
+    return list(range(os.cpu_count() or 1))
+
+
+def pin_current_thread(cpus):
+
+    """ Restricts the calling thread to some cores
+
+    :param cpus: core numbers
+    :type cpus: list
+    :returns: True if the affinity was set
+
+    """
+    if not cpus:
+        return False
+    try:
+        if sys.platform == 'win32':
+            kernel32 = ctypes.windll.kernel32
+            mask = sum(1 << cpu for cpu in cpus)
+            return bool(kernel32.SetThreadAffinityMask(kernel32.GetCurrentThread(), mask))
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus) # 0: the calling thread on Linux
+            return True
+    except (OSError, AttributeError):
+        pass
+    return False # macOS has no thread affinity
+
+
+def _raise_priority():
+
+    """ Raises the priority of the process. Returns the old one (None if it failed) """
+
+    try:
+        if psutil is not None:
+            process = psutil.Process()
+            old = process.nice()
+            process.nice(psutil.HIGH_PRIORITY_CLASS if sys.platform == 'win32' else -10)
+            return old
+        if sys.platform == 'win32':
+            kernel32 = ctypes.windll.kernel32
+            old = kernel32.GetPriorityClass(kernel32.GetCurrentProcess())
+            if kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), 0x80): # HIGH_PRIORITY_CLASS
+                return old
+            return None
+        old = os.getpriority(os.PRIO_PROCESS, 0)
+        os.setpriority(os.PRIO_PROCESS, 0, -10)
+        return old
+    except _ERRORS as e:
+        print('>>> WARNING <<< Process priority could not be raised: %s' % e)
+        return None
+
+
+def _restore_priority(old):
+    try:
+        if psutil is not None:
+            psutil.Process().nice(old)
+        elif sys.platform == 'win32':
+            kernel32 = ctypes.windll.kernel32
+            kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), old)
+        else:
+            os.setpriority(os.PRIO_PROCESS, 0, old)
+    except _ERRORS:
+        pass # lowering the priority again is not always allowed (nice)
+
+
+class RealtimeMode(object):
+    """ Process settings of a session and the report of their effect.
+
+        :param enabled: applies the settings (config.REALTIME_MODE) or only reports
+        :type enabled: boolean
+        :param render_cpu: index into the available cores for the render thread
+            (config.RENDER_CPU). The other cores are for the helper threads
+        :type render_cpu: int
+
+    """
+
+    def __init__(self, enabled=None, render_cpu=None):
+        self.enabled = bool(config.REALTIME_MODE if enabled is None else enabled)
+        cpus = available_cpus()
+        render_cpu = config.RENDER_CPU if render_cpu is None else render_cpu
+        if self.enabled and len(cpus) > 1:
+            self.render_cpus = [cpus[render_cpu]]
+            self.helper_cpus = [cpu for cpu in cpus if cpu != cpus[render_cpu]]
+        else:
+            self.render_cpus = self.helper_cpus = []
+        self.priority = None
+        self.pinned = False
+        self.in_epoch = False
+        self.collections = {True: 0, False: 0} # in epoch: number of collections
+        self._gc_was_enabled = gc.isenabled()
+        self._win = None
+
+    def _on_collection(self, phase, info):
+        if phase == 'start':
+            self.collections[self.in_epoch] += 1
+
+    def helper_thread_initializer(self):
+        """ Initializer for helper threads (e.g. ThreadPoolExecutor), keeps
+        them off the render core """
+        if self.helper_cpus:
+            pin_current_thread(self.helper_cpus)
+
+    def enter(self, win=None):
+
+        """ Applies the settings, from the render thread, before the first epoch
+
+        :param win: the window, to record its frame intervals (psychopy Window)
+
+        """
+        gc.callbacks.append(self._on_collection)
+        self._win = win
+        if win is not None and hasattr(win, 'recordFrameIntervals'):
+            win.recordFrameIntervals = True
+        if not self.enabled:
+            return
+        self.priority = _raise_priority()
+        self.pinned = pin_current_thread(self.render_cpus)
+        gc.collect()
+
+    def begin_epoch(self):
+        """ Freezes the objects alive until now and stops the collector """
+        self.in_epoch = True
+        if self.enabled:
+            gc.freeze()
+            gc.disable()
+
+    def end_epoch(self):
+        """ Collects what the epoch left behind (frozen objects are not scanned) """
+        self.in_epoch = False
+        if self.enabled:
+            gc.enable()
+            gc.collect()
+
+    def exit(self):
+        """ Restores the collector and the priority """
+        self.in_epoch = False
+        if self._on_collection in gc.callbacks:
+            gc.callbacks.remove(self._on_collection)
+        if not self.enabled:
+            return
+        gc.unfreeze()
+        if self._gc_was_enabled:
+            gc.enable()
+        if self.priority is not None:
+            _restore_priority(self.priority)
+
+    def frame_intervals(self):
+        """ Frame intervals of the window in seconds (empty if it does not record them) """
+        intervals = getattr(self._win, 'frameIntervals', None)
+        return np.asarray(intervals if intervals else [], dtype=float)
+
+    def report(self):
+        """ Returns the report as a list of (key, value) """
+        report = [('realtime_mode', int(self.enabled)),
+                  ('realtime_priority_raised', int(self.priority is not None)),
+                  ('realtime_render_cpus', ' '.join(map(str, self.render_cpus)) if self.pinned else None),
+                  ('gc_collections_in_epochs', self.collections[True]),
+                  ('gc_collections_between_epochs', self.collections[False])]
+        intervals = self.frame_intervals()
+        if len(intervals):
+            frame = 1.0 / config.FRAMERATE
+            report.append(('frame_intervals', len(intervals)))
+            for q in REPORT_PERCENTILES:
+                report.append(('frame_interval_p%g_ms' % q, round(float(np.percentile(intervals, q)) * 1000, 3)))
+            report.append(('frame_interval_max_ms', round(float(intervals.max()) * 1000, 3)))
+            report.append(('frame_intervals_late', int(np.sum(intervals > 1.5 * frame))))
+        return report
+
+    def write(self, metafile):
+        """ Prints the report and appends it to the metadata file (KEY,VALUE lines) """
+        with open(metafile, 'a') as f:
+            for key, value in self.report():
+                print('%s: %s' % (key, value))
+                f.write('%s,%s\n' % (key, value))
@@ -0,0 +1,596 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" CPU reference renderer of the stimuli (no window, no GPU needed).
+
+Produces the frame sequence of a stimulus file as NumPy arrays, the way the
+stimulus functions in ``stimuli`` draw it into the window: same epoch
+schedule (``helper.epoch_schedule``), same epoch preparation
+(``preparation``), same textures (``textures``) and the same colour pipeline
+(``helper.epoch_colors``). The units of ``main`` are reproduced for every
+PERSPECTIVE_CORRECTION value ('deg', 'degFlatPos' and 'degPerspective').
+
+Frames are RGB float32 arrays of shape (height, width, 3) in the psychopy
+colour space [-1, 1], with row 0 at the top of the window. They show the
+window content before the warper (perspective correction) and the window
+masks are applied.
+
+Timing is ideal: frame N is shown at N/FRAMERATE seconds from the start of
+its epoch, and tau and duration are counted in frames as in the stimulus
+functions (see timing). Random dots (dotty gratings) are drawn from the dots
+stream (see rng, `dot_positions`), so they are reproducible, any frame can be
+drawn directly, but they are not the dots psychopy drew.
+
+"""
+
+import numpy as np
+
+from modules.helper import *
+from modules.exceptions import StimulusError
+from modules.preparation import prepare_epoch
+from modules.textures import generate_textures, LEVEL_RGB
+from modules.rng import RandomStreams
+from modules.timing import seconds_to_frames, frame_timing
+from modules import config
+
+DEG_TO_CM = 0.017455 # size in cm of 1 deg at 1 cm distance (as in psychopy)
+MAX_TEX_VALUE = (2*(63.0/255.0))-1 # Max value in stim_texture after scaling
+MIN_TEX_VALUE = -1 # Min value in stim_texture after scaling
+DOT_COLOR = [-1.0,-0.7366,-0.7529] # Color of the dots of the dotty grating (see main)
+DOT_LIFE = 3 # frames
+CHUNK_FRAMES = 32 # frames per chunk of `OffscreenRenderer.render`, 24 MB at 500x500
+
+
+def dot_positions(streams, epoch, n_dots, frameN, dot_life=DOT_LIFE):
+
+    """ Positions of the dots of a dotty grating at one frame, without the
+    frames before it
+
+    Unit (epoch, 0) of the dots stream gives the first positions and the
+    life left of every dot, in (0, dot_life] frames. A dot is renewed when
+    its life is over, then every dot_life frames, at a position drawn from
+    unit (epoch, frame of the renewal + 1).
+
+    :param streams: `rng.RandomStreams` of the session
+    :param epoch: epoch of the dotty grating
+    :type epoch: int
+    :param n_dots: number of dots
+    :type n_dots: int
+    :param frameN: frame of the epoch
+    :type frameN: int
+    :returns: (n_dots, 2) positions in [-0.5, 0.5), fractions of the field
+
+    """
+    generator = streams.generator('dots', epoch, 0)
+    xy = generator.uniform(-0.5, 0.5, size=(n_dots, 2))
+    life = dot_life * (1 - generator.random(n_dots))
+    first_renewal = np.ceil(life - 1).astype(int)
+    renewed = frameN >= first_renewal
+    birth = np.where(renewed, first_renewal + (frameN - first_renewal) // dot_life * dot_life + 1, 0)
+    for unit in np.unique(birth[renewed]):
+        dots = birth == unit
+        xy[dots] = streams.generator('dots', epoch, int(unit)).uniform(-0.5, 0.5, size=(n_dots, 2))[dots]
+    return xy
+
+
+def deg2cm_flat(x, y, distance):
+
+    """ Converts positions in degrees to cm on a flat screen.
+
+    Same as psychopy ``deg2cm(correctFlat=True)``, used by the 'degFlatPos'
+    (positions only) and 'degPerspective' (every vertex) units.
+
+    :returns: (x, y) in cm
+
+    """
+    tan_x = np.tan(np.radians(x))
+    tan_y = np.tan(np.radians(y))
+    return (np.hypot(distance, tan_y * distance) * tan_x,
+            np.hypot(distance, tan_x * distance) * tan_y)
+
+
+def cm2deg_flat(x, y, distance):
+
+    """ Inverse of `deg2cm_flat` (closed form)
+
+    :returns: (x, y) in degrees
+
+    """
+    a = np.square(x / distance)
+    b = np.square(y / distance)
+    # with X = tan(x)**2 and Y = tan(y)**2: a = X(1+Y) and b = Y(1+X)
+    c = 1 + a - b
+    tan2_y = (np.sqrt(c * c + 4 * b) - c) / 2
+    tan2_x = np.maximum(tan2_y + a - b, 0)
+    return (np.degrees(np.arctan(np.sign(x) * np.sqrt(tan2_x))),
+            np.degrees(np.arctan(np.sign(y) * np.sqrt(tan2_y))))
+
+
+def square_texture(res=128):
+
+    """ Returns psychopy's 'sqr' texture: one square wave cycle along x
+
+    :param res: texture resolution (texRes)
+    :returns: NumPy array of shape (res, res) with values -1 and 1
+
+    """
+    one_period = np.linspace(0, 2 * np.pi, res)
+    row = np.where(np.sin(one_period - np.pi / 2) > 0, 1.0, -1.0)
+    return np.tile(row, (res, 1))
+
+
+def sample_texture(tex, u, v, interpolate=False):
+
+    """ Samples a texture with repeat wrapping, as OpenGL does.
+
+    :param tex: texture of shape (rows, cols) or (rows, cols, 3), row 0 at the bottom
+    :type tex: NumPy array
+    :param u: horizontal texture coordinates (1.0 = one texture width)
+    :type u: NumPy array
+    :param v: vertical texture coordinates (1.0 = one texture height)
+    :type v: NumPy array
+    :param interpolate: bilinear (True) or nearest neighbour (False) sampling
+    :type interpolate: bool
+    :returns: NumPy array of shape u.shape (+ (3,) for RGB textures)
+
+    """
+    rows, cols = tex.shape[:2]
+    if not interpolate:
+        c = np.floor(u * cols).astype(int) % cols
+        r = np.floor(v * rows).astype(int) % rows
+        return tex[r, c]
+
+    # texel centers are at (i + 0.5) / n
+    x = u * cols - 0.5
+    y = v * rows - 0.5
+    x0 = np.floor(x)
+    y0 = np.floor(y)
+    fx = x - x0
+    fy = y - y0
+    c0 = x0.astype(int) % cols
+    c1 = (c0 + 1) % cols
+    r0 = y0.astype(int) % rows
+    r1 = (r0 + 1) % rows
+    if tex.ndim == 3:
+        fx = fx[..., np.newaxis]
+        fy = fy[..., np.newaxis]
+    bottom = tex[r0, c0] * (1 - fx) + tex[r0, c1] * fx
+    top = tex[r1, c0] * (1 - fx) + tex[r1, c1] * fx
+    return bottom * (1 - fy) + top * fy
+
+
+def to_uint8(frames):
+
+    """ Converts frames from the psychopy colour space [-1, 1] to 8 bit [0, 255] """
+
+    return np.round((np.clip(frames, -1, 1) + 1) * 127.5).astype(np.uint8)
+
+
+class OffscreenRenderer(object):
+    """ Renders the frames of a stimulus file with NumPy.
+
+        :param stimdict: stimulus dictionary (see helper.Stimulus). Old
+            stimtype names are renamed in place, as in main
+        :type stimdict: dict
+        :param size: window size in pixels (width, height)
+        :type size: tuple
+        :param view_scale: as the viewScale of the window, e.g. [1,1/2] for the dlp
+        :type view_scale: tuple
+        :param screen_width: width of the projection area in cm (config.SCREEN_WIDTH)
+        :type screen_width: float
+        :param distance: distance from the viewer to the screen in cm (config.DISTANCE)
+        :type distance: float
+        :param framerate: refresh rate of the screen (config.FRAMERATE)
+        :type framerate: int
+        :param win_masks: as exp_Info['WinMasks']. Changes where drifting stripes start
+        :type win_masks: int
+        :param seed: seed of the random streams, e.g. epoch schedule and dots (config.SEED)
+        :type seed: int
+
+    """
+
+    def __init__(self, stimdict, size=(500, 500), view_scale=(1, 1),
+                 screen_width=None, distance=None, framerate=None,
+                 win_masks=0, seed=None):
+        self.stimdict = stimdict
+        self.size = (int(size[0]), int(size[1]))
+        self.screen_width = config.SCREEN_WIDTH if screen_width is None else screen_width
+        self.distance = config.DISTANCE if distance is None else distance
+        self.framerate = config.FRAMERATE if framerate is None else framerate
+        self.seed = config.SEED if seed is None else seed
+        self.exp_Info = {'WinMasks': win_masks}
+        self.streams = RandomStreams(self.seed, stimdict.get("RNG_MODE"))
+
+        # Same stimulus data as in main
+        rename_stimtypes(stimdict)
+        frame_timing(stimdict, self.framerate)
+        self.bg_ls, self.fg_ls = epoch_colors(stimdict)
+        (self.stim_texture_ls, self.noise_array_ls, self.stim_texture,
+         self._useTex, self._useNoise) = generate_textures(stimdict)
+        self._prepared = {}
+
+        # Pixel centers relative to the window center (x right, y up), row 0 at the top
+        width, height = self.size
+        self.pix_per_cm = width / self.screen_width
+        self.pix_per_deg = self.distance * DEG_TO_CM * self.pix_per_cm
+        px = (np.arange(width) + 0.5 - width / 2) / view_scale[0]
+        py = (height / 2 - np.arange(height) - 0.5) / view_scale[1]
+        self._px, self._py = np.meshgrid(px, py)
+
+        # Pixel centers in degrees, in the units main uses for the stimuli
+        self.perspective_correction = stimdict.get("PERSPECTIVE_CORRECTION", 0) # missing in old files
+        if self.perspective_correction == 2:
+            # 'degPerspective': every vertex is corrected for the flat screen
+            self._xdeg, self._ydeg = cm2deg_flat(self._px / self.pix_per_cm,
+                                                 self._py / self.pix_per_cm,
+                                                 self.distance)
+        else:
+            self._xdeg = self._px / self.pix_per_deg
+            self._ydeg = self._py / self.pix_per_deg
+
+    def _offsets(self, pos):
+        """ Returns the offsets in degrees of every pixel from a stimulus position """
+        if self.perspective_correction == 1 or self.perspective_correction == 2:
+            return self._xdeg - pos[0], self._ydeg - pos[1]
+
+        # 'degFlatPos': only the position is corrected for the flat screen
+        x_cm, y_cm = deg2cm_flat(pos[0], pos[1], self.distance)
+        return ((self._px - x_cm * self.pix_per_cm) / self.pix_per_deg,
+                (self._py - y_cm * self.pix_per_cm) / self.pix_per_deg)
+
+    def _local(self, pos, ori=0.0):
+        """ Returns the pixel coordinates in degrees in the frame of a stimulus
+        at pos, rotated by ori (clockwise, as psychopy)
+        """
+        dx, dy = self._offsets(pos)
+        if not ori:
+            return dx, dy
+        theta = np.radians(ori)
+        return (np.cos(theta) * dx - np.sin(theta) * dy,
+                np.sin(theta) * dx + np.cos(theta) * dy)
+
+    def _rect(self, pos, width, height, ori=0.0):
+        """ Returns the boolean mask of a visual.Rect """
+        u, v = self._local(pos, ori)
+        return (np.abs(u) <= width / 2) & (np.abs(v) <= height / 2)
+
+    def _circle(self, pos, radius):
+        """ Returns the boolean mask of a visual.Circle """
+        u, v = self._offsets(pos)
+        return u * u + v * v <= radius * radius
+
+    def _background(self, epoch):
+        frame = np.empty((self.size[1], self.size[0], 3), dtype=np.float32)
+        frame[:] = self.bg_ls[epoch]
+        return frame
+
+    def _full_screen(self):
+        """ Size in degrees of the full screen stimuli (noise and gratings) """
+        return max_angle_from_center(self.screen_width, self.distance) * 2
+
+    def prepared(self, epoch):
+        """ Returns the resources of an epoch (as prepared in main), computed once """
+        if epoch not in self._prepared:
+            if self.stimdict["stimtype"][epoch] == "N":
+                stim_texture, noise_arr = self.stim_texture, None
+            else:
+                stim_texture, noise_arr = self.stim_texture_ls[epoch], self.noise_array_ls[epoch]
+            self._prepared[epoch] = prepare_epoch(self.exp_Info, self.bg_ls, self.fg_ls,
+                                                  stim_texture, noise_arr, self.stimdict, epoch,
+                                                  self.screen_width, self.distance)
+        return self._prepared[epoch]
+
+    def epoch_frames(self, epoch):
+        """ Yields the frames of one epoch, one (height, width, 3) array per frame.
+
+        Consecutive identical frames may be the same array: do not modify them.
+        """
+        stimtype = self.stimdict["stimtype"][epoch]
+        prepared = self.prepared(epoch)
+        if stimtype == "SSR":
+            return self._standing_stripes_random(epoch, prepared)
+        elif stimtype[-1] == "C" or stimtype[-1] == "R":
+            return self._field_flash(epoch, prepared)
+        elif stimtype == "DS":
+            return self._drifting_stripe(epoch, prepared)
+        elif stimtype == "N":
+            return self._stim_noise(epoch, prepared)
+        elif stimtype == "DG":
+            return self._dotty_grating(epoch)
+        elif stimtype[-1:] in ("G", "g"):
+            return self._noisy_grating(epoch)
+        raise StimulusError(stimtype, epoch)
+
+    def _field_flash(self, epoch, prepared):
+        """ Frames of stimuli.field_flash """
+        stimdict = self.stimdict
+        stimtype = stimdict["stimtype"][epoch]
+        tau_frames = seconds_to_frames(stimdict["tau"][epoch], self.framerate)
+        n_frames = seconds_to_frames(stimdict["duration"][epoch], self.framerate)
+        try:
+            center = (stimdict['x_center'][epoch], stimdict['y_center'][epoch])
+        except:
+            center = (0, 0)
+
+        # The same object is drawn once per sister object
+        inside = np.zeros((self.size[1], self.size[0]), dtype=bool)
+        for space in prepared['space_ls']:
+            pos = center if stimtype == 'NC' else (center[0] - space, center[1])
+            if stimtype[-1] == "C":
+                radius = stimdict["radius"][epoch] if stimtype == "C" else 0.5 # psychopy default
+                inside |= self._circle(pos, radius)
+            else:
+                inside |= self._rect(pos, stimdict["width"][epoch], stimdict["height"][epoch])
+
+        bg_frame = self._background(epoch)
+        fg_frame = bg_frame.copy()
+        fg_frame[inside] = self.fg_ls[epoch]
+        circle_texture = prepared['circle_texture']
+        start_frame = 0
+        for frameN in range(n_frames):
+            # Before tau the object is drawn with the background color
+            if frameN < tau_frames:
+                yield bg_frame
+            elif stimtype == 'NC':
+                frame = bg_frame.copy()
+                frame[inside] = [-1, -1, circle_texture[start_frame]]
+                yield frame
+            else:
+                yield fg_frame
+            start_frame = start_frame + prepared['frame_shift']
+
+    def _standing_stripes_random(self, epoch, prepared):
+        """ Frames of stimuli.standing_stripes_random """
+        stimdict = self.stimdict
+        ori = stimdict["bar.orientation"][epoch]
+        bg_frame = self._background(epoch)
+        for position in prepared['positions']:
+            pos = [position, 0] if ori == 0 else [0, position]
+            frame = bg_frame.copy()
+            frame[self._rect(pos, stimdict["bar.width"][epoch],
+                             stimdict["bar.height"][epoch], ori)] = self.fg_ls[epoch]
+            for n in range(prepared['bar_duration']):
+                yield frame
+            for n in range(prepared['bg_duration']):
+                yield bg_frame
+
+    def _drifting_stripe(self, epoch, prepared):
+        """ Frames of stimuli.drifting_stripe, with the same position updates """
+        stimdict = self.stimdict
+        tau_frames = seconds_to_frames(stimdict["tau"][epoch], self.framerate)
+        n_frames = seconds_to_frames(stimdict["duration"][epoch], self.framerate)
+        width = stimdict["bar.width"][epoch]
+        height = stimdict["bar.height"][epoch]
+        ori = stimdict["bar.orientation"][epoch]
+        direction = prepared['direction']
+        init_pos = prepared['init_pos'] if prepared['init_pos'] is not None else 0.0
+        space_ls = prepared['space_ls']
+        step = (stimdict["velocity"][epoch] / self.framerate) / prepared['bar_number']
+        pos = np.array(prepared['pos'], dtype=float)
+
+        bg_frame = self._background(epoch)
+        for frameN in range(n_frames):
+            #Resetting sisters bar possition for next frame
+            if frameN > 0:
+                if ori == 0:
+                    if direction == "right":
+                        pos[0] = pos[0] + sum(space_ls)
+                    elif direction == "left":
+                        pos[0] = pos[0] - sum(space_ls)
+                elif ori == 90:
+                    if direction == "up":
+                        pos[1] = pos[1] + sum(space_ls)
+                    elif direction == "down":
+                        pos[1] = pos[1] - sum(space_ls)
+
+            if frameN < tau_frames:
+                yield bg_frame
+                continue
+
+            frame = bg_frame.copy()
+            for i in range(len(space_ls)):
+                if ori == 0:
+                    pos[1] = init_pos
+                    if direction == "right":
+                        pos[0] = pos[0] - space_ls[i] + step
+                    elif direction == "left":
+                        pos[0] = pos[0] + space_ls[i] - step
+                elif ori == 90:
+                    pos[0] = init_pos
+                    if direction == "up":
+                        pos[1] = pos[1] - space_ls[i] + step
+                    elif direction == "down":
+                        pos[1] = pos[1] + space_ls[i] - step
+                elif ori == 45:
+                    width = stimdict["bar.width"][epoch] * np.sqrt(2) # Correcting size for diagonals
+                    if direction == "left-up":
+                        pos[0] -= step * np.sqrt(2)
+                    elif direction == "right-down":
+                        pos[0] += step * np.sqrt(2)
+                elif ori == 135:
+                    width = stimdict["bar.width"][epoch] * np.sqrt(2) # Correcting size for diagonals
+                    if direction == "right-up":
+                        pos[1] += step * np.sqrt(2)
+                    elif direction == "left-down":
+                        pos[1] -= step * np.sqrt(2)
+                frame[self._rect(pos, width, height, ori)] = self.fg_ls[epoch]
+            yield frame
+
+    def _stim_noise(self, epoch, prepared):
+        """ Frames of stimuli.stim_noise """
+        tex_duration = seconds_to_frames(self.stimdict['texture.duration'][epoch], self.framerate)
+        size = self._full_screen()
+        u, v = self._offsets((0, 0))
+        inside = (np.abs(u) <= size / 2) & (np.abs(v) <= size / 2)
+
+        # Texel of every pixel inside the stimulus (nearest, no interpolation)
+        texture = prepared.get('texture', prepared.get('frames'))
+        rows, cols = texture.shape[1:3]
+        c = np.floor((u[inside] / size + 0.5) * cols).astype(int) % cols
+        r = np.floor((v[inside] / size + 0.5) * rows).astype(int) % rows
+
+        bg_frame = self._background(epoch)
+        if 'frames' in prepared:
+            # Video signal of the DLP pattern mode, one packed frame per flip
+            for packed in prepared['frames']:
+                frame = bg_frame.copy()
+                frame[inside] = packed[r, c]
+                yield frame
+            return
+
+        rgb = np.empty((len(r), 3), dtype=np.float32)
+        rgb[:, 0] = -1 # All R value to -1
+        rgb[:, 1] = -1 # All G value to -1
+        for t in texture:
+            frame = bg_frame.copy()
+            rgb[:, 2] = LEVEL_RGB[t[r, c]]
+            frame[inside] = rgb
+            for frameN in range(tex_duration):
+                yield frame
+
+    def _grating(self, pos, size, ori, circle_mask):
+        """ Returns the pixels inside a GratingStim and their texture frame coordinates """
+        u, v = self._local(pos, ori)
+        if circle_mask:
+            inside = u * u + v * v <= (size / 2) ** 2
+        else:
+            inside = (np.abs(u) <= size / 2) & (np.abs(v) <= size / 2)
+        return inside, u[inside], v[inside]
+
+    def _noisy_grating(self, epoch):
+        """ Frames of stimuli.noisy_grating """
+        stimdict = self.stimdict
+        tau_frames = seconds_to_frames(stimdict["tau"][epoch], self.framerate)
+        n_frames = seconds_to_frames(stimdict["duration"][epoch], self.framerate)
+        sf = 1 / stimdict['sWavelength'][epoch]
+        size = self._full_screen()
+        try:
+            ori = stimdict["orientation"][epoch]
+            direction = int(stimdict["direction"][epoch])
+        except:
+            ori = 0
+            direction = 1
+        phase_value = (stimdict['velocity'][epoch]/(self.framerate*stimdict['sWavelength'][epoch])) * direction
+
+        pos = (0, 0)
+        circle_mask = False
+        try:
+            if stimdict['mask'][epoch]:
+                circle_mask = True
+                pos = [stimdict['pos.x'][epoch], stimdict['pos.y'][epoch]]
+                size = stimdict['mask.size'][epoch]
+        except:
+            pass
+
+        stim_texture = self.stim_texture_ls[epoch] if self._useTex else square_texture()
+        noise_arr = self.noise_array_ls[epoch]
+        inside, u, v = self._grating(pos, size, ori, circle_mask)
+
+        bg_frame = self._background(epoch)
+        phase = 0.0
+        texture = stim_texture
+        for frameN in range(n_frames):
+            if self._useNoise:
+                texture = np.clip(stim_texture + noise_arr[frameN], MIN_TEX_VALUE, MAX_TEX_VALUE)
+            # After tau, change the phase of grating (motion)
+            if frameN >= tau_frames:
+                phase += phase_value
+            frame = bg_frame.copy()
+            frame[inside] = sample_texture(texture, u * sf - phase + 0.5,
+                                           v * sf - phase + 0.5, interpolate=True)[:, np.newaxis]
+            yield frame
+
+    def _dotty_grating(self, epoch):
+        """ Frames of stimuli.dotty_grating """
+        stimdict = self.stimdict
+        tau_frames = seconds_to_frames(stimdict["tau"][epoch], self.framerate)
+        n_frames = seconds_to_frames(stimdict["duration"][epoch], self.framerate)
+        sf = 1 / stimdict['sWavelength'][epoch]
+        size = self._full_screen()
+        phase_value = stimdict['velocity'][epoch]/(self.framerate*stimdict['sWavelength'][epoch])
+
+        texture = self.stim_texture_ls[epoch] if self._useTex else square_texture()
+        inside, u, v = self._grating((0, 0), size, 0, False)
+
+        # Dots: same position everywhere in the field, life time of 3 frames
+        n_dots = int(stimdict['nDots'][epoch])
+        dot_size = int(stimdict['dotSize'][epoch])
+        square = np.arange(dot_size) - dot_size // 2
+
+        bg_frame = self._background(epoch)
+        phase = 0.0
+        for frameN in range(n_frames):
+            if frameN >= tau_frames:
+                phase += phase_value
+            frame = bg_frame.copy()
+            frame[inside] = sample_texture(texture, u * sf - phase + 0.5,
+                                           v * sf - phase + 0.5, interpolate=True)[:, np.newaxis]
+
+            # dots of this frame on top (square points of dot_size pixels)
+            dots_xy = dot_positions(self.streams, epoch, n_dots, frameN) * size
+            col, row = self._deg2window(dots_xy)
+            rows = (row[:, np.newaxis, np.newaxis] + square[np.newaxis, :, np.newaxis]).repeat(dot_size, 2)
+            cols = (col[:, np.newaxis, np.newaxis] + square[np.newaxis, np.newaxis, :]).repeat(dot_size, 1)
+            valid = (rows >= 0) & (rows < self.size[1]) & (cols >= 0) & (cols < self.size[0])
+            frame[rows[valid], cols[valid]] = DOT_COLOR
+            yield frame
+
+    def _deg2window(self, xy):
+        """ Returns the window pixel (column, row) of positions in degrees """
+        if self.perspective_correction == 2:
+            x_cm, y_cm = deg2cm_flat(xy[:, 0], xy[:, 1], self.distance)
+            x, y = x_cm * self.pix_per_cm, y_cm * self.pix_per_cm
+        else:
+            x, y = xy[:, 0] * self.pix_per_deg, xy[:, 1] * self.pix_per_deg
+        # back from window content to window pixels (see view_scale)
+        scale_x = self._px[0, 1] - self._px[0, 0]
+        scale_y = self._py[0, 0] - self._py[1, 0]
+        col = np.floor(x / scale_x + self.size[0] / 2).astype(int)
+        row = np.floor(self.size[1] / 2 - y / scale_y).astype(int)
+        return col, row
+
+    def schedule(self, maxruntime=None):
+        """ Returns the epoch order of a session, as in main.
+
+        :param maxruntime: duration of the session in seconds. By default the
+            one of main (see helper.session_runtime)
+        :returns: numpy integer array
+
+        """
+        if maxruntime is None:
+            maxruntime = session_runtime(self.stimdict, config.MAXRUNTIME)
+        texture_count = len(self.stim_texture) if "N" in self.stimdict["stimtype"] else None
+        return epoch_schedule(self.stimdict, maxruntime, self.screen_width, self.distance,
+                              self.seed, texture_count)
+
+    def render(self, schedule=None, chunk_size=CHUNK_FRAMES):
+        """ Yields the frames of a session in chunks, so that long stimuli do
+        not need to fit in memory. Every frame is converted to 8 bit as soon
+        as it is rendered, into one preallocated chunk.
+
+        :param schedule: epoch order. By default the one of main (see `schedule`)
+        :type schedule: sequence of int
+        :param chunk_size: maximum number of frames per chunk
+        :type chunk_size: int
+        :returns: generator of (epochs, frames): the epoch of every frame (int
+            array of shape (n,)) and the frames (uint8 array of shape
+            (n, height, width, 3), see `to_uint8`). Both arrays are reused
+            for the next chunk: copy them to keep them
+
+        """
+        if schedule is None:
+            schedule = self.schedule()
+        frames = np.empty((chunk_size, self.size[1], self.size[0], 3), dtype=np.uint8)
+        epochs = np.empty(chunk_size, dtype=int)
+        n = 0
+        for epoch in schedule:
+            epoch = int(epoch)
+            for frame in self.epoch_frames(epoch):
+                frames[n] = to_uint8(frame)
+                epochs[n] = epoch
+                n += 1
+                if n == chunk_size:
+                    yield epochs, frames
+                    n = 0
+        if n:
+            yield epochs[:n], frames[:n]
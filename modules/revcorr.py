@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Reverse correlation of imaging traces with the ternary noise (receptive fields).
+
+The noise of a TERNARY_TEXTURE session is not stored: `contrast_stack`
+draws it again from config.SEED and the stimulus file
+(textures.ternary_noise), as contrasts -1, 0 and 1 per pixel. The frame log
+gives the texture of every stimulus frame of the noise ("N") epochs (theta,
+or the patterns of `dlp_pattern.expand_frame_log` in pattern mode) and the
+imaging frame it was shown in (data). `binned_stimulus` averages the
+textures shown during every imaging frame.
+
+The response-triggered average at lag L of a ROI is the mean over the
+imaging frames k with noise at k - L of
+
+    (r[k] - mean r) * s[k - L]
+
+i.e. the stimulus L imaging frames before the response, weighted by the
+response. `reverse_correlation` computes it for blocks of ROIs and chunks
+of CHUNK_FRAMES imaging frames, so the memory depends on neither the
+length of the recording nor the number of ROIs (only the result does),
+optionally in several processes. The traces can be memory-mapped (see
+trials.load_traces); in several processes pass the .npy filename.
+
+    sta = reverse_correlation('tseries_traces.npy', log, stimdict, lags=range(10))
+    sta['sta'][roi, 3] # (rows, cols) average stimulus 3 imaging frames before the response
+
+"""
+
+import multiprocessing
+import numpy as np
+
+from modules import dlp_pattern
+from modules.framelog import run_lengths, frame_intervals, nominal_interval
+from modules.textures import ternary_noise
+from modules.trials import IMAGING_FRAME_OFFSET, load_traces, imaging_rate
+
+CHUNK_FRAMES = 1000 # imaging frames per chunk
+BLOCK_BYTES = 64 * 1024 * 1024 # accumulators per block of ROIs
+
+
+def noise_epochs(stimdict):
+    """ Epochs of the noise stimulus ("N", after helper.rename_stimtypes) """
+    return [epoch for epoch, stimtype in enumerate(stimdict["stimtype"]) if stimtype in ("N", "noise")]
+
+
+def contrast_stack(stimdict, seed=None):
+
+    """ The ternary noise of a session as contrasts
+
+    :param stimdict: stimulus dictionary of a TERNARY_TEXTURE file
+    :type stimdict: dict
+    :param seed: default: config.SEED
+    :type seed: int
+    :returns: ((count, rows * cols) int8 array of -1, 0, 1, (rows, cols))
+
+    """
+    if stimdict.get("STIMULUSDATA") != "TERNARY_TEXTURE":
+        raise ValueError('Not a TERNARY_TEXTURE stimulus: %r' % (stimdict.get("STIMULUSDATA"),))
+    choices = ternary_noise(stimdict, seed) # indices into TERNARY_VALUES (0, 0.5, 1)
+    return choices.reshape(len(choices), -1).astype(np.int8) - 1, choices.shape[1:]
+
+
+def stimulus_samples(log, stimdict, count, offset=IMAGING_FRAME_OFFSET, framerate=None):
+
+    """ Imaging frame and texture of every noise frame (pattern) shown
+
+    :param log: `framelog.FrameLog`
+    :param stimdict: stimulus dictionary
+    :param count: number of textures of the stack
+    :type count: int
+    :param offset: imaging frame index = data + offset (see trials.presentations)
+    :param framerate: refresh rate in pattern mode (default:
+        stimdict['timing.framerate'] or the one of the frame log)
+    :returns: (imaging frames, texture indices), int arrays sorted by imaging frame
+
+    """
+    frames, textures = [], []
+    bit_depth = stimdict.get("PATTERN_BIT_DEPTH", 0)
+    for epoch in noise_epochs(stimdict):
+        rows = log.rows[log['epoch'] == epoch]
+        if not len(rows):
+            continue
+        frame = rows['data'] + offset
+        texture = rows['theta'].astype(np.int64)
+        if bit_depth:
+            if framerate is None:
+                framerate = stimdict.get("timing.framerate") or 1.0 / nominal_interval(frame_intervals(log))
+            tex_patterns = dlp_pattern.texture_patterns(stimdict['texture.duration'][epoch], framerate, bit_depth)
+            _, _, texture = dlp_pattern.expand_frame_log(rows['tcurr'], texture, framerate,
+                                                         bit_depth, tex_patterns)
+            frame = np.repeat(frame, dlp_pattern.patterns_per_frame(bit_depth))
+        frames.append(frame)
+        textures.append(texture)
+    if not frames:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    frames, textures = np.concatenate(frames), np.concatenate(textures)
+    keep = (frames >= 0) & (textures < count) # scanning started, no blank pattern
+    order = np.argsort(frames[keep], kind='stable')
+    return frames[keep][order], textures[keep][order]
+
+
+def binned_stimulus(contrast, frames, textures, first, last):
+
+    """ Mean contrast shown during the imaging frames [first, last)
+
+    :param contrast: see `contrast_stack`
+    :param frames: see `stimulus_samples`
+    :param textures: see `stimulus_samples`
+    :returns: ((last - first, pixels) float32 array, bool array: noise shown)
+
+    """
+    stimulus = np.zeros((last - first, contrast.shape[1]), dtype=np.float32)
+    shown = np.zeros(last - first, dtype=bool)
+    i0, i1 = np.searchsorted(frames, [first, last])
+    if i1 > i0:
+        values, starts, lengths = run_lengths(frames[i0:i1])
+        sums = np.add.reduceat(contrast[textures[i0:i1]].astype(np.float32), starts, axis=0)
+        stimulus[values - first] = sums / lengths[:, None]
+        shown[values - first] = True
+    return stimulus, shown
+
+
+_shared = {}
+
+
+def _share(contrast, frames, textures):
+    _shared.update(contrast=contrast, frames=frames, textures=textures)
+
+
+def _sta_block(job):
+    """ STA of a block of ROIs, streamed over chunks of imaging frames """
+    traces, first, last, lags, chunk_frames, is_block = job
+    if isinstance(traces, str):
+        traces = load_traces(traces)
+    contrast, frames, textures = _shared['contrast'], _shared['frames'], _shared['textures']
+    n_frames = traces.shape[1]
+    block = traces if is_block else traces[first:last]
+    n_rois, pixels = len(block), contrast.shape[1]
+    lo_lag, hi_lag = min(lags), max(lags)
+
+    weighted = np.zeros((n_rois, len(lags), pixels)) # sum of r[k] * s[k - L]
+    stimulus_sum = np.zeros((len(lags), pixels)) # sum of s[k - L]
+    response_sum = np.zeros((n_rois, len(lags))) # sum of r[k] with noise at k - L
+    samples = np.zeros(len(lags), dtype=np.int64)
+
+    for a in range(0, n_frames, chunk_frames):
+        b = min(a + chunk_frames, n_frames)
+        response = np.asarray(block[:, a:b], dtype=np.float64)
+        # Stimulus of the imaging frames [a - hi_lag, b - lo_lag), zero outside the recording
+        start = a - hi_lag
+        stimulus = np.zeros((b - a + hi_lag - lo_lag, pixels), dtype=np.float32)
+        shown = np.zeros(len(stimulus), dtype=bool)
+        inside = max(start, 0), min(b - lo_lag, n_frames)
+        if inside[1] > inside[0]:
+            s, v = binned_stimulus(contrast, frames, textures, *inside)
+            stimulus[inside[0] - start:inside[1] - start] = s
+            shown[inside[0] - start:inside[1] - start] = v
+        for j, lag in enumerate(lags):
+            s = stimulus[a - lag - start:b - lag - start]
+            v = shown[a - lag - start:b - lag - start]
+            weighted[:, j] += response @ s
+            stimulus_sum[j] += s.sum(axis=0)
+            response_sum[:, j] += response @ v
+            samples[j] += np.count_nonzero(v)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_response = response_sum / samples
+        sta = (weighted - mean_response[:, :, None] * stimulus_sum) / samples[:, None]
+    return first, sta.astype(np.float32), samples
+
+
+def reverse_correlation(traces, log, stimdict, lags=range(10), seed=None, offset=IMAGING_FRAME_OFFSET,
+                        framerate=None, processes=1, block_rois=None, chunk_frames=CHUNK_FRAMES, out=None):
+
+    """ Response-triggered averages of the ternary noise for all ROIs
+
+    :param traces: (n_rois, n_imaging_frames) array, memmap or .npy filename
+    :param log: `framelog.FrameLog` of the session
+    :param stimdict: stimulus dictionary (helper.Stimulus) of the session
+    :param lags: imaging frames between stimulus and response
+    :param seed: seed of the session (default: config.SEED)
+    :param offset: see `stimulus_samples`
+    :param framerate: see `stimulus_samples`
+    :param processes: worker processes (1: this process)
+    :type processes: int
+    :param block_rois: ROIs per block (default: BLOCK_BYTES of accumulators)
+    :param chunk_frames: imaging frames per chunk
+    :param out: (n_rois, n_lags, rows, cols) float32 array to fill, e.g.
+        np.lib.format.open_memmap for results larger than the memory
+    :returns: dict with sta (NaN for lags without noise), lags, samples
+        (imaging frames averaged per lag) and imaging_rate (Hz)
+
+    """
+    lags = [int(lag) for lag in lags]
+    contrast, shape = contrast_stack(stimdict, seed)
+    frames, textures = stimulus_samples(log, stimdict, len(contrast), offset, framerate)
+    source = load_traces(traces) if isinstance(traces, str) else traces
+    n_rois = source.shape[0]
+    if out is None:
+        out = np.empty((n_rois, len(lags)) + tuple(shape), dtype=np.float32)
+    if block_rois is None:
+        block_rois = max(1, BLOCK_BYTES // (8 * (len(lags) + 1) * contrast.shape[1]))
+
+    def jobs():
+        for first in range(0, n_rois, block_rois):
+            last = min(first + block_rois, n_rois)
+            if isinstance(traces, str) or processes == 1:
+                yield traces, first, last, lags, chunk_frames, False
+            else: # workers open a file themselves, arrays are sent block by block
+                yield np.asarray(source[first:last]), first, last, lags, chunk_frames, True
+
+    samples = None
+    if processes == 1:
+        _share(contrast, frames, textures)
+        results = map(_sta_block, jobs())
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_share, initargs=(contrast, frames, textures))
+        results = pool.imap_unordered(_sta_block, jobs())
+    try:
+        for first, sta, samples in results:
+            out[first:first + len(sta)] = sta.reshape((len(sta), len(lags)) + tuple(shape))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return {'sta': out, 'lags': np.array(lags), 'samples': samples, 'imaging_rate': imaging_rate(log)}
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" 1D receptive fields from standing stripe sessions (stimtype "SSR").
+
+standing_stripes_random flashes a bar at shuffled positions and logs its
+position (xPos for 0 deg bars, yPos for 90 deg bars) in every frame of the
+flash and NaN between flashes. `flashes` finds the flashes in the frame log
+and the imaging frames they were shown in; `position_tuning` averages the
+response of every ROI to the flashes at each position (one index array for
+all ROIs, read in blocks so that the traces can be memory-mapped) and
+`fit_gaussian` fits the centre and width of all tuning curves at once:
+
+    log = framelog.read_frame_log('..._stimulus_output_537_41.txt')
+    tuning = position_tuning(trials.load_traces('traces.npy'), log, window=(1, 6))
+    tuning[0]['fit']['centre'], tuning[0]['fit']['fwhm'] # per ROI, degrees
+
+Sessions recorded without the frame counter (MAXRUNTIME 0 in the stimulus
+file) are aligned with the imaging frame rate instead (rate, see
+trials.imaging_frames).
+
+"""
+
+import numpy as np
+
+from modules.trials import IMAGING_FRAME_OFFSET, imaging_frames
+
+BLOCK_BYTES = 64 * 1024 * 1024 # traces read per block of ROIs
+FIT_FLOOR = 0.1 # points below this fraction of the peak are not fitted
+FWHM_FACTOR = 2 * np.sqrt(2 * np.log(2))
+
+
+def stripe_axes(log, stimdict=None):
+
+    """ Position column of every standing stripe epoch
+
+    :param log: `framelog.FrameLog`
+    :param stimdict: stimulus dictionary. Without it, the epochs are those
+        with NaN positions in the log and the column is the one that varies
+    :returns: {epoch: 'xpos' (0 deg bars) or 'ypos' (90 deg bars)}
+
+    """
+    if stimdict is not None:
+        return {epoch: 'ypos' if stimdict["bar.orientation"][epoch] == 90 else 'xpos'
+                for epoch, stimtype in enumerate(stimdict["stimtype"])
+                if stimtype in ("SSR", "stripe(s)", "stripe")}
+    axes = {}
+    for epoch in np.unique(log['epoch'][np.isnan(log['xpos'])]):
+        rows = log.rows[(log['epoch'] == epoch) & ~np.isnan(log['xpos'])]
+        axes[int(epoch)] = 'ypos' if np.ptp(rows['ypos']) > np.ptp(rows['xpos']) else 'xpos'
+    return axes
+
+
+def flashes(log, stimdict=None, offset=IMAGING_FRAME_OFFSET, rate=None):
+
+    """ Bar flashes of the standing stripe epochs
+
+    :param log: `framelog.FrameLog`
+    :param stimdict: see `stripe_axes`
+    :param offset: see trials.imaging_frames
+    :param rate: see trials.imaging_frames
+    :returns: dict of arrays, one value per flash: epoch, position, onset
+        (imaging frame of the first frame of the bar) and frames (imaging
+        frames until the bar disappears)
+
+    """
+    axes = stripe_axes(log, stimdict)
+    position = np.full(len(log), np.nan)
+    for epoch, axis in axes.items():
+        rows = log['epoch'] == epoch
+        position[rows] = log[axis][rows]
+    shown = ~np.isnan(position)
+
+    # A flash starts where a bar appears or moves (or the epoch changes)
+    previous = np.concatenate(([np.nan], position[:-1]))
+    epoch_change = np.concatenate(([True], log['epoch'][1:] != log['epoch'][:-1]))
+    starts = np.flatnonzero(shown & ((previous != position) | epoch_change))
+    ends = np.flatnonzero(shown & ~np.concatenate((shown[1:], [False]))
+                          | shown & np.concatenate((position[1:] != position[:-1], [True]))
+                          | shown & np.concatenate((epoch_change[1:], [True])))
+
+    frames = imaging_frames(log, offset, rate)
+    return {'epoch': log['epoch'][starts], 'position': position[starts],
+            'onset': frames[starts], 'frames': frames[ends] - frames[starts] + 1}
+
+
+def _block_rois(traces, index):
+    per_roi = traces.shape[1] + index.size
+    return max(1, BLOCK_BYTES // (8 * per_roi))
+
+
+def flash_responses(traces, onsets, window, baseline=None, block_rois=None):
+
+    """ Mean response of every ROI to every flash
+
+    :param traces: (n_rois, n_imaging_frames) array or memmap
+    :param onsets: imaging frames of the flashes (see `flashes`)
+    :param window: (start, stop) imaging frames after the onset
+    :type window: tuple
+    :param baseline: mean of that many frames before the onset subtracted
+    :type baseline: int
+    :param block_rois: ROIs read at once
+    :returns: (n_rois, n_flashes) array, NaN for flashes whose frames are
+        not all within the recording
+
+    """
+    n_rois, n_frames = traces.shape
+    index = onsets[:, None] + np.arange(*window)
+    if baseline:
+        index = np.concatenate((onsets[:, None] + np.arange(-baseline, 0), index), axis=1)
+    inside = (index.min(axis=1) >= 0) & (index.max(axis=1) < n_frames)
+    index = np.where(inside[:, None], index, 0)
+    if block_rois is None:
+        block_rois = _block_rois(traces, index)
+
+    responses = np.empty((n_rois, len(onsets)))
+    for first in range(0, n_rois, block_rois):
+        block = np.asarray(traces[first:first + block_rois], dtype=np.float64)[:, index]
+        if baseline:
+            values = block[:, :, baseline:].mean(axis=2) - block[:, :, :baseline].mean(axis=2)
+        else:
+            values = block.mean(axis=2)
+        responses[first:first + block_rois] = values
+    responses[:, ~inside] = np.nan
+    return responses
+
+
+def fit_gaussian(positions, curves, polarity=1):
+
+    """ Gaussian fits of many tuning curves at once
+
+    Weighted least squares of the logarithm of the curves above their
+    minimum (Guo's method, weights: the squared values), on the points above
+    FIT_FLOOR of the peak.
+
+    :param positions: (n_positions,) array
+    :param curves: (n_rois, n_positions) array
+    :param polarity: -1 fits the troughs (responses of opposite sign)
+    :type polarity: int
+    :returns: dict of (n_rois,) arrays: centre, sigma, fwhm, amplitude,
+        offset and r2 (NaN where no peak can be fitted)
+
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    curves = polarity * np.asarray(curves, dtype=np.float64)
+    offset = np.nanmin(curves, axis=1)
+    y = curves - offset[:, None]
+    peak = np.nanmax(y, axis=1)
+    used = (y > FIT_FLOOR * peak[:, None]) & ~np.isnan(y)
+    weights = np.where(used, y, 0) ** 2
+
+    # Positions scaled to [-1,1] for a well-conditioned system
+    centre, scale = positions.mean(), max(np.ptp(positions) / 2, 1e-12)
+    x = (positions - centre) / scale
+    powers = x[None, :] ** np.arange(5)[:, None] # x^0 .. x^4
+    log_y = np.where(used, np.log(np.where(used, y, 1)), 0)
+    matrix = np.einsum('rp,kp->rk', weights, powers) # sums of w x^k
+    system = np.stack([matrix[:, i:i + 3] for i in range(3)], axis=1)
+    rhs = np.einsum('rp,kp->rk', weights * log_y, powers[:3])
+
+    solvable = (used.sum(axis=1) >= 3) & (np.abs(np.linalg.det(system)) > 1e-12)
+    coef = np.full((len(curves), 3), np.nan)
+    coef[solvable] = np.linalg.solve(system[solvable], rhs[solvable][:, :, None])[:, :, 0]
+    a, b, c = coef.T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        peaked = c < 0
+        sigma = np.where(peaked, np.sqrt(-1 / (2 * c)), np.nan)
+        mu = np.where(peaked, -b / (2 * c), np.nan)
+        amplitude = np.where(peaked, np.exp(a - b ** 2 / (4 * c)), np.nan)
+        model = amplitude[:, None] * np.exp(-(x[None, :] - mu[:, None]) ** 2 / (2 * sigma[:, None] ** 2))
+        residual = np.nansum((y - model) ** 2, axis=1)
+        total = np.nansum((y - np.nanmean(y, axis=1)[:, None]) ** 2, axis=1)
+        r2 = np.where(peaked, 1 - residual / total, np.nan)
+
+    return {'centre': centre + mu * scale, 'sigma': sigma * scale,
+            'fwhm': FWHM_FACTOR * sigma * scale, 'amplitude': polarity * amplitude,
+            'offset': polarity * offset, 'r2': r2}
+
+
+def position_tuning(traces, log, stimdict=None, window=None, baseline=None, polarity=1,
+                    offset=IMAGING_FRAME_OFFSET, rate=None, block_rois=None):
+
+    """ Position tuning curves and receptive field fits of all ROIs, per
+    standing stripe epoch
+
+    :param traces: (n_rois, n_imaging_frames) array or memmap (see trials.load_traces)
+    :param log: `framelog.FrameLog` of the session
+    :param stimdict: see `stripe_axes`
+    :param window: (start, stop) imaging frames after the onset (default:
+        the frames of the shortest flash)
+    :param baseline: see `flash_responses`
+    :param polarity: see `fit_gaussian`
+    :param offset: see trials.imaging_frames
+    :param rate: see trials.imaging_frames
+    :param block_rois: see `flash_responses`
+    :returns: {epoch: dict} with axis, positions (sorted), flashes (per
+        position), mean and sem ((n_rois, n_positions)) and fit (see `fit_gaussian`)
+
+    """
+    found = flashes(log, stimdict, offset, rate)
+    if not len(found['onset']):
+        return {}
+    if window is None:
+        window = (0, int(found['frames'].min()))
+    responses = flash_responses(traces, found['onset'], window, baseline, block_rois)
+    axes = stripe_axes(log, stimdict)
+
+    tuning = {}
+    for epoch in np.unique(found['epoch']):
+        mask = (found['epoch'] == epoch) & ~np.isnan(responses).all(axis=0)
+        positions, group = np.unique(found['position'][mask], return_inverse=True)
+        counts = np.bincount(group, minlength=len(positions))
+        # Sums per position for all ROIs: responses @ one-hot
+        onehot = np.zeros((len(group), len(positions)))
+        onehot[np.arange(len(group)), group] = 1
+        values = responses[:, mask]
+        mean = values @ onehot / counts
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = (values ** 2 @ onehot - counts * mean ** 2) / (counts - 1)
+            sem = np.sqrt(np.maximum(var, 0) / counts)
+        sem[:, counts < 2] = np.nan
+        tuning[int(epoch)] = {'axis': axes[int(epoch)], 'positions': positions, 'flashes': counts,
+                              'mean': mean, 'sem': sem, 'window': window,
+                              'fit': fit_gaussian(positions, mean, polarity)}
+    return tuning
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Random numbers of the stimuli: named, independent and seekable streams.
+
+Every random draw of a session comes from one `RandomStreams`, seeded with
+config.SEED. A stream is identified by its name (STREAMS) and a value is
+addressed by a unit: up to three integers, e.g. (epoch, frame). The
+generator of a unit is a counter-based Philox generator whose key is the
+seed and the stream and whose counter starts at the unit, so the values of
+any frame are computed directly, without replaying the frames before it,
+and streams never overlap:
+
+    streams = RandomStreams(config.SEED)
+    noise = streams.generator('noise', epoch, frameN).standard_normal((128, 128))
+
+config.RNG_MODE 'legacy' keeps the draws of the streams in LEGACY_STREAMS:
+`random_state` gives numpy's RandomState(seed) for them. It reproduces the
+bar positions and ternary textures of the sessions recorded since 2020, and
+the epoch order of helper.epoch_schedule since it is seeded. Older
+sessions shuffled their epochs without a seed; their order cannot be drawn
+again, only read from the metadata (epoch_schedule) or the frame log.
+These values are materialised up front (epoch schedule, shuffled
+positions, texture stack), so they are also read directly per frame. With
+'counter' they are drawn from Philox streams as well.
+
+"""
+
+import numpy as np
+
+from modules import config
+
+# Stream ids are part of the key: never renumber, only append
+STREAMS = {'epoch_order': 1, 'positions': 2, 'ternary': 3, 'noise': 4, 'snr_ladder': 5, 'dots': 6}
+LEGACY_STREAMS = ('epoch_order', 'positions', 'ternary')
+RNG_MODES = ('legacy', 'counter')
+SEED_BITS = 64
+
+
+class RandomStreams(object):
+    """ Named random streams of a session
+
+        :param seed: default: config.SEED
+        :type seed: int
+        :param mode: 'legacy' or 'counter' (default: config.RNG_MODE)
+        :type mode: str
+
+    """
+
+    def __init__(self, seed=None, mode=None):
+        self.seed = int(config.SEED if seed is None else seed)
+        self.mode = config.RNG_MODE if mode is None else mode
+        if self.mode not in RNG_MODES:
+            raise ValueError('RNG mode %r is not one of %s' % (self.mode, ', '.join(RNG_MODES)))
+        if not 0 <= self.seed < 2 ** SEED_BITS:
+            raise ValueError('Seed %r is not an unsigned %d-bit integer' % (self.seed, SEED_BITS))
+
+    def key(self, name):
+        """ Philox key of a stream: the seed and the stream id """
+        if name not in STREAMS:
+            raise KeyError('Unknown random stream %r (%s)' % (name, ', '.join(STREAMS)))
+        return self.seed | (STREAMS[name] << SEED_BITS)
+
+    def generator(self, name, *unit):
+
+        """ Generator of one unit of a stream, in O(1) for any unit
+
+        :param name: stream, see STREAMS
+        :type name: str
+        :param unit: up to 3 non-negative integers, e.g. (epoch, frame)
+        :returns: numpy.random.Generator
+
+        """
+        if len(unit) > 3:
+            raise ValueError('A unit has at most 3 indices, got %r' % (unit,))
+        # Counter word 0 counts the draws within the unit, words 1-3 are the unit
+        counter = np.zeros(4, dtype=np.uint64)
+        counter[1:1 + len(unit)] = unit
+        return np.random.Generator(np.random.Philox(key=self.key(name), counter=counter))
+
+    def is_legacy(self, name):
+        """ True if the stream keeps the draws of the recorded sessions """
+        return self.mode == 'legacy' and name in LEGACY_STREAMS
+
+    def random_state(self, name, *unit):
+
+        """ Generator of a stream with the legacy draws if `is_legacy`:
+        numpy.random.RandomState(seed), the same for every unit (see the
+        module docstring for which sessions it reproduces). Otherwise
+        `generator`.
+
+        """
+        if self.is_legacy(name):
+            return np.random.RandomState(self.seed)
+        return self.generator(name, *unit)
+
+    def stack(self, name, count, draw, *unit):
+
+        """ Values of consecutive units, e.g. the noise frames of an epoch
+
+        :param count: number of units; the last index of unit runs over 0 .. count - 1
+        :type count: int
+        :param draw: function of a generator returning the values of one unit
+        :returns: numpy array, (count,) + shape of one unit
+
+        """
+        return np.stack([draw(self.generator(name, *(unit + (k,)))) for k in range(count)])
+
+    def metadata(self):
+        """ Rows for helper.append_main_setup """
+        return {'rng_mode': self.mode, 'rng_seed': self.seed}
+
+
+def session_streams(stimdict=None):
+    """ Streams of a session: config.SEED, config.RNG_MODE unless the stimulus
+    file sets RNG_MODE (header) """
+    mode = stimdict.get("RNG_MODE") if stimdict is not None else None
+    return RandomStreams(config.SEED, mode)
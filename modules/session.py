@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Presentation of a session: the stimulus objects per epoch and the main
+loop over the epoch schedule.
+
+Shared by main and by the dry run (see ``simulation``), which passes a
+simulated window, clock and DAQ instead of the real ones.
+
+"""
+
+from psychopy import visual
+
+from modules.helper import *
+from modules.exceptions import *
+from modules import helper
+from modules import stimlog
+from modules import controls
+from modules import stimuli
+
+
+def create_stimulus_objects(win, stimdict, visual=visual):
+
+    """ Creates the stimulus object per epoch
+
+    :param win: the window where the stimuli are drawn
+    :type win: visual.Window
+    :param stimdict: stimulus attributes (see `helper.Stimulus`)
+    :type stimdict: dict
+    :param visual: where the stimulus classes come from, psychopy.visual by
+        default. The dry run passes `simulation.SimulatedVisual`
+    :returns: list with one stimulus object per epoch ([grating, dots] for "DG")
+
+    """
+    _units = stimulus_units(stimdict)
+    if _units == 'degPerspective':
+        from modules import perspective_correction # the units are registered on import
+    stim_object_ls = list()
+    for i,stimtype in enumerate(stimdict["stimtype"]):
+
+        if stimtype[-1] == "C":
+            circle = visual.Circle(win, units=_units, edges = 128)
+            stim_object = circle
+
+        elif stimtype ==  "SSR":
+            bar = visual.Rect(win, lineWidth=0, units=_units)
+            stim_object = bar
+
+        elif stimtype ==  "R":
+            bar = visual.Rect(win, lineWidth=0, units=_units)
+            stim_object = bar
+
+        elif stimtype ==  "DS":
+            bar = visual.Rect(win, lineWidth=0, units=_units)
+            stim_object = bar
+
+        elif stimtype == "N":
+            noise = visual.GratingStim(win,units=_units, name='noise',tex='sqr')
+            stim_object = noise
+
+        elif stimtype ==  "DG":
+            grating = visual.GratingStim(win,units=_units, name='grating',
+                                         tex='sqr',colorSpace='rgb',blendmode='avg',
+                                         texRes=128, interpolate=True, depth=-1.0,
+                                         phase = (0,0))
+            dots = visual.DotStim( win=win, name='dots', units=_units,
+                                  nDots=int(stimdict["nDots"][i]), dotSize=5,
+                                  speed=0.1, dir=0.0, coherence=1.0,
+                                  fieldPos=(0.0, 0.0), fieldSize=2.0,
+                                  fieldShape='square',signalDots='same',
+                                  noiseDots='position',dotLife=3,
+                                  color=[-1.0,-0.7366,-0.7529], colorSpace='rgb',
+                                  opacity=1, depth=-1.0)
+            stim_object =[grating,dots]
+
+        elif stimtype[-1:] in ("G", "g"): # G, noisygrating, lumgrating, TFgrating
+            grating = visual.GratingStim(win,units=_units, name='grating',
+                                         tex='sqr',colorSpace='rgb',
+                                         blendmode='avg',texRes=128,
+                                         interpolate=True, depth=-1.0,
+                                         phase = (0,0))
+            # noise = visual.NoiseStim(win,units=_units, name='noise',
+            #                          colorSpace='rgb',noiseType='Binary',
+            #                          noiseElementSize=0.0625,noiseBaseSf=8.0,
+            #                          noiseBW=1,noiseBWO=30, noiseOri=0.0,
+            #                          noiseFractalPower=0.0,noiseFilterLower=1.0,
+            #                          noiseFilterUpper=8.0, noiseFilterOrder=0.0,
+            #                          noiseClip=3.0, interpolate=False, depth=0.0)
+            # noise.buildNoise()
+            stim_object =grating
+
+        stim_object_ls.append(stim_object)
+
+    return stim_object_ls
+
+
+def warm_up(win, stim_object_ls):
+
+    """ Draws every stimulus object once into the back buffer and clears it,
+    so that shaders and vertex buffers are created before the first frame
+    (nothing is shown, the window is not flipped)
+
+    :param stim_object_ls: as returned by `create_stimulus_objects`
+    :type stim_object_ls: list
+
+    """
+    for stim_object in stim_object_ls:
+        for stim in (stim_object if isinstance(stim_object, list) else [stim_object]):
+            stim.draw()
+    if hasattr(win, 'clearBuffer'):
+        win.clearBuffer()
+
+
+def epoch_preparer(exp_Info, bg_ls, fg_ls, textures, stimdict, scr_width, scr_distance):
+
+    """ Returns the function preparing the resources of one epoch, for the
+    `prefetch.EpochPrefetcher`
+
+    :param textures: as returned by `textures.generate_textures`
+    :type textures: tuple
+
+    """
+    stim_texture_ls, noise_array_ls, stim_texture = textures[:3]
+
+    def prepare(e):
+        if stimdict["stimtype"][e] == "N":
+            return stimuli.prepare_epoch(exp_Info,bg_ls,fg_ls,stim_texture,None,stimdict,e,
+                                         scr_width,scr_distance)
+        return stimuli.prepare_epoch(exp_Info,bg_ls,fg_ls,stim_texture_ls[e],noise_array_ls[e],
+                                     stimdict,e,scr_width,scr_distance)
+    return prepare
+
+
+def run_epochs(win, stimdict, exp_Info, schedule, prefetcher, stim_object_ls, bg_ls, fg_ls,
+               textures, viewpos, out, outFile, dlp_ok, global_clock, nidaq, maxruntime,
+               profiler=None, realtime=None):
+
+    """ Main Loop which calls the functions to draw stim on screen.
+
+    It displays the stimulus unless:
+        keyboard key is pressed (manual stop, see `controls`)
+        stop condition becomse "True"
+        end of the schedule (session_runtime reached)
+
+    :param schedule: Epoch order of the whole session (see `helper.epoch_schedule`)
+    :type schedule: numpy integer array
+    :param prefetcher: prepares the resources of the upcoming epochs
+    :type prefetcher: prefetch.EpochPrefetcher
+    :param textures: as returned by `textures.generate_textures`
+    :type textures: tuple
+    :param nidaq: as returned by `helper.start_nidaq`
+    :type nidaq: tuple
+    :param maxruntime: global maximal runtime (config.MAXRUNTIME)
+    :type maxruntime: float
+    :param profiler: times the stages of every frame (see config.PROFILE_FRAMES)
+    :type profiler: profiling.FrameProfiler or None
+    :param realtime: garbage collection only between epochs (see config.REALTIME_MODE)
+    :type realtime: realtime.RealtimeMode or None
+    :returns: the Output of the last frame
+
+    """
+    (stim_texture_ls, noise_array_ls, stim_texture, _useTex, _useNoise) = textures
+    (counterTaskHandle, pulseTaskHandle, data, lastDataFrame, lastDataFrameStartTime) = nidaq
+    MAXRUNTIME = maxruntime
+    current_index = 0
+    stop = False
+    abort = controls.install(win)
+
+    while not (abort.stop_after_epoch or stop or current_index >= len(schedule)):
+        #print(f'WHILE LOOP STARTS: {global_clock.getTime()}')
+
+        # next epoch from the schedule, its resources are (being) prepared
+        epoch = int(schedule[current_index])
+        prepared = prefetcher.get(current_index)
+        current_index += 1
+        stimlog.log('epoch', '---------------------\nPresented epoch: {epoch}', epoch=epoch)
+
+        # Data for Output file
+        out.boutInd = out.boutInd + 1
+        out.epochchoose = epoch
+
+        # Reset epoch timer
+        duration_clock = global_clock.getTime()
+        stimlog.log('epoch_start', 'STIM SELECTION STARTS: {time}', time=duration_clock)
+        if realtime:
+            realtime.begin_epoch()
+        try:
+
+            # Functions that draw the different stimuli
+            if stimdict["stimtype"][epoch] == "SSR":
+
+                (out, lastDataFrame, lastDataFrameStartTime) = stimuli.standing_stripes_random(bg_ls,fg_ls,stimdict,epoch, win, global_clock,duration_clock,outFile,
+                                                                out,stim_object_ls[epoch],dlp_ok,counterTaskHandle,data, lastDataFrame, lastDataFrameStartTime, prepared=prepared, profiler=profiler)
+
+            elif stimdict["stimtype"][epoch][-1]== "C":
+
+                (out, lastDataFrame, lastDataFrameStartTime) = stimuli.field_flash(bg_ls,fg_ls,stim_texture_ls[epoch],noise_array_ls[epoch],stimdict,epoch, win, global_clock,duration_clock,outFile,
+                                                                out,stim_object_ls[epoch],dlp_ok, viewpos, data, counterTaskHandle, lastDataFrame, lastDataFrameStartTime, prepared=prepared, profiler=profiler)
+
+            elif stimdict["stimtype"][epoch][-1]== "R":
+
+                (out, lastDataFrame, lastDataFrameStartTime) = stimuli.field_flash(bg_ls,fg_ls,stim_texture_ls[epoch],noise_array_ls[epoch],stimdict,epoch, win, global_clock,duration_clock,outFile,
+                                                                out,stim_object_ls[epoch],dlp_ok, viewpos, data, counterTaskHandle, lastDataFrame, lastDataFrameStartTime, prepared=prepared, profiler=profiler)
+
+            elif stimdict["stimtype"][epoch] == "DS":
+                #print(f'FUNCTION CALLED: {global_clock.getTime()}')
+                (out, lastDataFrame, lastDataFrameStartTime) = stimuli.drifting_stripe(exp_Info,bg_ls,fg_ls,stimdict,epoch, win, global_clock,duration_clock,outFile,
+                                                                out,stim_object_ls[epoch],dlp_ok, viewpos, data, counterTaskHandle, lastDataFrame, lastDataFrameStartTime, prepared=prepared, profiler=profiler)
+
+
+            elif stimdict["stimtype"][epoch] == "N":
+
+                (out, lastDataFrame, lastDataFrameStartTime) = stimuli.stim_noise(bg_ls,stim_texture,stimdict,epoch, win, global_clock,duration_clock,outFile,
+                                                                out,stim_object_ls[epoch],dlp_ok,counterTaskHandle,data, lastDataFrame, lastDataFrameStartTime, prepared=prepared, profiler=profiler)
+
+            elif stimdict["stimtype"][epoch] == "DG":
+
+                (out, lastDataFrame, lastDataFrameStartTime)= stimuli.dotty_grating(_useNoise,_useTex,viewpos,bg_ls,stim_texture_ls[epoch],stimdict,epoch, win, global_clock,duration_clock,outFile,
+                                                                out,stim_object_ls[epoch][0],stim_object_ls[epoch][1],dlp_ok,counterTaskHandle,data, lastDataFrame, lastDataFrameStartTime, profiler=profiler)
+
+            elif stimdict["stimtype"][epoch][-1:] in ("G", "g"):
+
+                (out, lastDataFrame, lastDataFrameStartTime)= stimuli.noisy_grating(_useNoise,_useTex,viewpos,bg_ls,stim_texture_ls[epoch],noise_array_ls[epoch],stimdict,epoch, win, global_clock,duration_clock,outFile,
+                                                                out,stim_object_ls[epoch],dlp_ok,counterTaskHandle,data, lastDataFrame, lastDataFrameStartTime, profiler=profiler)
+
+
+            else: raise StimulusError(stimdict["stimtype"][epoch],epoch)
+
+            # Irregular stop conditions:
+            # "and not stimdict["MAXRUNTIME"]==0" is an quick fix to test stim
+            # on dlp without mic. Important for SEARCH Stimulus
+            if (dlp_ok and (global_clock.getTime() - lastDataFrameStartTime > 1)
+                and not stimdict["MAXRUNTIME"]==0):
+                raise MicroscopeException(lastDataFrame,lastDataFrameStartTime,global_clock.getTime())
+            elif (dlp_ok and (global_clock.getTime() >= stimdict["MAXRUNTIME"])
+                  and not stimdict["MAXRUNTIME"]==0):
+                raise StimulusTimeExceededException(stimdict["MAXRUNTIME"],global_clock.getTime())
+            elif (global_clock.getTime() >= MAXRUNTIME) and not stimdict["MAXRUNTIME"]==0:
+                raise GlobalTimeExceededException(MAXRUNTIME,global_clock.getTime())
+
+        # Real Errors
+        except StimulusError as e:
+            print ('Stimulus function could not be executed. Stimtype:', e.type)
+            print ('At epoch:', e.epoch)
+            raise
+        except getattr(helper.daq, 'DAQError', ()) as err: # helper.daq may be simulated
+            print ("DAQmx Error: %s"%err)
+        # Irregular stop conditions:
+        except (MicroscopeException, StimulusTimeExceededException, GlobalTimeExceededException) as e:
+            pass
+            print ("A stop condition became true: " )
+            print ("Time of %s was exceeded by current time %s at microscope frame %s. Maybe better use testmode (no DLP)?" %(e.spec_time,e.time,getattr(e,'frame',None)))
+            print (e)
+            stop = True
+        # Manual stop from stimulus:
+        except StopExperiment:
+            print('##############################################')
+            print ("Stopped experiment manually")
+            stop = True
+
+        if realtime:
+            realtime.end_epoch()
+        if profiler:
+            profiler.end_epoch()
+
+    if abort.stop_after_epoch and not abort.stop_now:
+        print ("Stopped experiment manually after the epoch")
+    controls.uninstall(win)
+    return out
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Dry run of a stimulus file: a whole session on a virtual clock.
+
+The window, the clock and the NI-DAQ are replaced by simulated versions,
+everything else is the code of a real session (epoch schedule, stimulus
+functions, per-frame logic, output and metadata files). Time only moves
+when the window flips, by one frame (1/FRAMERATE), so a session runs as
+fast as the per-frame logic allows and the frame log is the one a session
+without dropped frames would produce.
+
+The simulated microscope starts scanning at the trigger and sends one frame
+every 1/SIMULATED_SCAN_RATE seconds.
+
+Example:
+    from modules.simulation import dry_run
+    outfile, metafile = dry_run('stimuli_collection/my_stim.txt', out_dir='dry_run')
+
+"""
+
+import os
+import ctypes
+import contextlib
+import numpy as np
+import psychopy
+
+from modules.helper import *
+from modules import helper
+from modules import config
+from modules.prefetch import EpochPrefetcher
+from modules.profiling import FrameProfiler
+from modules.realtime import RealtimeMode
+from modules import stimlog
+from modules import dlp_pattern
+from modules.preparation import pattern_metadata
+from modules import catalog
+from modules.rng import session_streams
+from modules.diagnostics import grating_diagnostics, metadata_values
+from modules.timing import session_framerate, frame_timing
+from modules.textures import generate_textures
+from modules.session import create_stimulus_objects, epoch_preparer, warm_up, run_epochs
+
+
+class VirtualClock(object):
+    """ Stand-in for psychopy core.Clock. Time is only advanced explicitly """
+
+    def __init__(self):
+        self._time = 0.0
+
+    def getTime(self):
+        return self._time
+
+    def reset(self, newT=0.0):
+        self._time = newT
+
+    def advance(self, seconds):
+        self._time += seconds
+
+
+class SimulatedWindow(object):
+    """ Stand-in for the psychopy window. Every flip advances the clock by one frame
+
+        :param clock: the clock of the session
+        :type clock: VirtualClock
+
+    """
+
+    def __init__(self, clock, framerate=None, screen_width=None, distance=None, size=(500, 500)):
+        self.clock = clock
+        self.framerate = config.FRAMERATE if framerate is None else framerate
+        self.scrWidthCM = config.SCREEN_WIDTH if screen_width is None else screen_width
+        self.scrDistCM = config.DISTANCE if distance is None else distance
+        self.size = np.array(size)
+        self.color = [-1, -1, -1]
+        self.colorSpace = 'rgb'
+        self.frameN = 0
+
+    def flip(self, clearBuffer=True):
+        self.frameN += 1
+        self.clock.advance(1.0 / self.framerate)
+
+    def getActualFrameRate(self, *args, **kwargs):
+        return self.framerate
+
+    def close(self):
+        pass
+
+
+class SimulatedStim(object):
+    """ Stand-in for a psychopy stimulus. Attributes are only stored, drawing does nothing """
+
+    _arrays = ('pos', 'size', 'phase', 'fieldPos', 'fieldSize')
+
+    def __init__(self, win=None, **kwargs):
+        self.win = win
+        self.pos = (0.0, 0.0)
+        self.size = (0.5, 0.5)
+        self.phase = (0.0, 0.0)
+        self.ori = 0.0
+        self.opacity = 1.0
+        self.tex = None
+        self.mask = None
+        self.autoDraw = False
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def __setattr__(self, name, value):
+        # as in psychopy, positions and phases are float arrays (changed in place)
+        if name in self._arrays:
+            value = np.array(value, dtype=float)
+        object.__setattr__(self, name, value)
+
+    def draw(self, win=None):
+        pass
+
+    def setAutoDraw(self, value, log=None):
+        self.autoDraw = value
+
+    def setPhase(self, value, operation='', log=None):
+        self.phase = value if operation == '' else self.phase + value
+
+    def refreshDots(self):
+        pass
+
+
+class SimulatedVisual(object):
+    """ Stimulus classes for `session.create_stimulus_objects` in a dry run """
+    Circle = Rect = GratingStim = DotStim = SimulatedStim
+
+
+class SimulatedDAQError(Exception):
+    pass
+
+
+class SimulatedDAQ(object):
+    """ Stand-in for the PyDAQmx module (only what the session uses).
+
+    The pulse task triggers the microscope, which then starts a frame every
+    1/scan_rate seconds. The counter task counts those frames.
+
+        :param clock: the clock of the session
+        :type clock: VirtualClock
+        :param scan_rate: microscope frames per second
+        :type scan_rate: float
+
+    """
+
+    TaskHandle = ctypes.c_ulong
+    uInt32 = ctypes.c_uint32
+    byref = staticmethod(ctypes.byref)
+    DAQError = SimulatedDAQError
+    DAQmx_Val_Rising = DAQmx_Val_CountUp = DAQmx_Val_Seconds = DAQmx_Val_Low = 0
+
+    def __init__(self, clock, scan_rate=None):
+        self.clock = clock
+        self.scan_rate = config.SIMULATED_SCAN_RATE if scan_rate is None else scan_rate
+        self.trigger_time = None
+        self.pulse_task = None
+        self._tasks = {}
+
+    def DAQmxCreateTask(self, name, taskHandle_ref):
+        handle = len(self._tasks) + 1
+        taskHandle_ref._obj.value = handle
+        self._tasks[handle] = name
+
+    def DAQmxCreateCICountEdgesChan(self, taskHandle, *args):
+        pass
+
+    def DAQmxCreateCOPulseChanTime(self, taskHandle, *args):
+        self.pulse_task = taskHandle.value
+
+    def DAQmxStartTask(self, taskHandle):
+        if taskHandle.value == self.pulse_task:
+            self.trigger_time = self.clock.getTime()
+
+    def DAQmxReadCounterScalarU32(self, taskHandle, timeout, data_ref, reserved):
+        data_ref._obj.value = self.microscope_frames()
+
+    def DAQmxStopTask(self, taskHandle):
+        pass
+
+    def DAQmxClearTask(self, taskHandle):
+        self._tasks.pop(taskHandle.value, None)
+
+    def microscope_frames(self):
+        """ Number of frames the microscope has started since the trigger """
+        if self.trigger_time is None:
+            return 0
+        return int((self.clock.getTime() - self.trigger_time) * self.scan_rate) + 1
+
+
+@contextlib.contextmanager
+def simulated_daq(clock, scan_rate=None):
+
+    """ Replaces the NI-DAQ driver used by helper with a `SimulatedDAQ` """
+
+    original = helper.daq
+    helper.daq = SimulatedDAQ(clock, scan_rate)
+    try:
+        yield helper.daq
+    finally:
+        helper.daq = original
+
+
+def dry_run(path_stimfile, out_dir='.', dlp_ok=True, scan_rate=None, exp_Info=None,
+            window=None, visual=None, realtime=False):
+
+    """ Runs a whole session of a stimulus file on a virtual clock.
+
+    Same steps as main, without the dialogs, the window and the pause after
+    the trigger (the clock jumps to its end after the preparation).
+
+    :param path_stimfile: the path to the stimulus txt file
+    :type path_stimfile: str
+    :param out_dir: where the output and metadata files are written
+    :type out_dir: path
+    :param dlp_ok: simulates a session with DLP and microscope (True) or the test mode
+    :type dlp_ok: boolean
+    :param scan_rate: microscope frame rate. By default config.SIMULATED_SCAN_RATE
+    :type scan_rate: float
+    :param exp_Info: info about the experiment session. By default the one of config
+    :type exp_Info: dict
+    :param window: function taking the VirtualClock and returning the window.
+        By default a SimulatedWindow. A real window must advance the clock at
+        every flip (see bin/benchmark.py)
+    :param visual: stimulus classes, SimulatedVisual by default (psychopy.visual
+        with a real window)
+    :param realtime: applies the real-time mode (see config.REALTIME_MODE). It
+        is always reported in the metadata file
+    :type realtime: boolean
+    :returns: (output file, metadata file)
+
+    """
+    if exp_Info is None:
+        exp_Info = experiment_info()
+    add_session_info(exp_Info, psychopy.__version__)
+    os.makedirs(out_dir, exist_ok=True)
+
+    out = Output()
+    outFile = out.create_outfile_temp(out_dir, path_stimfile, exp_Info)
+    MAXRUNTIME = config.MAXRUNTIME
+
+    stimdict = Stimulus(path_stimfile).dict
+    rename_stimtypes(stimdict)
+
+    # Settings that would corrupt the bit planes of the pattern mode are refused
+    if stimdict.get("PATTERN_BIT_DEPTH", 0):
+        dlp_pattern.check_pattern_setup(stimdict, config.GAMMA_LS, config.CALIBRATE_GAMMA)
+
+    clock = VirtualClock()
+    win = SimulatedWindow(clock) if window is None else window(clock)
+    if not dlp_ok:
+        stimdict["MAXRUNTIME"] = 0
+    realtime = RealtimeMode(realtime)
+    stimlog.start(stimlog.log_filename(outFile.name), clock,
+                  initializer=realtime.helper_thread_initializer)
+
+    with simulated_daq(clock, scan_rate):
+        # As in main, the microscope is triggered first and the session is
+        # prepared during the pre-roll (the virtual clock does not move meanwhile)
+        nidaq = start_nidaq(dlp_ok, clock)
+
+        exp_Info['actual_frameRate'] = win.getActualFrameRate()
+        exp_Info['Timing_frame_rate'] = session_framerate(exp_Info['actual_frameRate'])
+        frame_timing(stimdict, exp_Info['Timing_frame_rate'])
+
+        textures = generate_textures(stimdict)
+        stim_object_ls = create_stimulus_objects(win, stimdict, visual or SimulatedVisual)
+        bg_ls, fg_ls = epoch_colors(stimdict)
+
+        stim_texture = textures[2]
+        texture_count = len(stim_texture) if "N" in stimdict["stimtype"] else None
+        schedule = epoch_schedule(stimdict, session_runtime(stimdict, MAXRUNTIME),
+                                  win.scrWidthCM, win.scrDistCM, config.SEED, texture_count)
+        metafile = write_main_setup(out_dir, dlp_ok, MAXRUNTIME, exp_Info, schedule)
+        append_main_setup(metafile, frame_log=os.path.basename(outFile.name), stimfile=path_stimfile,
+                          **session_streams(stimdict).metadata())
+        append_main_setup(metafile, **metadata_values(grating_diagnostics(stimdict, textures)))
+
+        prepare = epoch_preparer(exp_Info, bg_ls, fg_ls, textures, stimdict,
+                                 win.scrWidthCM, win.scrDistCM)
+        prefetcher = EpochPrefetcher(schedule, prepare, realtime.helper_thread_initializer)
+        prefetcher.get(0)
+        warm_up(win, stim_object_ls)
+        profiler = FrameProfiler() if config.PROFILE_FRAMES else None
+        realtime.enter(win)
+
+        preparation = clock.getTime()
+        clock.advance(config.TRIGGER_PAUSE - preparation)
+        append_main_setup(metafile, preroll_preparation_s=round(preparation, 3),
+                          stimulus_start_s=round(clock.getTime(), 4))
+        if stimdict.get("PATTERN_BIT_DEPTH", 0):
+            append_main_setup(metafile, **pattern_metadata(stim_texture, stimdict))
+        try:
+            run_epochs(win, stimdict, exp_Info, schedule, prefetcher, stim_object_ls,
+                       bg_ls, fg_ls, textures, None, out, outFile, dlp_ok, clock,
+                       nidaq, MAXRUNTIME, profiler, realtime)
+        finally:
+            realtime.exit()
+            prefetcher.close()
+            stimlog.stop()
+            outFile.close()
+            if profiler:
+                profiler.write(metafile)
+            realtime.write(metafile)
+            for taskHandle in nidaq[:2]:
+                if taskHandle:
+                    clearTask(taskHandle)
+
+    catalog.add_session(metafile, outFile.name)
+    return outFile.name, metafile
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Structured log of a session, written outside the presentation loop.
+
+Stimulus functions call `log` instead of print. A record (time, kind, message
+template and fields) is only appended to a queue (``collections.deque``,
+appending needs no lock). A background thread formats the records, prints them
+to the console at most config.LOG_RATE_LIMIT times per second and kind (the
+number of suppressed records is printed once the limit resets), and writes
+every record as a JSON line next to the output file (see `log_filename`).
+
+Before `start` (and after `stop`), `log` prints right away, so functions
+used outside of a session (offscreen rendering, analysis) behave as before.
+
+Example:
+    stimlog.log('direction', 'Direction: {direction}', direction=direction)
+
+"""
+
+import json
+import time
+import threading
+from collections import deque
+
+from modules import config
+
+_queue = deque()
+_state = {'thread': None, 'file': None, 'clock': None, 'limiter': None}
+_stop = threading.Event()
+
+
+def log(kind, message, **fields):
+
+    """ Logs a record
+
+    :param kind: type of the record, rate limits are per kind (e.g. 'epoch')
+    :type kind: str
+    :param message: message template, formatted with the fields (str.format)
+    :type message: str
+    :param fields: values of the record
+
+    """
+    clock = _state['clock']
+    record = (time.perf_counter(), clock.getTime() if clock is not None else None,
+              kind, message, fields)
+    if _state['thread'] is None:
+        print(message.format(**fields))
+    else:
+        _queue.append(record)
+
+
+def log_filename(outfile_name):
+    """ File of the records of a session, next to its output file """
+    base = outfile_name[:-4] if outfile_name.endswith('.txt') else outfile_name
+    return base + '_log.jsonl'
+
+
+def _jsonable(value):
+    return value.tolist() if hasattr(value, 'tolist') else str(value) # numpy values
+
+
+class _ConsoleLimiter(object):
+    """ At most `rate` console lines per second and kind """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.windows = {} # kind: [window start, lines, suppressed]
+
+    def allow(self, kind, t):
+        window = self.windows.setdefault(kind, [t, 0, 0])
+        if t - window[0] >= 1.0:
+            if window[2]:
+                print('[%s] %d messages suppressed' % (kind, window[2]))
+            window[:] = [t, 0, 0]
+        if window[1] < self.rate:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+    def flush(self):
+        for kind, window in self.windows.items():
+            if window[2]:
+                print('[%s] %d messages suppressed' % (kind, window[2]))
+            window[2] = 0
+
+
+def _drain(limiter):
+    f = _state['file']
+    while _queue:
+        t, session_time, kind, message, fields = _queue.popleft()
+        text = message.format(**fields)
+        if limiter.allow(kind, t):
+            print(text)
+        if f is not None:
+            f.write(json.dumps({'time': session_time, 'kind': kind, 'message': text,
+                                'fields': fields}, default=_jsonable) + '\n')
+
+
+def _run(limiter, initializer, interval):
+    if initializer is not None:
+        initializer()
+    while not _stop.wait(interval):
+        _drain(limiter)
+    _drain(limiter)
+    limiter.flush()
+
+
+def start(filename=None, clock=None, initializer=None, interval=0.1):
+
+    """ Starts the background thread
+
+    :param filename: JSON lines file for all records (None: console only)
+    :type filename: str
+    :param clock: session clock for the time of the records (global_clock)
+    :param initializer: called first in the thread (e.g.
+        `realtime.RealtimeMode.helper_thread_initializer`)
+    :type initializer: callable
+    :param interval: seconds between two drains of the queue
+    :type interval: float
+
+    """
+    stop()
+    _stop.clear()
+    _state['file'] = open(filename, 'w') if filename else None
+    _state['clock'] = clock
+    limiter = _state['limiter'] = _ConsoleLimiter(config.LOG_RATE_LIMIT)
+    _state['thread'] = threading.Thread(target=_run, args=(limiter, initializer, interval),
+                                        name='stimlog', daemon=True)
+    _state['thread'].start()
+
+
+def set_clock(clock):
+    """ Sets the clock for the time of the following records """
+    _state['clock'] = clock
+
+
+def stop():
+    """ Writes the remaining records and stops the background thread """
+    thread = _state['thread']
+    if thread is None:
+        return
+    _stop.set()
+    thread.join()
+    _state['thread'] = None
+    _drain(_state['limiter']) # records of other threads logged during the join
+    _state['limiter'].flush()
+    if _state['file'] is not None:
+        _state['file'].close()
+        _state['file'] = None
+    _state['clock'] = None
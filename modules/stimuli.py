@@ -7,24 +7,27 @@ Created on Wed Aug 26 15:52:43 2020
 
 # Importing packages
 from __future__ import division
-from psychopy import visual,core,logging,event
+from psychopy import visual,core,logging
 from psychopy.hardware import keyboard
 from psychopy.visual.windowwarp import Warper
-from matplotlib import pyplot as plt # For some checks
 import pyglet.gl as GL
-import PyDAQmx as daq
 import numpy as np
 import copy
 import time
-import cv2
 
 from modules.helper import *
+from modules.preparation import *
+from modules.profiling import start_profile
 from modules.exceptions import StopExperiment, MicroscopeException, StimulusTimeExceededException, GlobalTimeExceededException
 from modules import config
+from modules import stimlog
+from modules.controls import abort
+from modules.timing import epoch_frames, frame_rate, seconds_to_frames, EpochTimeline
+from modules.textures import LEVEL_RGB
 
 def field_flash(bg_ls,fg_ls,stim_texture,noise_arr,stimdict, epoch, window, global_clock, duration_clock,
                 outFile,out, stim_obj,dlpOK, viewpos, data,taskHandle = None,
-                lastDataFrame = 0, lastDataFrameStartTime = 0):
+                lastDataFrame = 0, lastDataFrameStartTime = 0, prepared = None, profiler = None):
 
     """field_flash:
 
@@ -34,12 +37,16 @@ def field_flash(bg_ls,fg_ls,stim_texture,noise_arr,stimdict, epoch, window, glob
     bg_ls: defines the level of luminance of the screen per epoch
     fg_ls:  defines the level of luminance of the stim_obj per epoch
     pos: defines the posisitonb of the stim_obj. [0,0] is the center of the screen
-    tau: duration in seconds for fg presentation
-    duration: entire duration in seconds (bg + fg)
+    tau: duration in seconds of the bg before the fg presentation (counted in frames)
+    duration: entire duration in seconds (bg + fg), counted in frames
     framerate: is the refresh rate of the monitor
+    prepared: resources from prepare_field_flash (computed here if None)
+    profiler: profiling.FrameProfiler timing the frame stages, or None
 
     """
 
+    if prepared is None:
+        prepared = prepare_field_flash(bg_ls,fg_ls,stim_texture,noise_arr,stimdict,epoch)
 
     win = window
     win.colorSpace = 'rgb' # R G B values in range: [-1, 1]
@@ -55,86 +62,42 @@ def field_flash(bg_ls,fg_ls,stim_texture,noise_arr,stimdict, epoch, window, glob
         stim_obj.height = stimdict["height"][epoch]
         
 
-    # set timing
-    tau = stimdict["tau"][epoch]
-    duration = stimdict["duration"][epoch]
-    framerate = config.FRAMERATE
-    frame_shift = 0 # For stim_obj texture
+    # set timing, in frames (see timing.frame_timing)
+    tau_frames, n_frames = epoch_frames(stimdict, epoch)
+    timeline = EpochTimeline.for_epoch(global_clock, stimdict, epoch)
+    frame_shift = prepared['frame_shift'] # For stim_obj texture
     start_frame = 0 # For stim_obj texture
+    circle_texture = prepared['circle_texture']
 
     # "number"  and "interSpace" attributes are present in only some stimuli
-    stim_obj_ls, space_ls = [], [] # Only implemented for vertical and horizontal bars (see bar.ori)
-    try:
-        stim_number = int(stimdict["number"][epoch])
-        inter_space = stimdict["interSpace"][epoch]
-        for i in range(stim_number):
-            if stim_number == 1:
-                space_ls.append(0.0)
-            else:
-
-                space_ls.append(inter_space * i)
-                #stim_obj.pos[0] = stim_obj.pos[0]-space_ls[i] # For sister objects
-            stim_obj_ls.append(stim_obj)
-    except:
-        stim_number = 1
-        stim_obj_ls.append(stim_obj)
-        space_ls.append(0.0)
-
-
-    # generating texture for luminance values
-    if stimdict["stimtype"][epoch] == 'NC':
-
-        wave_lenght = len(stim_texture[0]) # Lenght of the original wave
-        noise_arr = noise_arr[1,:,:] # Making lenghts of signal and noise the same
-
-        long_wave = stim_texture[0] # Initialyzing the array with 1 signal wave
-        for wave in stim_texture:
-            long_wave = np.append(long_wave,wave)
-        stim_texture = long_wave
-
-        long_noise_arr = noise_arr[0] # Initialyzing the array with 1 noise wave
-        for noise_wave in noise_arr:
-            long_noise_arr = np.append(long_noise_arr,noise_wave)
-        noise_arr = long_noise_arr
-
-        circle_texture = stim_texture + noise_arr # Final texture (=lum values) to apply
-        frequency =  stimdict["frequency"][epoch] # Frequency to change lum values
-        framerate = config.FRAMERATE # Screen frame rate
-        frame_shift = round((wave_lenght * frequency)/framerate)
-
+    space_ls = prepared['space_ls'] # Only implemented for vertical and horizontal bars (see bar.ori)
+    stim_obj_ls = [stim_obj] * len(space_ls)
 
     # Information to print
-    BG=  ((bg_ls[epoch][2]+1)/2)/(63.0/255.0) # Scaling values back to a range of [0 1]
-    FG= ((fg_ls[epoch][2]+1)/2)/(63.0/255.0)  # Scaling values back to a range of [0 1]
-    print(f'BG level: {BG}')
-    if BG == 0.0:
-        pass
+    BG, FG, WC = prepared['BG'], prepared['FG'], prepared['WC']
+    if WC is None:
+        stimlog.log('levels', 'BG level: {BG}', BG=BG)
     else:
-        # The WC calculation only makes sense if the win values is being showed
-        if stimdict["tau"][epoch] == stimdict["duration"][epoch]:
-            pass
-        else:
-            WC = (FG-BG)/BG
-            print(f'FG level: {FG}')
-            print(f'WC: {WC}')
+        stimlog.log('levels', 'BG level: {BG}\nFG level: {FG}\nWC: {WC}', BG=BG, FG=FG, WC=WC)
 
 
     # As long as duration, draw the stimulus
-    # Reset epoch timer
-    duration_clock = global_clock.getTime()
     reset_bar_position = False
 
-    for frameN in range(int(duration*framerate)):
-        # fast break on key (ESC) pressed
-        if len(event.getKeys(['escape'])):
+    stamp = start_profile(profiler, stimdict["stimtype"][epoch], n_frames)
+    for frameN in range(n_frames):
+        # fast break on key (ESC) pressed, see controls
+        if abort.stop_now:
             raise StopExperiment
-        
+        stamp() # keys
+
         #Resetting sisters stim_obj possition for next frame
         if reset_bar_position: # event avoided for first iteration (frame)
             stim_obj.pos[0] = stim_obj.pos[0] + sum(space_ls)
+        stamp() # update
 
-        # As long as tau, draw FOREGROUND (> sign direction)
-        if global_clock.getTime()-duration_clock >= tau:
+        # After tau, draw FOREGROUND
+        if frameN >= tau_frames:
             # For each bar object specified by the user (see "bar.number")
             for i,stim_obj in enumerate(stim_obj_ls):
                 try:
@@ -157,11 +120,12 @@ def field_flash(bg_ls,fg_ls,stim_texture,noise_arr,stimdict, epoch, window, glob
 
 
 
-        elif global_clock.getTime()-duration_clock < tau:
+        else:
             # stim_obj attributes for drawing BACKGROUND
             stim_obj.fillColor = bg_ls[epoch]
             stim_obj.lineColor= bg_ls[epoch]
             stim_obj.draw()
+        stamp() # draw
 
 
         # store Output
@@ -176,10 +140,15 @@ def field_flash(bg_ls,fg_ls,stim_texture,noise_arr,stimdict, epoch, window, glob
             check_timing_nidaq(dlpOK,stimdict["MAXRUNTIME"],global_clock,
                                taskHandle,data,lastDataFrame,
                                lastDataFrameStartTime)
+        stamp() # nidaq
         write_out(outFile,out)
 
         out.framenumber = out.framenumber +1
+        stamp() # write_out
         win.flip() # swap buffers
+        stamp() # flip
+        if frameN in timeline.marks:
+            timeline.flipped(frameN)
         reset_bar_position = True
         start_frame = start_frame + frame_shift
 
@@ -189,7 +158,7 @@ def field_flash(bg_ls,fg_ls,stim_texture,noise_arr,stimdict, epoch, window, glob
     return (out, lastDataFrame, lastDataFrameStartTime)
 
 
-def standing_stripes_random(bg_ls,fg_ls,stimdict, epoch, window, global_clock, duration_clock, outFile, out, bar, dlpOK, taskHandle=None, data=0, lastDataFrame=0, lastDataFrameStartTime=0):
+def standing_stripes_random(bg_ls,fg_ls,stimdict, epoch, window, global_clock, duration_clock, outFile, out, bar, dlpOK, taskHandle=None, data=0, lastDataFrame=0, lastDataFrameStartTime=0, prepared=None, profiler=None):
 
     """standing_stripes_random:
 
@@ -201,9 +170,14 @@ def standing_stripes_random(bg_ls,fg_ls,stimdict, epoch, window, global_clock, d
     Positions are equally spaced but does not appear in order, in order to
     prevent adaptation. Instead, they are shuffled based on a default seed.
 
+    prepared: resources from prepare_standing_stripes_random (computed here if None)
+    profiler: profiling.FrameProfiler timing the frame stages, or None
 
     """
 
+    if prepared is None:
+        prepared = prepare_standing_stripes_random(stimdict, epoch, window.scrWidthCM, window.scrDistCM)
+
     win = window
     win.color= bg_ls[epoch] # Background for selected epoch
 
@@ -214,21 +188,11 @@ def standing_stripes_random(bg_ls,fg_ls,stimdict, epoch, window, global_clock, d
     bar.height = stimdict["bar.height"][epoch]
     bar.ori = stimdict["bar.orientation"][epoch]
 
-    framerate = config.FRAMERATE
-    scr_width = win.scrWidthCM
-    scr_distance = win.scrDistCM
-    position_seed = config.SEED
-    bar_duration = int(stimdict["bar.duration"][epoch] * framerate)
-    bg_duration = int(stimdict["bg.duration"][epoch] * framerate)
-
+    bar_duration = prepared['bar_duration']
+    bg_duration = prepared['bg_duration']
 
     #Single bar, random locations
-    print(f'Getting random positions')
-    if stimdict["bar.orientation"][epoch] == 0:
-        positions = position_x(stimdict, epoch, screen_width=scr_width, distance=scr_distance, seed=position_seed)
-    elif stimdict["bar.orientation"][epoch] == 90:
-        positions = position_y(stimdict, epoch, screen_width=scr_width, distance=scr_distance, seed=position_seed)
-
+    positions = prepared['positions']
     bar_no = len(positions)
     epoch_duration = (bg_duration + bar_duration) * bar_no
 
@@ -236,10 +200,12 @@ def standing_stripes_random(bg_ls,fg_ls,stimdict, epoch, window, global_clock, d
     out.boutInd = out.boutInd + 1
 
     counter = [0, 0]
+    stamp = start_profile(profiler, stimdict["stimtype"][epoch], epoch_duration)
     for n in range(epoch_duration):
 
-        if len(event.getKeys(['escape'])):
+        if abort.stop_now:
             raise StopExperiment
+        stamp() # keys
 
         if counter[0] < bar_duration:
             if stimdict["bar.orientation"][epoch] == 0:
@@ -252,9 +218,11 @@ def standing_stripes_random(bg_ls,fg_ls,stimdict, epoch, window, global_clock, d
                 bar.pos = [0,positions[counter[1]]]
                 out.yPos = float(positions[counter[1]])
                 out.xPos = 0.0
+            stamp() # update
 
             #print(bar.pos)
             bar.draw()
+            stamp() # draw
 
 
             # out.xPos = float(positions[counter[1]])
@@ -264,6 +232,8 @@ def standing_stripes_random(bg_ls,fg_ls,stimdict, epoch, window, global_clock, d
             out.xPos = float("NaN")
             out.yPos = float("NaN")
             counter[0] += 1
+            stamp() # update
+            stamp() # draw
 
         elif counter[0] == (bg_duration + bar_duration - 1):
             out.xPos = float("NaN")
@@ -271,78 +241,73 @@ def standing_stripes_random(bg_ls,fg_ls,stimdict, epoch, window, global_clock, d
             counter[0] = 0
             counter[1] += 1 # For the next stripe
             out.boutInd = out.boutInd + 1
+            stamp() # update
+            stamp() # draw
 
         out.tcurr = global_clock.getTime()
 
          # quick and dirty fix to run stimulus on dlp without mic
         if not stimdict["MAXRUNTIME"] == 0:
             (out.data, lastDataFrame, lastDataFrameStartTime) = check_timing_nidaq(dlpOK, stimdict["MAXRUNTIME"], global_clock, taskHandle, data, lastDataFrame, lastDataFrameStartTime)
+        stamp() # nidaq
         write_out(outFile, out)
         out.framenumber = out.framenumber + 1
+        stamp() # write_out
 
         win.flip()
+        stamp() # flip
         # #SavingMovieFrames
         # win.getMovieFrame() #Frames are stored in memory until a saveMovieFrames() command is issued.
 
     return (out, lastDataFrame, lastDataFrameStartTime)
 
-def drifting_stripe(exp_Info,bg_ls,fg_ls,stimdict, epoch, window, global_clock, duration_clock, outFile,out, bar,dlpOK, viewpos, data,taskHandle = None, lastDataFrame = 0, lastDataFrameStartTime = 0):
+def drifting_stripe(exp_Info,bg_ls,fg_ls,stimdict, epoch, window, global_clock, duration_clock, outFile,out, bar,dlpOK, viewpos, data,taskHandle = None, lastDataFrame = 0, lastDataFrameStartTime = 0, prepared = None, profiler = None):
     """drifting_stripe:
+
+    prepared: resources from prepare_drifting_stripe (computed here if None)
+    profiler: profiling.FrameProfiler timing the frame stages, or None
     """
     #print(f' FUNCTION STARTS: {global_clock.getTime()}')
+    if prepared is None:
+        prepared = prepare_drifting_stripe(exp_Info, stimdict, epoch, window.scrWidthCM, window.scrDistCM)
+
     win = window
     win.color= bg_ls[epoch]  # Background for selected epoch
     bar.fillColor = fg_ls[epoch]
     bar.width = stimdict["bar.width"][epoch]
     bar.height = stimdict["bar.height"][epoch]
     bar.ori = stimdict["bar.orientation"][epoch]
-    # set timing
-    tau = stimdict["tau"][epoch]
-    duration = stimdict["duration"][epoch]
-    direction = stimdict["direction"][epoch]
-    framerate = config.FRAMERATE
-
-    # Size of your actual window (in degrees of visual angle)
-    scr_width = win.scrWidthCM
-    scr_distance = win.scrDistCM
+    # set timing, in frames (see timing.frame_timing)
+    tau_frames, n_frames = epoch_frames(stimdict, epoch)
+    timeline = EpochTimeline.for_epoch(global_clock, stimdict, epoch)
+    framerate = frame_rate(stimdict)
 
     # Setting edge positions
-    direction = set_edge_position_and_direction(bar,scr_width,scr_distance,exp_Info,direction)
-    print(f'Direction: {direction}')
+    bar.pos = prepared['pos']
+    direction = prepared['direction']
+    stimlog.log('direction', 'Direction: {direction}', direction=direction)
 
     # "bar.initPos" attribute are present in only some stimuli
-    try:
-        init_pos  = stimdict["bar.initPos"][epoch]
-        print(f'Initial position: {init_pos} ')
-    except:
+    init_pos = prepared['init_pos']
+    if init_pos is None:
         init_pos = 0.0 # In case the stim input file does not have an initial position, put it to the center
+    else:
+        stimlog.log('init_pos', 'Initial position: {init_pos} ', init_pos=init_pos)
 
     # "bar.number"  and "bar.interSpace" attributes are present in only some stimuli
-    bar_ls, space_ls = [], [] # Only implemented for vertical and horizontal bars (see bar.ori)
-    try:
-        bar_number = int(stimdict["bar.number"][epoch])
-        inter_space = stimdict["bar.interSpace"][epoch]
-        for i in range(bar_number):
-            bar_ls.append(bar)
-            if bar_number == 1:
-                space_ls.append(0.0)
-            else:
-                space_ls.append(inter_space * i)
-
-    except:
-        bar_number = 1
-        bar_ls.append(bar)
-        space_ls.append(0.0)
+    bar_number = prepared['bar_number']
+    space_ls = prepared['space_ls'] # Only implemented for vertical and horizontal bars (see bar.ori)
+    bar_ls = [bar] * len(space_ls)
 
 
     # As long as duration, draw the stimulus
-    # Reset epoch timer
     reset_bar_position = False
-    duration_clock = global_clock.getTime()
-    for frameN in range(int(duration*framerate)): # for seconds*100fps
-        # fast break on key (ESC) pressed
-        if len(event.getKeys(['escape'])):
+    stamp = start_profile(profiler, stimdict["stimtype"][epoch], n_frames)
+    for frameN in range(n_frames):
+        # fast break on key (ESC) pressed, see controls
+        if abort.stop_now:
             raise StopExperiment
+        stamp() # keys
 
         #Resetting sisters bar possition for next frame
         if reset_bar_position: # event avoided for first iteration (frame)
@@ -356,9 +321,10 @@ def drifting_stripe(exp_Info,bg_ls,fg_ls,stimdict, epoch, window, global_clock,
                     bar.pos[1] = bar.pos[1] + sum(space_ls)
                 elif direction == "down":
                     bar.pos[1] = bar.pos[1] - sum(space_ls)
+        stamp() # update
 
-        # As long as tau, draw FOREGROUND (> sign direction)
-        if global_clock.getTime()-duration_clock >= tau:
+        # After tau, draw FOREGROUND
+        if frameN >= tau_frames:
 
             # For each bar object specified by the user (see "bar.number")
             for i,bar in enumerate(bar_ls):
@@ -396,6 +362,7 @@ def drifting_stripe(exp_Info,bg_ls,fg_ls,stimdict, epoch, window, global_clock,
                         bar.pos -= (0.0,(stimdict["velocity"][epoch]/framerate)/bar_number*np.sqrt(2))
                 #print(bar.pos)
                 bar.draw()
+        stamp() # draw
         # store Output
         out.tcurr = global_clock.getTime()
         out.xPos = float(bar.pos[0])
@@ -405,9 +372,14 @@ def drifting_stripe(exp_Info,bg_ls,fg_ls,stimdict, epoch, window, global_clock,
         # quick and dirty fix to run stimulus on dlp without mic
         if not stimdict["MAXRUNTIME"] == 0:
             (out.data,lastDataFrame, lastDataFrameStartTime) = check_timing_nidaq(dlpOK,stimdict["MAXRUNTIME"],global_clock,taskHandle,data,lastDataFrame,lastDataFrameStartTime)
+        stamp() # nidaq
         write_out(outFile,out)
         out.framenumber = out.framenumber +1
+        stamp() # write_out
         win.flip() # swap buffers
+        stamp() # flip
+        if frameN in timeline.marks:
+            timeline.flipped(frameN)
         reset_bar_position = True
         # #SavingMovieFrames
         # win.getMovieFrame() #Frames are stored in memory until a saveMovieFrames() command is issued.
@@ -416,18 +388,23 @@ def drifting_stripe(exp_Info,bg_ls,fg_ls,stimdict, epoch, window, global_clock,
 
 
 
-def stim_noise(bg_ls,stim_texture,stimdict, epoch, window, global_clock, duration_clock, outFile, out, noise, dlpOK, taskHandle=None, data=0, lastDataFrame=0, lastDataFrameStartTime=0):
+def stim_noise(bg_ls,stim_texture,stimdict, epoch, window, global_clock, duration_clock, outFile, out, noise, dlpOK, taskHandle=None, data=0, lastDataFrame=0, lastDataFrameStartTime=0, prepared=None, profiler=None):
 
     """stim_noise:
 
+    prepared: resources from prepare_stim_noise (computed here if None)
+    profiler: profiling.FrameProfiler timing the frame stages, or None
 
     """
+    if prepared is None:
+        prepared = prepare_stim_noise(stim_texture)
+
     win = window
     win.color= bg_ls[epoch]  # Background for selected epoch
     win.colorSpace = 'rgb'
 
-    # set timing
-    framerate = config.FRAMERATE
+    # set timing, rate of the frame counts (see timing.frame_timing)
+    framerate = frame_rate(stimdict)
 
 
     # Size of your actual window (in the units chosen, normally degrees)
@@ -440,7 +417,7 @@ def stim_noise(bg_ls,stim_texture,stimdict, epoch, window, global_clock, duratio
     noise.size= (maxhorang, maxhorang)
     noise.sf = 1/maxhorang
 
-    tex_duration = int(stimdict['texture.duration'][epoch] * framerate) # Duration in frame number
+    tex_duration = seconds_to_frames(stimdict['texture.duration'][epoch], framerate) # Duration in frame number
     tex_count = int(stimdict['texture.count'][epoch])
     hor_size = np.sqrt(stimdict['texture.hor_size'][epoch])
     vert_size = np.sqrt(stimdict['texture.vert_size'][epoch])
@@ -448,43 +425,91 @@ def stim_noise(bg_ls,stim_texture,stimdict, epoch, window, global_clock, duratio
     vert_size  = int(vert_size)
 
 
-    texture = copy.deepcopy(stim_texture) # An independent copy
-    texture *= 63.0/255.0 # convert from 8 bit depth to 6 bit depth.
-    texture = texture * 2 - 1 # the *2-1 part converts the color space [0,1] -> [-1,1]
+    if 'frames' in prepared:
+        # DLP pattern mode: several textures per video frame (see dlp_pattern)
+        return stim_noise_patterns(prepared, stimdict, epoch, win, global_clock, outFile, out,
+                                   noise, dlpOK, taskHandle, data, lastDataFrame,
+                                   lastDataFrameStartTime, profiler)
 
+    texture = prepared['texture'] # uint8 levels
 
+    #Geeting RGB values for the texture
+    rgb_t = numpy.zeros((texture.shape[1],texture.shape[2],3), dtype=np.float32)
+    rgb_t[:,:,0] = -1 # All R value to -1
+    rgb_t[:,:,1] = -1 # All G value to -1
+
+    stamp = start_profile(profiler, stimdict["stimtype"][epoch], len(texture)*tex_duration)
     for count,t in enumerate(texture):
         for frameN in range(tex_duration):
-            if len(event.getKeys(['escape'])):
+            if abort.stop_now:
                 raise StopExperiment
+            stamp() # keys
 
-            #Geeting RGB values for the texture
-            rgb_t = numpy.zeros((t.shape[0],t.shape[1],3), dtype=np.float32)
-            rgb_t[:,:,0] = -1 # All R value to -1
-            rgb_t[:,:,1] = -1 # All G value to -1
-            rgb_t[:,:,2] = t
-            # for i in range(1):
-            #     rgb_t[:,:,i+1] = t # Setting G and B values
-
-            # noise.tex = t
-            noise.tex = rgb_t
+            if frameN == 0: # uploaded once per texture, as float only here
+                rgb_t[:,:,2] = LEVEL_RGB[t]
+                noise.tex = rgb_t
+            stamp() # update
             noise.draw()
+            stamp() # draw
 
             out.tcurr = global_clock.getTime()
             out.theta = count
             if not stimdict["MAXRUNTIME"] == 0:
                 (out.data, lastDataFrame, lastDataFrameStartTime) = check_timing_nidaq(dlpOK, stimdict["MAXRUNTIME"], global_clock,taskHandle,data,lastDataFrame,lastDataFrameStartTime)
+            stamp() # nidaq
             write_out(outFile, out)
 
             out.framenumber = out.framenumber + 1
+            stamp() # write_out
 
             win.flip()
+            stamp() # flip
 
     return (out, lastDataFrame, lastDataFrameStartTime)
 
 
 
-def noisy_grating(_useNoise,_useTex,viewpos,bg_ls,stim_texture,noise_arr,stimdict, epoch, window, global_clock, duration_clock, outFile, out, grating, dlpOK, taskHandle=None, data=0, lastDataFrame=0, lastDataFrameStartTime=0):
+def stim_noise_patterns(prepared, stimdict, epoch, win, global_clock, outFile, out, noise, dlpOK, taskHandle=None, data=0, lastDataFrame=0, lastDataFrameStartTime=0, profiler=None):
+
+    """stim_noise_patterns:
+
+    Presents a noise texture stack packed into bit planes (from
+    prepare_stim_noise_patterns), one packed frame per flip. theta in the
+    frame log is the number of the first pattern of the frame in the epoch
+    (see dlp_pattern.expand_frame_log).
+
+    """
+    frames = prepared['frames']
+    n_patterns = prepared['patterns_per_frame']
+
+    stamp = start_profile(profiler, stimdict["stimtype"][epoch], len(frames))
+    for frameN, rgb_t in enumerate(frames):
+        if abort.stop_now:
+            raise StopExperiment
+        stamp() # keys
+
+        noise.tex = rgb_t
+        stamp() # update
+        noise.draw()
+        stamp() # draw
+
+        out.tcurr = global_clock.getTime()
+        out.theta = frameN * n_patterns
+        if not stimdict["MAXRUNTIME"] == 0:
+            (out.data, lastDataFrame, lastDataFrameStartTime) = check_timing_nidaq(dlpOK, stimdict["MAXRUNTIME"], global_clock,taskHandle,data,lastDataFrame,lastDataFrameStartTime)
+        stamp() # nidaq
+        write_out(outFile, out)
+
+        out.framenumber = out.framenumber + 1
+        stamp() # write_out
+
+        win.flip()
+        stamp() # flip
+
+    return (out, lastDataFrame, lastDataFrameStartTime)
+
+
+def noisy_grating(_useNoise,_useTex,viewpos,bg_ls,stim_texture,noise_arr,stimdict, epoch, window, global_clock, duration_clock, outFile, out, grating, dlpOK, taskHandle=None, data=0, lastDataFrame=0, lastDataFrameStartTime=0, profiler=None):
 
     """noisy_grating:
 
@@ -504,10 +529,10 @@ def noisy_grating(_useNoise,_useTex,viewpos,bg_ls,stim_texture,noise_arr,stimdic
     # win.flip() # present background
 
 
-    # set timing
-    framerate = config.FRAMERATE
-    tau = stimdict["tau"][epoch]
-    duration = int(stimdict['duration'][epoch] * framerate) # Duration in frame number
+    # set timing, in frames (see timing.frame_timing)
+    framerate = frame_rate(stimdict)
+    tau_frames, duration = epoch_frames(stimdict, epoch) # Duration in frame number
+    timeline = EpochTimeline.for_epoch(global_clock, stimdict, epoch)
 
 
     # Size of your actual window (in the units chosen, normally degrees)
@@ -526,9 +551,9 @@ def noisy_grating(_useNoise,_useTex,viewpos,bg_ls,stim_texture,noise_arr,stimdic
     try:
         grating.ori = stimdict["orientation"][epoch]
         direction = int(stimdict["direction"][epoch]) # Direction of the moving grating: either +1 or -1
-        print('Orientation: {}, Direction: {}'.format( grating.ori,direction))
+        stimlog.log('direction', 'Orientation: {ori}, Direction: {direction}', ori=grating.ori, direction=direction)
     except:
-        print('Stim without specified direction and orientation. Default: 0 deg and left')
+        stimlog.log('direction', 'Stim without specified direction and orientation. Default: 0 deg and left')
         grating.ori = 0
         direction = 1
 
@@ -547,22 +572,22 @@ def noisy_grating(_useNoise,_useTex,viewpos,bg_ls,stim_texture,noise_arr,stimdic
     # variable to store
     if stimdict["stimtype"][epoch] == 'noisygrating':
         output_value = stimdict['SNR'][epoch]
-        print('{} SNR'.format(output_value))
+        stimlog.log('output_value', '{value} SNR', value=output_value)
     elif stimdict["stimtype"][epoch] == 'lumgrating':
         output_value = stimdict['lum'][epoch]
-        print('{} lum'.format(output_value))
+        stimlog.log('output_value', '{value} lum', value=output_value)
     elif stimdict["stimtype"][epoch] == 'TFgrating':
         output_value = float(stimdict['velocity'][epoch])/stimdict['sWavelength'][epoch] # Temporal frequency
-        print('{} hz'.format(output_value))
+        stimlog.log('output_value', '{value} hz', value=output_value)
 
 
-    # Reset epoch timer
-    duration_clock = global_clock.getTime()
     max_tex_value = (2*(63.0/255.0))-1 # Max value in stim_texture after scaling
     min_tex_value = -1 # Min value in stim_texture after scaling
+    stamp = start_profile(profiler, stimdict["stimtype"][epoch], duration)
     for frameN in range(duration):
-            if len(event.getKeys(['escape'])):
+            if abort.stop_now:
                 raise StopExperiment
+            stamp() # keys
             # noise.draw()   #The noise object is currently NOT IN USE
             if _useNoise:
                 # Adding noise to the original signal
@@ -574,57 +599,40 @@ def noisy_grating(_useNoise,_useTex,viewpos,bg_ls,stim_texture,noise_arr,stimdic
                 grating.tex = grating_texture
 
             # After tau, change the phase of grating (motion)
-            if global_clock.getTime()-duration_clock >= tau:
+            if frameN >= tau_frames:
                 grating.phase += _phaseValue
+            stamp() # update
             grating.draw()
+            stamp() # draw
 
 
             out.tcurr = global_clock.getTime()
             out.theta = output_value
             if not stimdict["MAXRUNTIME"] == 0:
                 (out.data, lastDataFrame, lastDataFrameStartTime) = check_timing_nidaq(dlpOK, stimdict["MAXRUNTIME"], global_clock,taskHandle,data,lastDataFrame,lastDataFrameStartTime)
+            stamp() # nidaq
             write_out(outFile, out)
 
             out.framenumber = out.framenumber + 1
+            stamp() # write_out
 
             win.flip()
+            stamp() # flip
+            if frameN in timeline.marks:
+                timeline.flipped(frameN)
 
             ##SavingMovieFrames
             #win.getMovieFrame() #Frames are stored in memory until a saveMovieFrames() command is issued.
 
-    # Checking what we actually present per frame
-    fig1,ax = plt.subplots(2,2)
-    ax[0, 0].plot(grating.tex.T)
-    ax[0, 0].axhline(y = max_tex_value, color = 'k', linestyle = ':', label = "max")
-    ax[0, 0].axhline(y = min_tex_value, color = 'k', linestyle = '--', label = "min")
-    ax[0, 0].set_title('{}%MC_{}_SNR'.format(stimdict['michealson.contrast'][-1]*100,output_value))
-    ax[0, 1].plot(grating.tex[0])
-    ax[0, 1].set_title('{}%MC_{}_SNR'.format(stimdict['michealson.contrast'][-1]*100,output_value))
-    ax[1, 0].plot(grating.tex[0:3,:].T)
-    ax[1, 1].imshow(grating.tex,cmap=plt.get_cmap('gray'))
-
-    # Computing contrast of the image based on proportion of pixels with min and max values
-    total_num_pixels = grating.tex.size
-    max_count = np.count_nonzero(grating.tex== np.max(grating.tex))
-    max_ratio = round((max_count/ total_num_pixels),3)
-    min_count = np.count_nonzero(grating.tex== np.min(grating.tex))
-    min_ratio = round((min_count/ total_num_pixels),3)
-
-    contrast = (max_ratio + min_ratio)/2 # mean
-    ax[1, 1].set_title('Contrast: %f' % (round(contrast,3)*100))
-
-
-
-    output_dir = 'F:\\SebastianFilesExternalDrive\\Science\\PhDAGSilies\\2pData Python_data\\Trash'
-   #  fig1.savefig('{}\\{}%MC_{}_SNR.png'.format(output_dir,stimdict['michealson.contrast'][-1]*100,output_value))
-   # fig1.savefig('{}\\{}%MC_{}_SNR.pdf'.format(output_dir,stimdict['michealson.contrast'][-1]*100,output_value))
+    # Contrast diagnostics of the textures: see diagnostics (written to the
+    # metadata at preparation) and bin/grating_report.py (figures)
 
     return (out, lastDataFrame, lastDataFrameStartTime)
 
 
 
 
-def dotty_grating(_useNoise,_useTex,viewpos,bg_ls,stim_texture,stimdict, epoch, window, global_clock, duration_clock, outFile, out, grating,dots, dlpOK, taskHandle=None, data=0, lastDataFrame=0, lastDataFrameStartTime=0):
+def dotty_grating(_useNoise,_useTex,viewpos,bg_ls,stim_texture,stimdict, epoch, window, global_clock, duration_clock, outFile, out, grating,dots, dlpOK, taskHandle=None, data=0, lastDataFrame=0, lastDataFrameStartTime=0, profiler=None):
 
     """dotty_grating:
 
@@ -644,10 +652,10 @@ def dotty_grating(_useNoise,_useTex,viewpos,bg_ls,stim_texture,stimdict, epoch,
     win.colorSpace = 'rgb'
 
 
-    # set timing
-    framerate = config.FRAMERATE
-    tau = stimdict["tau"][epoch]
-    duration = int(stimdict['duration'][epoch] * framerate) # Duration in frame number
+    # set timing, in frames (see timing.frame_timing)
+    framerate = frame_rate(stimdict)
+    tau_frames, duration = epoch_frames(stimdict, epoch) # Duration in frame number
+    timeline = EpochTimeline.for_epoch(global_clock, stimdict, epoch)
 
 
     # Size of your actual window (in the units chosen, normally degrees)
@@ -674,30 +682,37 @@ def dotty_grating(_useNoise,_useTex,viewpos,bg_ls,stim_texture,stimdict, epoch,
     dots.speed= 0
     dots.fieldSize= (maxhorang, maxhorang)
 
-    # Reset epoch timer
-    duration_clock = global_clock.getTime()
+    stamp = start_profile(profiler, stimdict["stimtype"][epoch], duration)
     for frameN in range(duration):
-            if len(event.getKeys(['escape'])):
+            if abort.stop_now:
                 raise StopExperiment
+            stamp() # keys
 
             # dots.draw()
             dots.setAutoDraw(True)
             # After tau, change the phase of grating (motion)
-            if global_clock.getTime()-duration_clock >= tau:
+            if frameN >= tau_frames:
                 grating.phase += _phaseValue
                 # grating.setPhase(stimdict['setPhase'][epoch],'+') #Deprecated
+            stamp() # update
             grating.draw()
+            stamp() # draw
 
 
             out.tcurr = global_clock.getTime()
             out.theta = dots.nDots
             if not stimdict["MAXRUNTIME"] == 0:
                 (out.data, lastDataFrame, lastDataFrameStartTime) = check_timing_nidaq(dlpOK, stimdict["MAXRUNTIME"], global_clock,taskHandle,data,lastDataFrame,lastDataFrameStartTime)
+            stamp() # nidaq
             write_out(outFile, out)
 
             out.framenumber = out.framenumber + 1
+            stamp() # write_out
 
-            win.flip()
+            win.flip() # the dots (autoDraw) are drawn here
+            stamp() # flip
+            if frameN in timeline.marks:
+                timeline.flipped(frameN)
 
     dots.setAutoDraw(False)
     return (out, lastDataFrame, lastDataFrameStartTime)
@@ -78,6 +78,35 @@ def test_window_3masks():
 
 
 
+def test_window_mask():
+    '''
+    Same layout as test_window_3masks, but masked inside the main window with
+    masking.WindowMask (config.MASK_POLYGONS). Only the lower-central part of
+    the circle should be visible.
+    '''
+
+    from psychopy import visual,core
+    from psychopy.visual.windowwarp import Warper # perspective correction
+    from masking import WindowMask
+    import config
+
+    win = visual.Window(fullscr = False, monitor='testMonitor',
+                                size = [400,400], viewScale = [1,1],
+                                screen = 0,
+                                color=[-1,-1,-1],useFBO = True,allowGUI=False,
+                                viewOri = 0.0)
+    warper = Warper(win, warp='spherical', warpGridsize= 128, eyepoint = [0.5,0.5])
+    win_mask = WindowMask(win, config.MASK_POLYGONS, cache_dir='')
+
+    circle_stim = visual.Circle(win=win, radius=400, units='pix',
+                        fillColor=[1,1,1], edges = 128)
+    circle_stim.draw()
+    win.flip()
+
+    core.wait(3)
+    win.close()
+
+
 def test_window_4masks(_width=400,_height= 400,_xpos=568,_ypos=232):
 
     '''
@@ -173,3 +202,211 @@ def test_window_4masks(_width=400,_height= 400,_xpos=568,_ypos=232):
     print(f"The used monitor '{win.monitor.name}' has a resolution of: {win.monitor.getSizePix()} pixels")
     print(f"Main screnn located at: {win.pos} pixels")
     '''
+
+
+def test_uint8_noise_textures():
+
+    '''
+    The noise textures are stored as uint8 levels (textures.noise_levels) and
+    converted to rgb only at upload (textures.LEVEL_RGB). The levels shown
+    must be the same as with the former float path, in which the [0,1]
+    texture was scaled to 6 bits and [-1,1] and copied into a float32 rgb
+    array.
+    '''
+
+    import numpy as np
+    from modules.textures import noise_levels, display_levels, LEVEL_RGB
+
+    np.random.seed(54378)
+    for values in (np.random.choice([0,0.5,1], size=(100,16,16)), # ternary noise
+                   np.random.rand(100,16,16), # arbitrary stimulus data
+                   np.linspace(0,1,1001)):
+        # Former float path
+        texture = values * (63.0/255.0)
+        texture = texture * 2 - 1
+        rgb_t = np.zeros(texture.shape, dtype=np.float32)
+        rgb_t[:] = texture
+
+        levels = noise_levels(values)
+        assert levels.dtype == np.uint8
+        assert levels.max() <= 63
+        assert np.array_equal(display_levels(LEVEL_RGB[levels]), display_levels(rgb_t))
+
+    # Every level survives the conversion to rgb
+    assert np.array_equal(display_levels(LEVEL_RGB), np.arange(256))
+    print('uint8 noise textures: shown levels identical to the float path')
+
+
+def test_trial_averages():
+
+    '''
+    Trial averages of modules.trials against a loop over the presentations,
+    on a synthetic frame log (stimulus at 60 Hz, imaging at 10 Hz) and
+    memory-mapped traces read in blocks of a few ROIs.
+    '''
+
+    import os
+    import tempfile
+    import numpy as np
+    from modules.framelog import FrameLog, DTYPE
+    from modules.trials import load_traces, imaging_rate, presentations, trial_averages
+
+    # 12 presentations of 3 epochs, 2 s each, after 1 s without scanning
+    rows = np.zeros(12 * 120, dtype=DTYPE)
+    rows['frame'] = np.arange(len(rows))
+    rows['tcurr'] = 1 + rows['frame'] / 60.0
+    rows['boutInd'] = rows['frame'] // 120
+    rows['epoch'] = rows['boutInd'] % 3
+    rows['data'] = np.floor(rows['tcurr'] * 10) - 9 # counter at 1 during the first imaging frame
+    log = FrameLog(rows)
+    assert abs(imaging_rate(log) - 10) < 1e-6
+
+    np.random.seed(54378)
+    n_rois, n_frames = 50, 260
+    filename = os.path.join(tempfile.mkdtemp(), 'traces.npy')
+    np.save(filename, np.random.rand(n_rois, n_frames).astype(np.float32))
+    traces = load_traces(filename)
+
+    pre, post = 3, 4
+    averages = trial_averages(traces, log, pre=pre, post=post, block_rois=7)
+    epochs, onsets, durations = presentations(log)
+    for epoch in range(3):
+        n = durations[epochs == epoch].min()
+        trials = [np.asarray(traces[:, onset - pre:onset + n + post])
+                  for e, onset in zip(epochs, onsets) if e == epoch and onset >= pre]
+        stack = np.array(trials, dtype=np.float64)
+        assert averages[epoch]['trials'] == len(trials)
+        assert np.allclose(averages[epoch]['mean'], stack.mean(axis=0))
+        assert np.allclose(averages[epoch]['sem'], stack.std(axis=0, ddof=1) / np.sqrt(len(trials)))
+    print('trial averages: identical to the loop over presentations')
+
+
+def test_reverse_correlation():
+
+    '''
+    Response-triggered averages of modules.revcorr, computed in chunks and
+    blocks (also in 2 processes), against the direct formula, and the
+    receptive field of a synthetic ROI responding to the noise 2 imaging
+    frames later.
+    '''
+
+    import numpy as np
+    from modules.framelog import FrameLog, DTYPE
+    from modules.revcorr import (reverse_correlation, contrast_stack, stimulus_samples,
+                                 binned_stimulus)
+
+    stimdict = {"STIMULUSDATA": "TERNARY_TEXTURE", "stimtype": ["C", "N"],
+                "texture.hor_size": [0, 8], "texture.vert_size": [0, 8], "texture.duration": [0, 0.05]}
+    contrast, shape = contrast_stack(stimdict)
+
+    # 2 s of circle, then 1500 textures of 3 frames at 60 Hz; imaging at 10 Hz
+    rows = np.zeros(120 + 4500, dtype=DTYPE)
+    rows['frame'] = np.arange(len(rows))
+    rows['tcurr'] = 1 + rows['frame'] / 60.0
+    rows['boutInd'] = rows['epoch'] = rows['frame'] >= 120
+    rows['theta'][120:] = np.arange(4500) // 3
+    rows['data'] = np.floor(rows['tcurr'] * 10) - 9
+    log = FrameLog(rows)
+    n_frames = int(rows['data'][-1])
+    frames, textures = stimulus_samples(log, stimdict, len(contrast))
+    stimulus, shown = binned_stimulus(contrast, frames, textures, 0, n_frames)
+
+    np.random.seed(54378)
+    fields = np.random.randn(20, contrast.shape[1])
+    traces = np.random.randn(20, n_frames) * 0.5 + 3
+    traces[:, 2:] += fields @ stimulus[:-2].T
+
+    result = reverse_correlation(traces, log, stimdict, lags=range(5), block_rois=7, chunk_frames=100)
+    parallel = reverse_correlation(traces, log, stimdict, lags=range(5), processes=2, block_rois=6)
+    assert np.allclose(result['sta'], parallel['sta'], atol=1e-5)
+    for lag in range(5):
+        k = np.arange(lag, n_frames)
+        k = k[shown[k - lag]]
+        response = traces[:, k] - traces[:, k].mean(axis=1)[:, None]
+        direct = response @ stimulus[k - lag] / len(k)
+        assert np.allclose(result['sta'][:, lag].reshape(20, -1), direct, atol=1e-4)
+    fit = [np.corrcoef(result['sta'][roi, 2].ravel(), fields[roi])[0, 1] for roi in range(20)]
+    assert min(fit) > 0.8
+    print('reverse correlation: identical to the direct formula, receptive fields found at lag 2')
+
+
+def test_position_tuning():
+
+    '''
+    Receptive fields of modules.rfmap on a synthetic standing stripe session:
+    a 0 deg epoch (xPos) and a 90 deg epoch (yPos), bars of 1 s at 15
+    shuffled positions with 1 s of background, imaging at 10 Hz. Every ROI
+    responds to the bars of epoch 0 with a Gaussian tuning curve.
+    '''
+
+    import numpy as np
+    from modules.framelog import FrameLog, DTYPE
+    from modules.rfmap import stripe_axes, flashes, position_tuning
+
+    np.random.seed(54378)
+    positions = np.arange(-35, 40, 5.0)
+    rows = []
+    for epoch, column in ((0, 'xpos'), (1, 'ypos'), (0, 'xpos')):
+        for position in np.random.permutation(positions):
+            flash = np.zeros(120, dtype=DTYPE)
+            flash['epoch'] = epoch
+            flash['xpos'] = flash['ypos'] = np.nan
+            flash[column][:60] = position
+            flash[{'xpos': 'ypos', 'ypos': 'xpos'}[column]][:60] = 0.0
+            rows.append(flash)
+    rows = np.concatenate(rows)
+    rows['frame'] = np.arange(len(rows))
+    rows['tcurr'] = 1 + rows['frame'] / 60.0
+    rows['data'] = np.floor(rows['tcurr'] * 10) - 9
+    log = FrameLog(rows)
+    assert stripe_axes(log) == {0: 'xpos', 1: 'ypos'}
+    found = flashes(log)
+    assert len(found['onset']) == 3 * len(positions) and found['frames'].min() == 10
+
+    n_rois = 500
+    centres, widths = np.random.uniform(-20, 20, n_rois), np.random.uniform(4, 10, n_rois)
+    traces = np.random.randn(n_rois, int(rows['data'][-1]) + 10) * 0.1
+    for epoch, position, onset, frames in zip(found['epoch'], found['position'], found['onset'], found['frames']):
+        if epoch == 0:
+            traces[:, onset:onset + frames] += np.exp(-(position - centres) ** 2 / (2 * widths ** 2))[:, None]
+
+    tuning = position_tuning(traces, log, block_rois=64)
+    assert tuning[0]['axis'] == 'xpos' and tuning[1]['axis'] == 'ypos'
+    assert np.array_equal(tuning[0]['positions'], positions) and (tuning[0]['flashes'] == 2).all()
+    fit = tuning[0]['fit']
+    assert np.nanmedian(np.abs(fit['centre'] - centres)) < 0.5
+    assert np.nanmedian(np.abs(fit['sigma'] / widths - 1)) < 0.1
+    print('position tuning: centres and widths of the receptive fields recovered')
+
+
+def test_random_streams():
+
+    '''
+    Streams of modules.rng: the values of a unit (epoch, frame) are the same
+    however they are reached, streams and units do not overlap, the legacy
+    streams keep RandomState(seed), and the dots of a frame of the renderer
+    are the ones of renewing the dots frame by frame.
+    '''
+
+    import numpy as np
+    from modules.rng import RandomStreams
+    from modules.rendering import dot_positions, DOT_LIFE
+
+    streams = RandomStreams(54378, 'counter')
+    frame = streams.stack('noise', 50, lambda g: g.standard_normal((4, 4)), 2)[37]
+    assert np.array_equal(frame, streams.generator('noise', 2, 37).standard_normal((4, 4)))
+    assert not np.array_equal(frame, streams.generator('noise', 2, 38).standard_normal((4, 4)))
+    assert not np.array_equal(frame, streams.generator('snr_ladder', 2, 37).standard_normal((4, 4)))
+    legacy = RandomStreams(54378, 'legacy')
+    assert np.array_equal(legacy.random_state('positions', 3).rand(5), np.random.RandomState(54378).rand(5))
+    assert not legacy.is_legacy('noise')
+
+    n_dots = 300
+    generator = streams.generator('dots', 1, 0)
+    xy = generator.uniform(-0.5, 0.5, size=(n_dots, 2))
+    first = np.ceil(DOT_LIFE * (1 - generator.random(n_dots)) - 1)
+    for frameN in range(30):
+        dead = (frameN >= first) & ((frameN - first) % DOT_LIFE == 0)
+        xy[dead] = streams.generator('dots', 1, frameN + 1).uniform(-0.5, 0.5, size=(n_dots, 2))[dead]
+        assert np.array_equal(dot_positions(streams, 1, n_dots, frameN), xy)
+    print('random streams: frames regenerated directly, legacy draws kept')
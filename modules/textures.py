@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Generation (or loading) of the stimulus textures defined in the stimulus file.
+
+Used by the main script and by the offscreen renderer, so that both present
+exactly the same textures. Nothing here needs a window.
+
+"""
+
+import numpy as np
+
+from modules import config
+from modules.rng import RandomStreams
+
+PROJECTOR_BITS = 6 # noise textures use the 6 bit depth of the DLP (see get_dlpcol)
+LEVEL_RGB = np.arange(256, dtype=np.float32) / 127.5 - 1 # 8-bit level -> psychopy rgb
+TERNARY_VALUES = (0, 0.5, 1) # dark, gray, bright
+TERNARY_COUNT = 10000 # textures of a TERNARY_TEXTURE stack
+
+
+def display_levels(rgb):
+
+    """ 8-bit levels shown for psychopy rgb values (the framebuffer rounds
+    the float32 color to the nearest level)
+
+    :param rgb: values in [-1,1]
+    :type rgb: numpy array
+    :returns: uint8 array
+
+    """
+    rgb = np.asarray(rgb, dtype=np.float32)
+    return np.rint(np.clip((rgb + 1) * np.float32(0.5), 0, 1) * np.float32(255)).astype(np.uint8)
+
+
+def noise_levels(values):
+
+    """ Noise texture values in [0,1] to the 8-bit levels they are shown at,
+    scaled to the projector bit depth. Stored as uint8 and converted to
+    psychopy rgb (LEVEL_RGB) only when a texture is uploaded.
+
+    :param values: e.g. the ternary choices 0, 0.5 and 1
+    :type values: numpy array
+    :returns: uint8 array of the same shape
+
+    """
+    top = (2 ** PROJECTOR_BITS - 1) / 255.0
+    return display_levels(np.asarray(values) * top * 2 - 1) # [0,1] -> 6 bit -> [-1,1]
+
+
+def ternary_noise(stimdict, seed=None):
+
+    """ Choices of the ternary noise of a TERNARY_TEXTURE stimulus file, as
+    presented: drawn from the ternary stream of the session (see rng; the
+    legacy draws are np.random.choice of TERNARY_VALUES after
+    np.random.seed(seed), texture k of a counter stream is drawn directly),
+    1D noise repeated to a square texture
+
+    :param stimdict: stimulus dictionary
+    :type stimdict: dict
+    :param seed: default: config.SEED
+    :type seed: int
+    :returns: (TERNARY_COUNT, rows, cols) uint8 array of indices into TERNARY_VALUES
+
+    """
+    hor_size = int(stimdict["texture.hor_size"][1])
+    vert_size = int(stimdict["texture.vert_size"][1])
+    streams = RandomStreams(seed, stimdict.get("RNG_MODE"))
+    size = (hor_size, vert_size)
+    if streams.is_legacy('ternary'):
+        # Same draws as np.random.choice(TERNARY_VALUES, ...), which picks indices
+        random_state = streams.random_state('ternary')
+        choices = random_state.choice(len(TERNARY_VALUES), size=(TERNARY_COUNT,) + size).astype(np.uint8)
+    else:
+        choices = streams.stack('ternary', TERNARY_COUNT,
+                                lambda generator: generator.integers(0, len(TERNARY_VALUES), size, dtype=np.uint8))
+    if hor_size == 1:
+        choices = np.repeat(choices, vert_size, axis=1)
+    elif vert_size == 1:
+        choices = np.repeat(choices, hor_size, axis=2)
+    return choices
+
+
+class ScaledNoise(object):
+    """ Noise of one epoch of an SNR ladder: a shared unit-variance noise
+    source times the standard deviation of the epoch, computed when a frame
+    is drawn. Indexed like the (frames, rows, cols) noise array it replaces.
+
+        :param unit_noise: (frames, rows, cols) standard normal noise
+        :type unit_noise: numpy array
+        :param std: standard deviation of the epoch
+        :type std: float
+
+    """
+
+    def __init__(self, unit_noise, std):
+        self.unit_noise = unit_noise
+        self.std = std
+        self.shape = unit_noise.shape
+
+    def __len__(self):
+        return len(self.unit_noise)
+
+    def __getitem__(self, index):
+        return self.unit_noise[index] * self.std
+
+    def __iter__(self):
+        for frame in self.unit_noise:
+            yield frame * self.std
+
+    def max(self):
+        return self.unit_noise.max() * self.std
+
+
+def generate_textures(stimdict):
+
+    """ Generates or loads the stimulus data if STIMULUSDATA is not NULL.
+    With the header SNR_LADDER 1, the noisy sinusoidal epochs share one
+    noise source (see `ScaledNoise`)
+
+    :param stimdict: stimulus dictionary
+    :type stimdict: dict
+    :returns: stim_texture_ls (one texture or None per epoch), noise_array_ls
+        (one noise array or None per epoch), stim_texture (the last texture
+        generated, used by the noise stimulus, as uint8 levels, see
+        `noise_levels`), _useTex and _useNoise flags
+    :rtype: tuple
+
+    """
+    stim_texture = None
+    _useTex = False
+    _useNoise = False
+
+    if stimdict["STIMULUSDATA"] != "NULL":
+            if stimdict["STIMULUSDATA"][0:10] == "SINUSOIDAL":
+                _useTex = True
+                _useNoise = False
+                # Creting texture for the sinusoidal grating
+                dimension = 128 # It needs to be square power-of-two (e.g. 64 x 64) for PsychoPy
+                if stimdict['stimtype'][-1] == 'noisy_circle':
+                        dimension = config.FRAMERATE  # It needs to be the lentgh of the screen refresh (frame) rate for a proper frequency sampling
+
+                stim_texture_ls = list()
+                for e in range(stimdict["EPOCHS"]):
+                    con= stimdict['michealson.contrast'][e]
+                    lum = stimdict['lum'][e]
+                    #Important here to recalculate bg and fg from original lum nand con values.
+                    # The previous bg and fg were already corrected for dlp bit depth
+                    # and [-1,1] color range. We want to avoud this here for BG and FG.
+                    # Calculation of BG and FG here depends on the michelson contrast definition
+                    FG = (con * lum) + lum #wrong: lum*(1+con)
+                    BG = 2*lum - FG # wrong:lum*(1-con)
+                    print(f'Sinusoidal wave, FG:{FG} BG:{BG}')
+                    f = 1# generate a single cycle
+                    # Generate 1D wave and modulate the luminance and contrast
+                    x = np.arange(dimension)
+                    # Wave needs to be scaled to 0-1 so we can modulate it easier later
+                    sine_signal = (np.sin(2 * np.pi * f * x / dimension)/2 +0.5)
+
+                    # Scaling the signal
+                    #It stills need to me done differently. the MContrast scaling is not properly working and the scaling is not symmetric.
+                    stim_texture  = (sine_signal  * 2*(FG - BG)* (63.0/255.0))-1 + (BG*(63.0/255.0)*2)# Scaling the signal to [-1,1] range, from 8bit to 6bit range and  to chosen MContrast
+                    stim_texture_min = np.min(stim_texture)
+
+                    # Making either 1D or 2D sine wave
+                    stim_texture = np.tile(stim_texture, [dimension,1]) # Saving 2D wave in the list
+                    stim_texture_ls.append(stim_texture)
+
+
+
+                if stimdict["STIMULUSDATA"][11:16] == "NOISY":
+                    _useNoise = True
+                    # Adding noise using target SNR
+                    # Set a target SNR
+                    # Creating noise array per epoch
+
+                    # Max value of noise to avoid clipping of the sinusoidal wave
+                    tolerated_noise_max_value_1 = 2*(abs(-1 - stim_texture_min)) # based on the lowest value for PSYCHOPY, -1
+                    tolerated_noise_max_value_2 = np.min(stim_texture)-np.max(stim_texture) # based on the sinusoidal values. THIS CALCULATION ONLY MAKES SENSE FOR 50% MC
+
+                    # SNR ladder: one unit-variance noise source for all epochs,
+                    # scaled per SNR when drawn (same realisation at every level)
+                    # Noise frame k of an epoch is drawn from its own unit of
+                    # the noise stream (see rng), reproducible and seekable
+                    streams = RandomStreams(None, stimdict.get("RNG_MODE"))
+                    ladder = stimdict.get("SNR_LADDER", 0)
+                    if ladder:
+                        unit_noise = streams.stack('snr_ladder', 1000,
+                                                   lambda generator: generator.standard_normal((dimension,dimension)))
+
+                    print('Noise levels (STD):')
+                    noise_array_ls = list()
+                    for i,SNR in enumerate(stimdict['SNR']):
+                        target_snr = SNR
+                        print(f'SNR {i}: {target_snr}')
+                        # SNR as mean of standard deviation of signal/standard deviation of noise
+                        # Wikipedia coeficient of variation definition
+
+                        signal = stim_texture_ls[i][1]
+                        signal_mean = np.mean(signal)
+                        signal_std = np.std(signal)
+                        signal_std = np.std(stim_texture_ls[i])
+                        print(f'STD signal {i}: {signal_std}')
+                        signal_rms = np.sqrt(np.mean(signal**2))
+                        noise_mean = 0
+                        noise_std = (signal_std/target_snr) # Before was: (signal_mean/target_snr)
+                        print(f'STD {i}: {noise_std}')
+                        if ladder:
+                            noise_arr = ScaledNoise(unit_noise, noise_std)
+                        else:
+                            noise_arr = streams.stack('noise', 1000,
+                                                      lambda generator: generator.normal(noise_mean, noise_std, (dimension,dimension)), i)
+                        print(f'MAX VALUE {i}: {noise_arr.max()}')
+                        if noise_arr.max() > tolerated_noise_max_value_1:
+                            print(f'WARNING!!! NOISE CLIPPING FOR EPOCH: {i}')
+                        noise_rms = np.sqrt(np.mean(noise_arr[0,:,:]**2))
+                        noise_array_ls.append(noise_arr)
+
+                        # Plotting what it will be presented
+                        max_value = (2*(63.0/255.0))-1 # Max value in stim_texture after scaling
+                        min_value = -1 # Min value in stim_texture after scaling
+                        noisy_sinosoidal_wave = signal + noise_arr [1,1,:]
+                        noisy_sinosoidal_wave[np.where(noisy_sinosoidal_wave> max_value)] = max_value
+                        noisy_sinosoidal_wave[np.where(noisy_sinosoidal_wave<min_value)] = min_value
+                        # plt.plot(noisy_sinosoidal_wave)
+                        # plt.show()
+
+                        # Calculating std for noise based on SNR definition in dB
+
+                        # target_snr_db = 10* (np.log10(mean_signal/np.sqrt(noise_std)))
+                        # target_snr_db = 10* (np.log10(signal_std/noise_std))
+                        target_snr_db = 20* np.log10(signal_rms/noise_rms) # Wikipedia decibels definition
+                        # print(f'SNR_dB {i}: {target_snr_db}')
+
+                else:
+                    noise_array_ls = list()
+                    for e in range(stimdict["EPOCHS"]):
+                        noise_array_ls.append(None)
+
+            elif  stimdict["STIMULUSDATA"] == "TERNARY_TEXTURE":
+                stim_texture_ls = list()
+                noise_array_ls = list()
+                # uint8 levels looked up per choice, no float stack
+                stim_texture = noise_levels(np.array(TERNARY_VALUES))[ternary_noise(stimdict)]
+
+                stim_texture_ls.append(stim_texture)
+                noise_array_ls.append(None)
+
+            elif  stimdict["STIMULUSDATA"] == "POLIGON":
+                stim_texture_ls = list()
+                noise_array_ls = list()
+                x=int(stimdict["texture.hor_size"][1])
+                y=int(stimdict["texture.vert_size"][1])
+                z= 10000 # z- dimension (here frames presented over time)
+                curr_arr = np.zeros(size=(z,x,y))
+
+
+
+            else: # Specific case for older files (used in 2pstim-C- in which ["STIMULUSDATA"] was not specified
+                 import h5py
+                 stim_texture = h5py.File(stimdict["STIMULUSDATA"])
+                 stim_texture= stim_texture['stimulus'][()]
+                 stim_texture= stim_texture[0:10000,:,:] # 10000 is a fix value
+                 stim_texture = noise_levels(stim_texture)
+
+    else: # When ["STIMULUSDATA"]is == "NULL"
+        stim_texture_ls = list()
+        noise_array_ls = list()
+        for e in range(stimdict["EPOCHS"]):
+            stim_texture_ls.append(None)
+            noise_array_ls.append(None)
+        _useTex = False
+        _useNoise = False
+
+    return stim_texture_ls, noise_array_ls, stim_texture, _useTex, _useNoise
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Frame-counted timing of the epochs.
+
+`tau` and `duration` of every epoch are converted once per session into
+numbers of frames (`frame_timing`), at the refresh rate measured by the
+window (`session_framerate`). The stimulus loops then decide background,
+foreground or motion from the frame number alone, so onsets do not depend
+on when the clock is read.
+
+`EpochTimeline` reads the clock only right after the flips that matter
+(first frame, tau transition, last frame) and logs the planned versus the
+actual flip time of each transition (see stimlog, kind 'transition').
+
+"""
+
+from modules import config
+from modules import stimlog
+
+
+def seconds_to_frames(seconds, framerate):
+    """ Number of frames closest to a duration (robust to e.g. 0.3*60 = 17.999...) """
+    return int(round(seconds * framerate))
+
+
+def session_framerate(measured, nominal=None, tolerance=0.05):
+
+    """ Refresh rate used for the frame counts of a session.
+
+    :param measured: rate measured by the window (win.getActualFrameRate()), or None
+    :type measured: float
+    :param nominal: config.FRAMERATE by default
+    :type nominal: float
+    :param tolerance: relative deviation from the nominal rate accepted
+    :type tolerance: float
+    :returns: the measured rate, or the nominal one if the measurement failed or
+        is far from it (e.g. a test monitor at another refresh rate)
+
+    """
+    nominal = config.FRAMERATE if nominal is None else nominal
+    if measured is None or abs(measured - nominal) > tolerance * nominal:
+        stimlog.log('timing', 'Measured frame rate {measured} not used, frame counts at {nominal} Hz',
+                    measured=measured, nominal=nominal)
+        return float(nominal)
+    return float(measured)
+
+
+def frame_timing(stimdict, framerate):
+
+    """ Adds the frame counts of every epoch to the stimulus dictionary:
+    "tau.frames", "duration.frames" (for the attributes present) and
+    "timing.framerate"
+
+    :param stimdict: stimulus attributes (see `helper.Stimulus`)
+    :type stimdict: dict
+    :param framerate: see `session_framerate`
+    :type framerate: float
+
+    """
+    stimdict["timing.framerate"] = framerate
+    for name in ("tau", "duration"):
+        if name in stimdict:
+            stimdict[name + ".frames"] = [seconds_to_frames(value, framerate)
+                                         for value in stimdict[name]]
+
+
+def frame_rate(stimdict):
+    """ Rate of the frame counts of a session, for per-frame steps (speed,
+    phase). Without `frame_timing`, config.FRAMERATE """
+    return stimdict.get("timing.framerate", config.FRAMERATE)
+
+
+def epoch_frames(stimdict, epoch):
+    """ (tau frames, duration frames) of an epoch. Without `frame_timing`,
+    counted at config.FRAMERATE """
+    if "duration.frames" in stimdict:
+        return stimdict["tau.frames"][epoch], stimdict["duration.frames"][epoch]
+    return (seconds_to_frames(stimdict["tau"][epoch], config.FRAMERATE),
+            seconds_to_frames(stimdict["duration"][epoch], config.FRAMERATE))
+
+
+class EpochTimeline(object):
+    """ Planned versus actual flip times of the transitions of an epoch.
+
+    After the flip of frame N, call `flipped(N)` if N is in `marks`.
+
+        :param clock: the session clock (global_clock)
+        :param framerate: rate of the frame counts ("timing.framerate")
+        :type framerate: float
+        :param epoch: epoch index
+        :type epoch: int
+        :param tau_frames: frame of the tau transition
+        :type tau_frames: int
+        :param n_frames: frames of the epoch
+        :type n_frames: int
+
+    """
+
+    def __init__(self, clock, framerate, epoch, tau_frames, n_frames):
+        self.clock = clock
+        self.framerate = framerate
+        self.epoch = epoch
+        self.start = None
+        self.names = {0: 'onset', tau_frames: 'tau', n_frames - 1: 'end'}
+        self.marks = frozenset(frame for frame in self.names if 0 <= frame < n_frames)
+
+    @classmethod
+    def for_epoch(cls, clock, stimdict, epoch):
+        """ Timeline from the frame counts of `frame_timing` """
+        tau_frames, n_frames = epoch_frames(stimdict, epoch)
+        return cls(clock, stimdict.get("timing.framerate", config.FRAMERATE), epoch,
+                   tau_frames, n_frames)
+
+    def flipped(self, frameN):
+        """ Logs the transition shown by the flip of frame N """
+        actual = self.clock.getTime()
+        if frameN == 0:
+            self.start = actual
+            return
+        planned = self.start + frameN / self.framerate
+        stimlog.log('transition', 'Epoch {epoch} {name} at frame {frame}: planned {planned:.4f} s, '
+                    'actual {actual:.4f} s ({error_ms:+.2f} ms)', epoch=self.epoch,
+                    name=self.names[frameN], frame=frameN, planned=planned, actual=actual,
+                    error_ms=(actual - planned) * 1000)
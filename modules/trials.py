@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Epoch-aligned trial averages of imaging traces.
+
+The frame log gives, for every stimulus frame, the presentation (boutInd),
+its epoch and the number of microscope frames counted so far by the NI-DAQ
+(data). One presentation is one trial; it starts at the imaging frame
+scanned during its first stimulus frame (`presentations`).
+
+`trial_windows` turns the presentations into an index array of imaging
+frames per epoch (trials x window, `pre` frames before the onset, the
+shortest presentation of the epoch and `post` frames after it), so that
+`traces[:, index]` cuts the trials of all ROIs at once. `trial_averages`
+streams over blocks of ROIs, each read once, so the traces can be a
+memory-mapped array larger than the memory (see `load_traces`):
+
+    traces = load_traces('tseries_traces.npy') # (n_rois, n_imaging_frames)
+    log = framelog.read_frame_log('..._stimulus_output_537_41.txt')
+    averages = trial_averages(traces, log, pre=5, post=10)
+    averages[2]['mean'] # (n_rois, window) mean response to epoch 2
+
+Sessions recorded without the frame counter (MAXRUNTIME 0 in the stimulus
+file) are aligned with the imaging frame rate instead (rate, see
+`imaging_frames`).
+
+"""
+
+import numpy as np
+
+from modules.framelog import run_lengths
+
+IMAGING_FRAME_OFFSET = -1 # the counter is at 1 while the first imaging frame is scanned
+BLOCK_BYTES = 64 * 1024 * 1024 # traces read per block of ROIs
+
+
+def load_traces(filename):
+    """ Traces (n_rois, n_imaging_frames) of a .npy file, memory-mapped """
+    return np.load(filename, mmap_mode='r')
+
+
+def imaging_rate(log):
+
+    """ Imaging frame rate of a session, from the frame counter of the frame log
+
+    :param log: `framelog.FrameLog`
+    :returns: float (Hz), None without counted frames
+
+    """
+    counted = np.concatenate(([True], np.diff(log['data']) != 0)) & (log['data'] > 0)
+    data, tcurr = log['data'][counted], log['tcurr'][counted]
+    if len(data) < 2 or tcurr[-1] == tcurr[0]:
+        return None
+    return float(np.polyfit(tcurr, data, 1)[0])
+
+
+def imaging_frames(log, offset=IMAGING_FRAME_OFFSET, rate=None):
+
+    """ Imaging frame scanned during every stimulus frame
+
+    :param log: `framelog.FrameLog`
+    :param offset: imaging frame index = data + offset
+    :type offset: int
+    :param rate: imaging frame rate (Hz). If given, the frames are computed
+        from the times instead (the clock starts at the trigger), for
+        sessions whose counter was not read (MAXRUNTIME 0 in the stimulus file)
+    :type rate: float
+    :returns: int array
+
+    """
+    if rate is not None:
+        return np.floor(log['tcurr'] * rate).astype(np.int64)
+    return log['data'] + offset
+
+
+def presentations(log, offset=IMAGING_FRAME_OFFSET, rate=None):
+
+    """ Epoch and imaging frames of every presentation (run of boutInd)
+
+    :param log: `framelog.FrameLog`
+    :param offset: imaging frame index = data + offset
+    :type offset: int
+    :param rate: see `imaging_frames`
+    :returns: (epochs, first imaging frames, imaging frames until the next
+        presentation), int arrays. The last presentation ends after the
+        imaging frame of its last stimulus frame
+
+    """
+    _, starts, _ = run_lengths(log['boutInd'])
+    frames = imaging_frames(log, offset, rate)
+    onsets = frames[starts]
+    ends = np.concatenate((onsets[1:], [frames[-1] + 1])) if len(starts) else onsets
+    return log['epoch'][starts], onsets, ends - onsets
+
+
+def trial_windows(log, n_imaging_frames, pre=0, post=0, frames=None, offset=IMAGING_FRAME_OFFSET,
+                  rate=None):
+
+    """ Imaging frames of the trials of every epoch
+
+    Trials whose window does not lie within the recording, and presentations
+    before the microscope started, are left out.
+
+    :param log: `framelog.FrameLog`
+    :param n_imaging_frames: length of the traces
+    :type n_imaging_frames: int
+    :param pre: frames before the onset
+    :type pre: int
+    :param post: frames after the stimulus
+    :type post: int
+    :param frames: frames of the stimulus, int or {epoch: int} (default: the
+        shortest presentation of the epoch)
+    :param offset: see `presentations`
+    :param rate: see `imaging_frames`, for sessions without the frame counter
+    :returns: {epoch: (n_trials, pre + frames + post) int array}
+
+    """
+    epochs, onsets, durations = presentations(log, offset, rate)
+    if len(onsets) and rate is None and (onsets < 0).all():
+        print('>>> WARNING <<< No presentation during the recording: the frame counter '
+              'was not read (MAXRUNTIME 0)? Pass the imaging rate (rate)')
+    windows = {}
+    for epoch in np.unique(epochs):
+        mask = (epochs == epoch) & (onsets >= 0)
+        if not mask.any():
+            continue
+        n = frames.get(int(epoch)) if isinstance(frames, dict) else frames
+        n = int(durations[mask].min()) if n is None else int(n)
+        index = onsets[mask, None] + np.arange(-pre, n + post)
+        index = index[(index[:, 0] >= 0) & (index[:, -1] < n_imaging_frames)]
+        if len(index):
+            windows[int(epoch)] = index
+    return windows
+
+
+def trial_stacks(traces, index):
+
+    """ Trials of all ROIs
+
+    :param traces: (n_rois, n_imaging_frames) array
+    :param index: one epoch of `trial_windows`
+    :returns: (n_trials, n_rois, window) array
+
+    """
+    return np.asarray(traces)[:, index].transpose(1, 0, 2)
+
+
+def _block_rois(traces, windows):
+    """ ROIs per block, so that a block and its trials fit in BLOCK_BYTES """
+    per_roi = traces.shape[1] + sum(index.size for index in windows.values())
+    return max(1, BLOCK_BYTES // (8 * per_roi))
+
+
+def trial_averages(traces, log, pre=0, post=0, frames=None, offset=IMAGING_FRAME_OFFSET,
+                   rate=None, block_rois=None):
+
+    """ Mean and SEM over the trials of every epoch, for all ROIs
+
+    :param traces: (n_rois, n_imaging_frames) array or memmap (see `load_traces`)
+    :param log: `framelog.FrameLog` of the session
+    :param pre: see `trial_windows`
+    :param post: see `trial_windows`
+    :param frames: see `trial_windows`
+    :param offset: see `presentations`
+    :param rate: see `imaging_frames`
+    :param block_rois: ROIs read at once (default: BLOCK_BYTES of float64)
+    :type block_rois: int
+    :returns: {epoch: dict} with mean and sem ((n_rois, window) float arrays,
+        sem is NaN with a single trial), trials (their number), frames (the
+        index of `trial_windows`) and pre
+
+    """
+    n_rois, n_imaging_frames = traces.shape
+    windows = trial_windows(log, n_imaging_frames, pre, post, frames, offset, rate)
+    averages = {epoch: {'mean': np.empty((n_rois, index.shape[1])),
+                        'sem': np.empty((n_rois, index.shape[1])),
+                        'trials': len(index), 'frames': index, 'pre': pre}
+                for epoch, index in windows.items()}
+    if block_rois is None:
+        block_rois = _block_rois(traces, windows)
+
+    for first in range(0, n_rois, block_rois):
+        block = np.asarray(traces[first:first + block_rois], dtype=np.float64)
+        for epoch, index in windows.items():
+            stack = block[:, index] # (rois, trials, window)
+            averages[epoch]['mean'][first:first + block_rois] = stack.mean(axis=1)
+            if len(index) > 1:
+                sem = stack.std(axis=1, ddof=1) / np.sqrt(len(index))
+            else:
+                sem = np.nan
+            averages[epoch]['sem'][first:first + block_rois] = sem
+    return averages
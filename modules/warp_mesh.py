@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Vectorized generation of perspective-correction (warp) meshes.
+
+Same geometry as ``psychopy.visual.windowwarp.Warper`` (spherical and
+cylindrical projections), but computed without Python loops. Meshes are
+cached in ``config.CACHE_DIR`` as binary .npy files (x, y, u, v and opacity
+stacked), keyed by every parameter that changes the mesh, and loaded by
+``perspective_correction.CachedWarper`` with ``warp='warpfile'``: reading
+one is faster than computing the mesh, parsing a text warpfile is not.
+Paul Bourke warpfiles (filetype 2) are still read and written.
+
+"""
+
+import os
+import numpy
+
+
+def warp_grid(warp, eyepoint, mon_width_cm, mon_height_cm, dist_cm, xgrid, ygrid):
+
+    """ Computes vertex and texture coordinates on a regular grid.
+
+    :param warp: 'spherical' or 'cylindrical'
+    :type warp: str
+    :param eyepoint: eye position, [0.5, 0.5] is the screen center
+    :type eyepoint: list
+    :param mon_width_cm: width of the projection area
+    :type mon_width_cm: float
+    :param mon_height_cm: height of the projection area
+    :type mon_height_cm: float
+    :param dist_cm: distance from the eye to the screen
+    :type dist_cm: float
+    :param xgrid: number of grid points along x
+    :type xgrid: int
+    :param ygrid: number of grid points along y
+    :type ygrid: int
+    :returns: (x, y, u, v) float32 arrays of shape (ygrid, xgrid). x and y in
+        normalized device coordinates [-1, 1], u and v in texture space [0, 1]
+
+    """
+    if warp not in ('spherical', 'cylindrical'):
+        raise ValueError('Unknown warp specification: %s' % warp)
+    isCylindrical = warp == 'cylindrical'
+
+    # eye position in cm
+    xEye = eyepoint[0] * mon_width_cm
+    yEye = eyepoint[1] * mon_height_cm
+
+    x_coords, y_coords = numpy.meshgrid(numpy.linspace(-1.0, 1.0, xgrid),
+                                        numpy.linspace(-1.0, 1.0, ygrid))
+    x, y = numpy.meshgrid(numpy.linspace(0, mon_width_cm, xgrid) - xEye,
+                          numpy.linspace(0, mon_height_cm, ygrid) - yEye)
+
+    r = numpy.sqrt(numpy.square(x) + numpy.square(y) + numpy.square(dist_cm))
+    azimuth = numpy.arctan(x / dist_cm)
+    altitude = numpy.arcsin(y / r)
+
+    # calculate the texture coordinates
+    if isCylindrical:
+        tx = dist_cm * numpy.sin(azimuth)
+        ty = dist_cm * numpy.sin(altitude)
+    else:
+        tx = dist_cm * (1 + x / r) - dist_cm
+        ty = dist_cm * (1 + y / r) - dist_cm
+
+    # prevent div0
+    azimuth[azimuth == 0] = numpy.finfo(numpy.float32).eps
+    altitude[altitude == 0] = numpy.finfo(numpy.float32).eps
+
+    # the texture coordinates (which are now lying on the sphere) are
+    # remapped back onto the plane of the display
+    if isCylindrical:
+        tx = tx * azimuth / numpy.sin(azimuth)
+        ty = ty * altitude / numpy.sin(altitude)
+    else:
+        centralAngle = numpy.arccos(numpy.cos(altitude) * numpy.cos(numpy.abs(azimuth)))
+        arcLength = centralAngle * dist_cm # distance from eyepoint to texture vertex
+        theta = numpy.arctan2(ty, tx)
+        tx = arcLength * numpy.cos(theta)
+        ty = arcLength * numpy.sin(theta)
+
+    u_coords = tx / mon_width_cm + 0.5
+    v_coords = ty / mon_height_cm + 0.5
+
+    return (x_coords.astype('float32'), y_coords.astype('float32'),
+            u_coords.astype('float32'), v_coords.astype('float32'))
+
+
+def grid_to_quads(*grids):
+
+    """ Expands grid arrays of shape (ygrid, xgrid) into per-quad vertices.
+
+    Every quad gets its 4 corners in the order the Warper draws them:
+    (y,x), (y,x+1), (y+1,x+1), (y+1,x).
+
+    :returns: list with one array of shape ((ygrid-1)*(xgrid-1)*4,) per grid
+
+    """
+    quads = []
+    for grid in grids:
+        corners = numpy.stack([grid[:-1, :-1], grid[:-1, 1:],
+                               grid[1:, 1:], grid[1:, :-1]], axis=-1)
+        quads.append(corners.reshape(-1))
+    return quads
+
+
+def warpfile_name(warp, eyepoint, screen_width, distance, gridsize, win_size,
+                  cache_dir):
+
+    """ Returns the warpfile path for one set of warp parameters """
+
+    name = 'warp_%s_eye%g_%g_w%g_d%g_grid%d_win%dx%d.npy' % (
+        warp, eyepoint[0], eyepoint[1], screen_width, distance, gridsize,
+        win_size[0], win_size[1])
+    return os.path.join(cache_dir, name)
+
+
+def write_warpfile(filename, x, y, u, v, opacity=None):
+
+    """ Writes a warp mesh as a Paul Bourke warpfile (filetype 2) """
+
+    rows, cols = x.shape
+    if opacity is None:
+        opacity = numpy.ones_like(x)
+    warpdata = numpy.column_stack([a.reshape(-1) for a in (x, y, u, v, opacity)])
+
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    numpy.savetxt(filename, warpdata, fmt='%.7f',
+                  header='2\n%d %d' % (cols, rows), comments='')
+
+
+def write_mesh(filename, x, y, u, v, opacity=None):
+
+    """ Writes a warp mesh as a binary .npy file, (5, rows, cols) float32 """
+
+    if opacity is None:
+        opacity = numpy.ones_like(x)
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename, 'wb') as fh: # exact name, numpy.save would append .npy
+        numpy.save(fh, numpy.stack([x, y, u, v, opacity]).astype('float32'))
+
+
+def read_warpfile(filename):
+
+    """ Reads a warp mesh: a .npy file of `write_mesh` or a Paul Bourke
+    warpfile (filetype 2)
+
+    :returns: (x, y, u, v, opacity) float32 arrays of shape (rows, cols)
+
+    """
+    if filename.endswith('.npy'):
+        mesh = numpy.load(filename)
+        if mesh.ndim != 3 or mesh.shape[0] != 5:
+            raise ValueError('warpfile data incorrect: ' + filename)
+        return tuple(mesh)
+
+    with open(filename) as fh:
+        filetype = int(fh.readline())
+        cols, rows = map(int, fh.readline().split())
+    warpdata = numpy.loadtxt(filename, skiprows=2, dtype='float32', ndmin=2)
+
+    if filetype != 2 or warpdata.shape != (cols * rows, 5):
+        raise ValueError('warpfile data incorrect: ' + filename)
+
+    return tuple(warpdata[:, i].reshape(rows, cols) for i in range(5))
+
+
+def get_warpfile(warp, eyepoint, screen_width, distance, gridsize, win_size,
+                 cache_dir):
+
+    """ Returns the path of the cached mesh (.npy, see `write_mesh`) for
+    these parameters.
+
+    The mesh is computed and written only if it is not cached yet.
+    The height of the projection area follows from the window aspect ratio,
+    as in the psychopy Warper.
+
+    :param warp: 'spherical' or 'cylindrical'
+    :param eyepoint: eye position, [0.5, 0.5] is the screen center
+    :param screen_width: width of the projection area in cm
+    :param distance: distance from the eye to the screen in cm
+    :param gridsize: number of grid points per axis
+    :param win_size: window size in pixels
+    :param cache_dir: directory where the meshes are stored
+    :returns: path
+
+    """
+    filename = warpfile_name(warp, eyepoint, screen_width, distance, gridsize,
+                             win_size, cache_dir)
+    if not os.path.exists(filename):
+        mon_height_cm = screen_width / (win_size[0] / win_size[1])
+        grids = warp_grid(warp, eyepoint, screen_width, mon_height_cm, distance,
+                          gridsize, gridsize)
+        # written under a temporary name first, since several processes may
+        # compute the same mesh at once (e.g. movie export)
+        temp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        write_mesh(temp_filename, *grids)
+        os.replace(temp_filename, filename)
+
+    return filename
+
+
+def remap_indices(x, y, u, v, width, height):
+
+    """ Per-pixel lookup table of a warp mesh, to warp frames on the CPU.
+
+    Every pixel of the warped frame gets the texture coordinates (u, v)
+    interpolated from the mesh at its position, as OpenGL does when it
+    draws the mesh. Those are converted into the pixel of the unwarped frame
+    it shows (nearest neighbour).
+
+    :param x, y, u, v: mesh grids as returned by `warp_grid` or `read_warpfile`.
+        x and y must be a regular grid over [-1, 1]
+    :param width: frame width in pixels
+    :type width: int
+    :param height: frame height in pixels
+    :type height: int
+    :returns: (rows, cols, valid) arrays of shape (height, width). rows and
+        cols index the unwarped frame (row 0 at the top), valid is False
+        where the mesh shows nothing (outside the texture)
+
+    """
+    ygrid, xgrid = x.shape
+    # position of every pixel center in the mesh (fractional grid index)
+    gx = ((numpy.arange(width) + 0.5) / width) * (xgrid - 1)
+    gy = (1 - (numpy.arange(height) + 0.5) / height) * (ygrid - 1) # row 0 at the top
+    gx, gy = numpy.meshgrid(gx, gy)
+    x0 = numpy.minimum(numpy.floor(gx).astype(int), xgrid - 2)
+    y0 = numpy.minimum(numpy.floor(gy).astype(int), ygrid - 2)
+    fx = gx - x0
+    fy = gy - y0
+
+    def interpolate(grid):
+        return ((grid[y0, x0] * (1 - fx) + grid[y0, x0 + 1] * fx) * (1 - fy) +
+                (grid[y0 + 1, x0] * (1 - fx) + grid[y0 + 1, x0 + 1] * fx) * fy)
+
+    pixel_u = interpolate(u)
+    pixel_v = interpolate(v)
+    valid = (pixel_u >= 0) & (pixel_u <= 1) & (pixel_v >= 0) & (pixel_v <= 1)
+    cols = numpy.clip(numpy.floor(pixel_u * width).astype(int), 0, width - 1)
+    rows = numpy.clip(numpy.floor((1 - pixel_v) * height).astype(int), 0, height - 1)
+
+    return rows, cols, valid